@@ -0,0 +1,178 @@
+"""asyncio counterpart to scope_client: a microscope client whose RPC calls are
+coroutines, so that a single event loop can drive the scope while also doing
+other work (e.g. retrieving live images, running a GUI, or talking to other
+instruments). Example:
+
+    async def main():
+        scope, scope_properties = await client_main()
+        await scope.stage.set_z(10)
+        async with in_state(scope.tl.lamp, enabled=True):
+            image = await scope.camera.acquire_image()
+        async for image, timestamp, frame_number in LiveFrames(scope, scope_properties):
+            ...
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+Properties are not available as attributes: use the get_/set_ functions instead.
+"""
+
+import asyncio
+import functools
+import importlib.util
+import platform
+import zmq.asyncio
+
+import ism_buffer
+
+from .simple_rpc import async_rpc_client, async_property_client
+from .util import transfer_ism_buffer
+from .config import scope_configuration
+
+async def _get_data_getter(rpc_client, force_remote=False):
+    """Asynchronous version of transfer_ism_buffer.client_get_data_getter().
+    Returns is_local, get_data, where get_data is a coroutine function."""
+    if force_remote:
+        is_local = False
+    else:
+        is_local = await rpc_client('_transfer_ism_buffer._server_get_node') == platform.node()
+
+    if is_local: # on same machine -- use ISM buffer directly
+        async def get_data(name):
+            array = ism_buffer.open(name).asarray()
+            await rpc_client('_transfer_ism_buffer._server_release_array', name)
+            return array
+    else: # pipe data over network
+        class GetData:
+            def __init__(self):
+                self.compressor_args = {}
+                if importlib.util.find_spec('blosc') is not None:
+                    self.compressor = 'blosc'
+                    self.compressor_args['cname'] = 'lz4'
+                else:
+                    self.compressor = 'zlib'
+                    self.compressor_args['level'] = 2
+
+            def set_network_compression(self, compressor, **compressor_args):
+                self.compressor = compressor
+                self.compressor_args = compressor_args
+            set_network_compression.__doc__ = transfer_ism_buffer.client_get_data_getter.__doc__
+
+            async def __call__(self, name):
+                data = await rpc_client('_transfer_ism_buffer._server_pack_data', name, self.compressor, **self.compressor_args)
+                # decompression can take a while: keep the event loop responsive
+                unpack = functools.partial(transfer_ism_buffer._client_unpack_data, data, self.compressor)
+                return await asyncio.get_event_loop().run_in_executor(None, unpack)
+        get_data = GetData()
+    return is_local, get_data
+
+async def _make_rpc_client(rpc_addr, interrupt_addr, image_transfer_addr, context=None):
+    client = async_rpc_client.AsyncZMQClient(rpc_addr, interrupt_addr, context)
+    image_transfer_client = async_rpc_client.AsyncZMQClient(image_transfer_addr, context=context)
+    is_local, get_data = await _get_data_getter(image_transfer_client)
+
+    # define additional client wrapper functions: each receives the awaitable RPC result
+    async def get_image(result):
+        return await get_data(await result)
+    async def get_many_data(data_list):
+        return await asyncio.gather(*[get_data(name) for name in data_list])
+    async def get_sequence_data(result):
+        return await get_many_data(await result)
+    async def get_stream_data(result):
+        images_names, timestamps, attempted_frame_rate = await result
+        return await get_many_data(images_names), timestamps, attempted_frame_rate
+    async def get_autofocus_data(result):
+        return_values = await result
+        best_z, positions_and_scores = return_values[:2]
+        if len(return_values) == 3:
+            image_names = return_values[2]
+            return best_z, positions_and_scores, await get_many_data(image_names)
+        else:
+            return best_z, positions_and_scores
+    async def get_batch_data(result):
+        images, timestamps = await result
+        if isinstance(images, str): # a single server-side reduced image
+            return await get_data(images), timestamps
+        return await get_many_data(images), timestamps
+    async def get_config(result):
+        return scope_configuration.ConfigDict(await result)
+
+    client_wrappers = {
+        'get_configuration': get_config,
+        'camera.acquire_image': get_image,
+        'camera.next_image': get_image,
+        'camera.next_images': get_batch_data,
+        'camera.stream_acquire': get_stream_data,
+        'camera.acquisition_sequencer.run': get_sequence_data,
+        'camera.autofocus.autofocus': get_autofocus_data,
+        'camera.autofocus.autofocus_continuous_move': get_autofocus_data
+    }
+    scope = await client.proxy_namespace(client_wrappers)
+    if hasattr(scope, 'camera'):
+        # as in scope_client, use the image transfer connection so that the latest
+        # image can be retrieved even while the main connection is busy.
+        async def latest_image():
+            name, timestamp, frame_number = await image_transfer_client('latest_image')
+            return await get_data(name), timestamp, frame_number
+        latest_image.__doc__ = scope.camera.latest_image.__doc__
+        scope.camera.latest_image = latest_image
+
+    scope._get_data = get_data
+    scope._is_local = is_local
+    if not is_local:
+        scope.camera.set_network_compression = get_data.set_network_compression
+    scope._rpc_client = client
+    scope._image_transfer_client = image_transfer_client
+    scope._lock_attrs() # prevent unwary users from setting new attributes that won't get communicated to the server
+    return scope
+
+async def client_main(host='127.0.0.1', context=None):
+    """Return scope, scope_properties: a proxy namespace for the scope whose
+    functions are coroutine functions, and an async_property_client.AsyncZMQClient."""
+    if context is None:
+        context = zmq.asyncio.Context()
+    addresses = scope_configuration.get_addresses(host)
+    scope = await _make_rpc_client(addresses['rpc'], addresses['interrupt'], addresses['image_transfer_rpc'], context)
+    scope_properties = async_property_client.AsyncZMQClient(addresses['property'], context)
+    return scope, scope_properties
+
+class in_state:
+    """Asynchronous context manager to set a number of device parameters at once
+    using keyword arguments. The old values of those parameters will be restored
+    upon exiting the with-block:
+        async with in_state(scope.stage, x=10, y=20):
+            ...
+    """
+    def __init__(self, device, **state):
+        self.device = device
+        self.state = state
+
+    async def __aenter__(self):
+        await self.device.push_state(**self.state)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.device.pop_state()
+
+class LiveFrames:
+    """Asynchronous iterator over the images from a camera in live mode, as
+    (image, timestamp, frame_number) tuples. This is the asyncio counterpart
+    to scope_client.LiveStreamer:
+        async for image, timestamp, frame_number in LiveFrames(scope, scope_properties):
+            ...
+
+    If frames arrive faster than they are consumed, intermediate frames are
+    skipped and the latest frame is returned. Call close() (or break out of the
+    loop and call close()) to stop receiving frame notifications.
+    """
+    def __init__(self, scope, scope_properties):
+        self.scope = scope
+        self._frame_numbers = scope_properties.subscribe('scope.camera.frame_number', maxsize=1)
+
+    def close(self):
+        self._frame_numbers.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await self._frame_numbers.__anext__() # raises StopAsyncIteration once closed
+        return await self.scope.camera.latest_image()
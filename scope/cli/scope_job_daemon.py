@@ -36,6 +36,10 @@ def main(argv):
     parser_add.add_argument('-d', '--delay', metavar='DELAY', type=parse_delay, dest='next_run_time',
         help='time to delay before running the job (h, h:m, or h:m:s). Default: run immediately.',
         default='0')
+    parser_add.add_argument('-r', '--resource', choices=scope_job_runner.RESOURCES, default=scope_job_runner.RESOURCE_SCOPE,
+        help='"scope" for jobs that use the microscope (which run one at a time), or "cpu" for jobs that do not (which may run concurrently with others). Default: %(default)s')
+    parser_add.add_argument('-w', '--worker', action='store_true',
+        help='keep the job running as a worker process between runs, rather than starting it anew each time (for timecourse acquisition scripts)')
     parser_remove = subparsers.add_parser('remove',
         help='remove a job from the queue (will not terminate the current job if running)')
     parser_remove.set_defaults(func='remove_job')
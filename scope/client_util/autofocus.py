@@ -53,6 +53,34 @@ def coarse_fine_autofocus(scope, z_start, z_max, coarse_range_mm, coarse_steps,
             binning='1x1', return_images=return_images)
     return coarse_result, fine_result
 
+def predicted_autofocus(scope, z_start, predicted_z, uncertainty, z_max, coarse_range_mm, coarse_steps,
+    fine_range_mm, fine_steps, sigmas=4, min_range_mm=0.01):
+    """Autofocus around a predicted focus position (see focus_prediction).
+
+    If the prediction is confident enough that the focus should be within
+    'sigmas' standard deviations of predicted_z, and that range is no larger
+    than fine_range_mm, skip the coarse autofocus and run only a fine autofocus
+    over that range (but at least min_range_mm), with proportionally fewer
+    steps. If the best focus is then found at the edge of the range, the
+    prediction was wrong: fall back to a full coarse/fine autofocus around
+    the best position found. If predicted_z is None, a full coarse/fine
+    autofocus is run around z_start.
+
+    Returns (coarse_z, fine_z); coarse_z is None if the coarse pass was skipped.
+    """
+    if predicted_z is not None:
+        range_mm = max(2 * sigmas * uncertainty, min_range_mm)
+        if range_mm <= fine_range_mm:
+            steps = max(int(round(fine_steps * range_mm / fine_range_mm)), 5)
+            with scope.camera.in_state(readout_rate='280 MHz', shutter_mode='Rolling'):
+                fine_z = autofocus(scope, predicted_z, z_max, range_mm, steps, speed=0.3,
+                    binning='1x1', return_images=False)
+            step_size = range_mm / (steps - 1)
+            if abs(fine_z - predicted_z) < range_mm / 2 - step_size:
+                return None, fine_z
+            z_start = fine_z
+    return coarse_fine_autofocus(scope, z_start, z_max, coarse_range_mm, coarse_steps, fine_range_mm, fine_steps)
+
 def autofocus(scope, z_start, z_max, range_mm, steps, speed, return_images, **camera_params):
     """Run a single-pass autofocus.
 
@@ -22,13 +22,23 @@
 #
 # Authors: Zach Pincus
 
+import collections
+import hashlib
+import json
+import pathlib
 import time
 import numpy
 from scipy import ndimage
 from zplib.scalar_stats import mcd
 
+from ..util import frame_stats
+
 def image_order_statistic(image, k):
-    return numpy.partition(image, k, axis=None)[k]
+    """Return the k-th smallest value in an image (negative k counts from the
+    largest). To find several order statistics of the same image, use
+    frame_stats.frame_statistics() directly, which (for unsigned integer images)
+    computes the histogram only once."""
+    return frame_stats.frame_statistics(image).order_statistic(k)
 
 class DarkCurrentCorrector:
     """Class that acquires dark-current images and corrects newly-acquired images
@@ -56,16 +66,66 @@ class DarkCurrentCorrector:
                     scope.il.spectra_x.lamp_specs.keys()})
             scope.camera.start_image_sequence_acquisition(frame_count=len(self.exposures)*frames_to_average, trigger_mode='Software')
             for exp in self.exposures:
-                images = []
-                for i in range(frames_to_average):
-                    scope.camera.send_software_trigger()
-                    images.append(scope.camera.next_image(max(1000, 2*exp)))
-                self.dark_images.append(numpy.mean(images, axis=0))
+                dark_image, timestamps = scope.camera.next_images(frames_to_average, max(1000, 2*exp),
+                    reduce='mean', trigger=True)
+                self.dark_images.append(dark_image)
             scope.camera.end_image_sequence_acquisition()
             if hasattr(scope.il, 'spectra_x'):
                 scope.il.spectra_x.pop_state()
-
-    def correct(self, image, exposure_ms):
+        self._init_model()
+
+    @classmethod
+    def load(cls, path):
+        """Return a DarkCurrentCorrector from calibration data written by save()."""
+        data = numpy.load(str(path))
+        corrector = cls.__new__(cls)
+        corrector.exposures = data['exposures']
+        corrector.dark_images = list(data['dark_images'])
+        corrector._init_model()
+        return corrector
+
+    def save(self, path):
+        """Write the calibration data to the given .npz file path."""
+        with open(str(path), 'wb') as f:
+            numpy.savez(f, exposures=self.exposures, dark_images=numpy.array(self.dark_images, dtype=numpy.float32))
+
+    # number of interpolated dark images to keep: a timecourse uses only a few exposures
+    DARK_IMAGE_CACHE_SIZE = 8
+
+    def _init_model(self):
+        """Store the calibration images as float32 (the means of several frames
+        are not integers), and start with an empty cache of interpolated dark
+        images."""
+        self.dark_images = [numpy.asarray(dark_image, dtype=numpy.float32) for dark_image in self.dark_images]
+        self._dark_image_cache = collections.OrderedDict()
+
+    def dark_image(self, exposure_ms):
+        """Return the uint16 dark-current image for the given exposure time,
+        linearly interpolated between the two calibration images whose exposures
+        bracket it."""
+        if exposure_ms < self.exposures[0] or exposure_ms > self.exposures[-1]:
+            raise ValueError('Exposure time is outside of the calibration range')
+        cache = self._dark_image_cache
+        if exposure_ms in cache:
+            cache.move_to_end(exposure_ms)
+            return cache[exposure_ms]
+        # index of the calibration interval [exposures[i], exposures[i+1]] containing exposure_ms
+        i = max(numpy.searchsorted(self.exposures, exposure_ms), 1) - 1
+        before_exp, after_exp = self.exposures[i], self.exposures[i+1]
+        before_img, after_img = self.dark_images[i], self.dark_images[i+1]
+        a = numpy.float32((exposure_ms - before_exp) / (after_exp - before_exp))
+        # before + a * (after - before), with float32 temporaries only
+        dark_image = numpy.subtract(after_img, before_img)
+        dark_image *= a
+        dark_image += before_img
+        dark_image.round(out=dark_image)
+        dark_image = dark_image.astype(numpy.uint16)
+        cache[exposure_ms] = dark_image
+        if len(cache) > self.DARK_IMAGE_CACHE_SIZE:
+            cache.popitem(last=False)
+        return dark_image
+
+    def correct(self, image, exposure_ms, out=None):
         """Correct a given image for the dark-currents.
 
         Parameters:
@@ -74,24 +134,79 @@ class DarkCurrentCorrector:
                 full length of time that the camera was exposing, even if the
                 lights were on only for a portion of that duration (as with
                 the acquisition_sequencer.)
+            out: array to store the result in (may be the image itself, to
+                correct it in-place). If None, a new array is allocated.
 
-        Returns: corrected image.
+        Returns: corrected image, of the same dtype as the input, with values
+            that would be negative clamped to zero.
         """
-        if exposure_ms < self.exposures[0] or exposure_ms > self.exposures[-1]:
-            raise ValueError('Exposure time is outside of the calibration range')
-        i = numpy.searchsorted(self.exposures, exposure_ms)
-        if exposure_ms == self.exposures[i]:
-            dark_image = self.dark_images[i]
+        dark_image = self.dark_image(exposure_ms)
+        # saturating subtraction without any wider temporaries:
+        # image - min(image, dark) == max(image - dark, 0)
+        if out is image:
+            dark_image = numpy.minimum(image, dark_image)
+            numpy.subtract(image, dark_image, out=out)
         else:
-            before_exp, after_exp = self.exposures[i-1], self.exposures[i]
-            before_img, after_img = self.dark_images[i-1], self.dark_images[i]
-            a = (exposure_ms - before_exp) / (after_exp - before_exp)
-            dark_image = (1-a) * before_img + a * after_img
-            dark_image.round()
-            dark_image = dark_image.astype(numpy.uint16)
-        int_image = image.astype(numpy.int32) - dark_image
-        int_image[int_image < 0] = 0
-        return int_image.astype(numpy.uint16)
+            out = numpy.minimum(image, dark_image, out=out)
+            numpy.subtract(image, out, out=out)
+        return out
+
+class DarkCalibrationCache:
+    """On-disk cache of dark-current calibrations, so that a DarkCurrentCorrector
+    need not be re-acquired (several seconds with the shutters closed) every time
+    one is needed.
+
+    Calibrations are keyed by the camera state that affects dark currents: serial
+    number, sensor gain, readout rate, shutter mode, binning, and AOI (plus the
+    DarkCurrentCorrector parameters). A cached calibration is reused only if it
+    is no older than max_age_hours and the sensor temperature has drifted by no
+    more than max_temperature_drift degrees C since it was acquired; otherwise
+    a new calibration is acquired and replaces it.
+    """
+    CAMERA_STATE = ['serial_number', 'sensor_gain', 'readout_rate', 'shutter_mode',
+        'binning', 'aoi_left', 'aoi_top', 'aoi_width', 'aoi_height']
+
+    def __init__(self, cache_dir, max_age_hours=24, max_temperature_drift=1):
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.max_age_hours = max_age_hours
+        self.max_temperature_drift = max_temperature_drift
+
+    def _cache_key(self, scope, corrector_args):
+        state = {name: getattr(scope.camera, name) for name in self.CAMERA_STATE}
+        state['corrector_args'] = corrector_args
+        encoded = json.dumps(state, sort_keys=True).encode('utf8')
+        return state, hashlib.sha1(encoded).hexdigest()[:16]
+
+    def get_corrector(self, scope, **corrector_args):
+        """Return a DarkCurrentCorrector for the current camera state, loading a
+        valid cached calibration if one exists, or else acquiring and caching a
+        new one. Keyword arguments are passed to DarkCurrentCorrector.
+
+        Returns: corrector, is_new (True if a new calibration was acquired)"""
+        state, key = self._cache_key(scope, corrector_args)
+        record_path = self.cache_dir / (key + '.json')
+        data_path = self.cache_dir / (key + '.npz')
+        temperature = scope.camera.sensor_temperature
+        if record_path.exists():
+            with record_path.open() as f:
+                record = json.load(f)
+            age_hours = (time.time() - record['timestamp']) / 60**2
+            drift = abs(temperature - record['temperature'])
+            if age_hours <= self.max_age_hours and drift <= self.max_temperature_drift:
+                return DarkCurrentCorrector.load(data_path), False
+        corrector = DarkCurrentCorrector(scope, **corrector_args)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # write the data before the record that marks it as valid, each via a
+        # rename so that an interrupted write never leaves a corrupt cache entry
+        temp_data_path = data_path.with_suffix('.tmp')
+        corrector.save(temp_data_path)
+        temp_data_path.replace(data_path)
+        record = dict(state=state, timestamp=time.time(), temperature=temperature)
+        temp_record_path = record_path.with_suffix('.tmp')
+        with temp_record_path.open('w') as f:
+            json.dump(record, f)
+        temp_record_path.replace(record_path)
+        return corrector, True
 
 def meter_exposure_and_intensity(scope, lamp, max_exposure=200, max_intensity=255,
     min_intensity_fraction=0.3, max_intensity_fraction=0.75):
@@ -139,8 +254,9 @@ def meter_exposure_and_intensity(scope, lamp, max_exposure=200, max_intensity=25
         for intensity in intensities:
             lamp.intensity = intensity
             scope.camera.send_software_trigger()
-            image = scope.camera.next_image(1000)
-            if image_order_statistic(image, -12) < max_good_value:
+            # compute the statistics on the server rather than transferring the image
+            image_max, = scope.camera.next_image_statistics(1000, order_statistics=[-12])['order_statistics']
+            if image_max < max_good_value:
                 good_intensity = intensity
                 break
         if good_intensity is None:
@@ -199,9 +315,9 @@ def meter_exposure(scope, lamp, max_exposure=200, min_intensity_fraction=0.3,
         for exposure in exposures:
             scope.camera.exposure_time = exposure
             scope.camera.send_software_trigger()
-            image = scope.camera.next_image(max(1000, 2*exposure))
-            image_max = image_order_statistic(image, -12)
-            image_min = image_order_statistic(image, int(image.size * 0.95))
+            stats = scope.camera.next_image_statistics(max(1000, 2*exposure), order_statistics=[-12], quantiles=[0.95])
+            image_max, = stats['order_statistics']
+            image_min, = stats['quantiles']
             if image_max < max_good_value:
                 good_exposure = exposure
             else:
@@ -215,7 +331,7 @@ def meter_exposure(scope, lamp, max_exposure=200, min_intensity_fraction=0.3,
     scope.camera.exposure_time = good_exposure
     return good_exposure
 
-def get_vignette_mask(image, percent_vignetted=5):
+def get_vignette_mask(image, percent_vignetted=5, downsample=4):
     """Convert a well-exposed image (ideally a brightfield image with ~uniform
     intensity) into a mask delimiting the image region from the dark,
     vignetted borders of the image.
@@ -224,6 +340,10 @@ def get_vignette_mask(image, percent_vignetted=5):
         35% is a good estimate for images with a full circular vignette 
         (e.g. 0.7x optocoupler); 5% is reasonable for images with only small
         vignetted areas (e.g. 1x optocoupler).
+    downsample: factor by which to shrink the thresholded mask before the
+        morphological clean-up, which is much faster at low resolution. The
+        mask boundary is then accurate to within this many pixels. Use 1 to
+        process at full resolution.
 
     Returns: vignette_mask, which is True in the image regions.
     """
@@ -231,9 +351,13 @@ def get_vignette_mask(image, percent_vignetted=5):
     mean, std = mcd.robust_mean_std(bright_pixels[::10], 0.85)
     vignette_threshold = mean - 5 * std
     vignette_mask = image > vignette_threshold
+    if downsample > 1:
+        vignette_mask = _downsample(vignette_mask, downsample) >= 0.5
     vignette_mask = ndimage.binary_closing(vignette_mask)
     vignette_mask = ndimage.binary_fill_holes(vignette_mask)
-    vignette_mask = ndimage.binary_opening(vignette_mask, iterations=15)
+    vignette_mask = ndimage.binary_opening(vignette_mask, iterations=max(1, round(15 / downsample)))
+    if downsample > 1:
+        vignette_mask = _upsample_nearest(vignette_mask, image.shape, downsample)
     return vignette_mask
 
 def get_averaged_images(scope, positions, dark_corrector, frames_to_average=5):
@@ -256,13 +380,12 @@ def get_averaged_images(scope, positions, dark_corrector, frames_to_average=5):
             scope.stage.position = position
             scope.camera.start_image_sequence_acquisition(frame_count=frames_to_average,
                 trigger_mode='Internal')
-            images = [scope.camera.next_image() for i in range(frames_to_average)]
+            image, timestamps = scope.camera.next_images(frames_to_average, reduce='mean')
             scope.camera.end_image_sequence_acquisition()
-            images = [dark_corrector.correct(image, exposure_ms) for image in images]
-            position_images.append(numpy.mean(images, axis=0))
+            position_images.append(dark_corrector.correct(image, exposure_ms))
     return numpy.median(position_images, axis=0)
 
-def get_flat_field(image, vignette_mask):
+def get_flat_field(image, vignette_mask, downsample=4):
     """Return a flat-field correction image.
 
     This function smooths out an image and corrects for vignetting to produce
@@ -285,18 +408,28 @@ def get_flat_field(image, vignette_mask):
         image: input image.
         vignette_mask: image mask that is True for regions that are NOT obscured
            by vignetting (the dark areas around the edge of the image).
+        downsample: factor by which to shrink the image before smoothing. The
+           smoothing is much faster at low resolution, and the flat field is
+           smooth enough that linearly interpolating the result back to full
+           resolution loses nothing. Use 1 to process at full resolution.
 
     Returns: flat-field correction image and the mean intensity of the non-
         vignetted image regions (after smoothing), for use as a measure of
         overall illumination intensity.
     """
     flat_field = numpy.array(image, dtype=float) # make a copy of the image because we modify it in-place
-    near_vignette_mask = vignette_mask ^ ndimage.binary_erosion(vignette_mask, iterations=10)
+    if downsample > 1:
+        small_mask = _downsample(vignette_mask, downsample) >= 0.5
+        eroded = ndimage.binary_erosion(small_mask, iterations=max(1, round(10 / downsample)))
+        eroded = _upsample_nearest(eroded, vignette_mask.shape, downsample)
+    else:
+        eroded = ndimage.binary_erosion(vignette_mask, iterations=10)
+    near_vignette_mask = vignette_mask & ~eroded
     # set the vignetted region to a value that's the mean value of the pixels
     # nearest, so that when we do image smoothing those dark vignetted values
     # don't muck things up too much.
     flat_field[~vignette_mask] = flat_field[near_vignette_mask].mean()
-    flat_field = _smooth_flat_field(flat_field)
+    flat_field = _smooth_flat_field(flat_field, downsample)
     mean_intensity = flat_field[vignette_mask].mean()
     flat_field /= mean_intensity
     flat_field[flat_field <= 0] = 1 # we're going to reciprocate, so prevent div/0 errors
@@ -311,9 +444,93 @@ def _circular_mask(s):
 
 _m9 = _circular_mask(9)
 
-def _smooth_flat_field(image):
-    image = ndimage.gaussian_filter(image.astype(numpy.float32), 15, mode='nearest')
-    image = image[::2, ::2]
-    image = ndimage.median_filter(image, footprint=_m9)
-    image = ndimage.zoom(image, 2)
-    return ndimage.gaussian_filter(image, 5)
+def _smooth_flat_field(image, downsample=4):
+    if downsample == 1:
+        image = ndimage.gaussian_filter(image.astype(numpy.float32), 15, mode='nearest')
+        image = image[::2, ::2]
+        image = ndimage.median_filter(image, footprint=_m9)
+        image = ndimage.zoom(image, 2)
+        return ndimage.gaussian_filter(image, 5)
+    # same steps as above, with all lengths scaled to the downsampled image
+    # (the median footprint above is 9 pixels at half resolution)
+    small = _downsample(image, downsample)
+    small = ndimage.gaussian_filter(small, 15 / downsample, mode='nearest')
+    small = ndimage.median_filter(small, footprint=_circular_mask(max(2, round(18 / downsample))))
+    small = ndimage.gaussian_filter(small, 5 / downsample, mode='nearest')
+    return _upsample_linear(small, image.shape, downsample)
+
+def _downsample(image, factor):
+    """Return the float32 mean of image over factor x factor blocks, replicating
+    the edge pixels to fill out partial blocks."""
+    image = numpy.pad(image, [(0, -size % factor) for size in image.shape], mode='edge')
+    h, w = image.shape
+    return image.reshape((h//factor, factor, w//factor, factor)).mean(axis=(1, 3), dtype=numpy.float32)
+
+def _upsample_nearest(image, shape, factor):
+    """Inverse of _downsample() for masks: repeat each pixel into a factor x
+    factor block, and crop to the given full-resolution shape."""
+    image = image.repeat(factor, axis=0).repeat(factor, axis=1)
+    return image[:shape[0], :shape[1]]
+
+def _upsample_linear(image, shape, factor):
+    """Inverse of _downsample() for smooth images: linearly interpolate to the
+    given full-resolution shape, one axis at a time."""
+    for axis, size in enumerate(shape):
+        # the center of block i is at full-resolution coordinate i*factor + (factor-1)/2
+        coords = ((numpy.arange(size) - (factor - 1) / 2) / factor).clip(0, image.shape[axis] - 1)
+        lower = coords.astype(int)
+        upper = numpy.minimum(lower + 1, image.shape[axis] - 1)
+        weight_shape = [1, 1]
+        weight_shape[axis] = size
+        weights = (coords - lower).astype(numpy.float32).reshape(weight_shape)
+        image_lower = image.take(lower, axis=axis)
+        image = image_lower + (image.take(upper, axis=axis) - image_lower) * weights
+    return image
+
+def benchmark_flat_field(image=None, percent_vignetted=5, downsample=4):
+    """Compare the full-resolution and downsampled vignette-mask and flat-field
+    calculations. If no image is given, a synthetic 2560x2160 brightfield image
+    with uneven illumination, a circular vignette, and noise is used.
+
+    Returns a dict with the seconds taken at full resolution and downsampled,
+    the fraction of pixels where the vignette masks disagree, and the maximum
+    relative difference between the flat fields (where both masks are True,
+    away from the mask boundary)."""
+    if image is None:
+        ys, xs = numpy.indices((2560, 2160), dtype=numpy.float32)
+        r2 = ((xs - 1080) / 1400)**2 + ((ys - 1280) / 1400)**2
+        image = 20000 * (1 - 0.3*r2)
+        image[r2 > 1] = 500
+        image += numpy.random.normal(scale=200, size=image.shape)
+    results = {}
+    for name, factor in [('full', 1), ('downsampled', downsample)]:
+        t = time.perf_counter()
+        mask = get_vignette_mask(image, percent_vignetted, factor)
+        flat_field, mean_intensity = get_flat_field(image, mask, factor)
+        results[name] = time.perf_counter() - t, mask, flat_field
+    full_time, full_mask, full_flat_field = results['full']
+    down_time, down_mask, down_flat_field = results['downsampled']
+    interior = ndimage.binary_erosion(full_mask & down_mask, iterations=30)
+    difference = abs(down_flat_field[interior] - full_flat_field[interior]) / full_flat_field[interior]
+    return dict(full_seconds=full_time, downsampled_seconds=down_time,
+        mask_disagreement=float((full_mask != down_mask).mean()), max_relative_difference=float(difference.max()))
+
+def check_flat_field(image=None, percent_vignetted=5, downsample=4, max_mask_disagreement=0.01,
+        max_relative_difference=0.02):
+    """Check that the downsampled vignette mask and flat field are equivalent
+    to the full-resolution ones, within the given tolerances: the fraction of
+    pixels where the masks disagree, and the maximum relative difference of the
+    flat fields away from the mask boundary (see benchmark_flat_field()).
+    Return the benchmark results, or raise AssertionError if out of tolerance."""
+    results = benchmark_flat_field(image, percent_vignetted, downsample)
+    if results['mask_disagreement'] >= max_mask_disagreement:
+        raise AssertionError('Vignette masks disagree at {:.2%} of pixels (tolerance {:.2%})'.format(
+            results['mask_disagreement'], max_mask_disagreement))
+    if results['max_relative_difference'] >= max_relative_difference:
+        raise AssertionError('Flat fields differ by up to {:.2%} (tolerance {:.2%})'.format(
+            results['max_relative_difference'], max_relative_difference))
+    return results
+
+if __name__ == '__main__':
+    # check the downsampled flat-field calculation; exits nonzero if out of tolerance
+    print(check_flat_field())
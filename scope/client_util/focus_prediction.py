@@ -0,0 +1,115 @@
+"""Prediction of the in-focus z position of a timecourse position, so that
+autofocus can search a narrow range around the prediction.
+
+The prediction has two parts:
+    1. The focus history of the position itself, fit with a robust (Theil-Sen)
+       linear model of z versus time, which tracks slow drift (e.g. the sample
+       settling or evaporating) while ignoring the occasional bad autofocus.
+    2. The errors of that model at the positions already focused during the
+       current timepoint. These are largely shared by nearby positions (e.g.
+       thermal drift of the stage, or a tilted plate), so a plane is fit to the
+       errors as a function of (x, y) and used to correct the prediction.
+
+The uncertainty of the prediction is estimated from the scatter of the
+residuals of both fits (as a robust standard deviation). Predictions made
+before the second part can be estimated have infinite uncertainty, so that the
+first few positions of each timepoint get a full autofocus.
+"""
+
+import numpy
+
+def theil_sen(x, y):
+    """Return the slope and intercept of the Theil-Sen robust line fit to y(x):
+    the median of the slopes between all pairs of points, and the median
+    intercept given that slope."""
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    i, j = numpy.triu_indices(len(x), 1)
+    dx = x[j] - x[i]
+    valid = dx != 0
+    slope = numpy.median((y[j] - y[i])[valid] / dx[valid]) if valid.any() else 0
+    intercept = numpy.median(y - slope * x)
+    return slope, intercept
+
+def robust_std(residuals):
+    """Return the standard deviation estimated from the median absolute deviation."""
+    return 1.4826 * numpy.median(numpy.abs(residuals))
+
+class FocusPredictor:
+    def __init__(self, min_history=3, max_history=8, min_uncertainty=0.002, min_reference_positions=3):
+        """Parameters:
+            min_history: minimum number of previous focus positions required to
+                make a prediction.
+            max_history: number of most recent focus positions to fit.
+            min_uncertainty: lower bound on the reported uncertainty, in mm,
+                since with few points the residuals may be deceptively small.
+            min_reference_positions: until the actual focus has been recorded
+                at this many positions in the current timepoint, the focus
+                change shared by all positions since the last timepoint is
+                unknown, so the uncertainty of predictions is reported as
+                infinite.
+        """
+        self.min_history = min_history
+        self.max_history = max_history
+        self.min_uncertainty = min_uncertainty
+        self.min_reference_positions = min_reference_positions
+        self.errors = [] # (x, y, z error) at the positions focused this timepoint
+
+    def predict(self, position_coords, position_metadata, timestamp):
+        """Predict the in-focus z position.
+
+        Parameters:
+            position_coords: (x, y, z) stage coordinates of the position.
+            position_metadata: list of the metadata dicts from previous
+                timepoints at this position, which must contain 'timestamp'
+                and 'fine_z' values for a prediction to be made.
+            timestamp: time.time() value for which to predict the focus.
+
+        Returns: (z, uncertainty) in mm, or (None, None) if there is not
+            enough history to make a prediction.
+        """
+        history = [(entry['timestamp'], entry['fine_z']) for entry in position_metadata[-self.max_history:]
+            if entry.get('fine_z') is not None and 'timestamp' in entry]
+        if len(history) < self.min_history:
+            return None, None
+        # fit in hours relative to the prediction time, to keep the numbers well-scaled
+        times, zs = numpy.array(history).T
+        times = (times - timestamp) / 3600
+        slope, intercept = theil_sen(times, zs)
+        uncertainty = robust_std(zs - (slope * times + intercept))
+        z = intercept
+        if self.errors:
+            correction, correction_uncertainty = self._predict_error(*position_coords[:2])
+            z += correction
+            uncertainty = max(uncertainty, correction_uncertainty)
+        if len(self.errors) < self.min_reference_positions:
+            uncertainty = numpy.inf
+        return float(z), float(max(uncertainty, self.min_uncertainty))
+
+    def _predict_error(self, x, y):
+        xs, ys, errors = numpy.array(self.errors).T
+        if len(errors) < 4:
+            # too few points to fit a plane robustly: use a constant offset
+            correction = numpy.median(errors)
+            return correction, robust_std(errors - correction)
+        design = numpy.column_stack([xs, ys, numpy.ones_like(xs)])
+        coefficients = numpy.linalg.lstsq(design, errors)[0]
+        residuals = errors - design.dot(coefficients)
+        # refit without gross outliers (e.g. autofocus failures)
+        scale = robust_std(residuals)
+        inliers = numpy.abs(residuals) <= 3 * scale if scale > 0 else numpy.ones(len(errors), dtype=bool)
+        if inliers.sum() >= 3:
+            coefficients = numpy.linalg.lstsq(design[inliers], errors[inliers])[0]
+            residuals = errors - design.dot(coefficients)
+        return numpy.dot([x, y, 1], coefficients), robust_std(residuals)
+
+    def record(self, position_coords, predicted_z, actual_z):
+        """Record the actual focus position found at a position for which
+        predict() gave predicted_z (or None), to correct later predictions
+        during the same timepoint."""
+        if predicted_z is None or actual_z is None:
+            return
+        # the error relative to the drift model alone is what the plane models
+        correction = self._predict_error(*position_coords[:2])[0] if self.errors else 0
+        x, y = position_coords[:2]
+        self.errors.append((x, y, actual_z - (predicted_z - correction)))
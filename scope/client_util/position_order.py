@@ -0,0 +1,94 @@
+"""Ordering of stage positions to minimize travel time.
+
+Given a matrix of the time (or distance) to move between every pair of
+positions, tsp_order() finds a short open path that visits every position once:
+a greedy nearest-neighbor path, improved by 2-opt moves (reversing a segment of
+the path whenever that shortens it) until no improving move remains. For
+positions laid out on a regular grid, serpentine_order() gives the classic
+boustrophedon path instead: along each row, alternating direction.
+
+The movement-time matrix for a real stage can be obtained from
+scope.stage.calculate_movement_times(); chebyshev_distances() is a stand-in
+for when no stage is available (x and y move simultaneously, so the distance
+that matters is the larger of the two).
+"""
+
+import numpy
+
+def chebyshev_distances(positions):
+    """Return the matrix of max(|dx|, |dy|) between all pairs of (x,y,...) positions."""
+    xy = numpy.asarray(positions, dtype=float)[:, :2]
+    return abs(xy[:, numpy.newaxis] - xy[numpy.newaxis, :]).max(axis=2)
+
+def path_cost(order, costs):
+    """Return the total cost of visiting positions in the given order."""
+    order = numpy.asarray(order)
+    return float(numpy.asarray(costs)[order[:-1], order[1:]].sum())
+
+def nearest_neighbor_order(costs, start=0):
+    """Return a path through all positions that starts at the given index and
+    always moves to the nearest unvisited position."""
+    costs = numpy.asarray(costs, dtype=float)
+    unvisited = numpy.ones(len(costs), dtype=bool)
+    order = [start]
+    unvisited[start] = False
+    for i in range(len(costs) - 1):
+        remaining = numpy.flatnonzero(unvisited)
+        current = remaining[costs[order[-1], remaining].argmin()]
+        order.append(current)
+        unvisited[current] = False
+    return [int(i) for i in order]
+
+def two_opt(order, costs, max_passes=100):
+    """Improve a path by 2-opt moves: reversing the segment order[i:j+1] replaces
+    the edges (order[i-1], order[i]) and (order[j], order[j+1]) with
+    (order[i-1], order[j]) and (order[i], order[j+1]). The first position is
+    kept fixed. Costs are assumed to be symmetric."""
+    costs = numpy.asarray(costs, dtype=float)
+    order = numpy.array(order)
+    n = len(order)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n - 1):
+            # consider all j > i at once
+            before, first = order[i-1], order[i]
+            j = numpy.arange(i + 1, n)
+            last = order[j]
+            old = costs[before, first] + costs[last[:-1], order[j[:-1]+1]]
+            new = costs[before, last[:-1]] + costs[first, order[j[:-1]+1]]
+            # reversing up to the end of the path removes only one edge
+            old = numpy.append(old, costs[before, first])
+            new = numpy.append(new, costs[before, last[-1]])
+            gains = old - new
+            best = gains.argmax()
+            if gains[best] > 1e-9:
+                order[i:j[best]+1] = order[i:j[best]+1][::-1]
+                improved = True
+        if not improved:
+            break
+    return [int(i) for i in order]
+
+def tsp_order(costs, start=0):
+    """Return a short path through all positions (as a list of indices), given
+    a symmetric matrix of movement costs between them."""
+    if len(costs) < 3:
+        return list(range(len(costs)))
+    return two_opt(nearest_neighbor_order(costs, start), costs)
+
+def serpentine_order(positions, row_tolerance):
+    """Return a path through positions (as a list of indices) that goes
+    row-by-row in increasing y, alternating the direction of travel along x in
+    each row. Positions whose y coordinates are within row_tolerance (in mm) of
+    the previous position's, in increasing y, are in the same row."""
+    xy = numpy.asarray(positions, dtype=float)[:, :2]
+    by_y = numpy.argsort(xy[:, 1], kind='mergesort')
+    rows = [[by_y[0]]]
+    for i in by_y[1:]:
+        if xy[i, 1] - xy[rows[-1][-1], 1] > row_tolerance:
+            rows.append([])
+        rows[-1].append(i)
+    order = []
+    for row_number, row in enumerate(rows):
+        row = sorted(row, key=lambda i: xy[i, 0], reverse=row_number % 2 == 1)
+        order.extend(int(i) for i in row)
+    return order
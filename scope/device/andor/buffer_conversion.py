@@ -0,0 +1,156 @@
+"""Conversion of raw Andor image buffers into uint16 images.
+
+Andor buffers contain 'height' rows of 'stride' bytes each, followed by
+metadata. For the Mono16 and Mono12 encodings each pixel is a little-endian
+uint16, so a row is just the first width pixels of each stride: conversion is
+a single strided numpy copy. For Mono12Packed, each pair of pixels A and B is
+packed into three bytes as:
+    byte 0: bits 11-4 of A
+    byte 1: bits 3-0 of A in the low nibble; bits 3-0 of B in the high nibble
+    byte 2: bits 11-4 of B
+which unpacks with a handful of vectorized shift/mask operations. Any other
+encoding falls back to the Andor utility library's ConvertBuffer.
+
+Output arrays are as created by camera.BufferFactory: Fortran-ordered uint16
+arrays of shape (width, height).
+"""
+
+import ctypes
+import time
+import numpy
+
+from . import lowlevel
+
+UINT8_P = ctypes.POINTER(ctypes.c_uint8)
+
+def get_converter(width, height, stride, input_encoding):
+    """Return a function convert(buffer, output_array) that fills output_array
+    with the image in the raw Andor buffer (a uint8 numpy array) given the AOI
+    width, height, and stride and the Andor pixel encoding name."""
+    if input_encoding in ('Mono16', 'Mono12') and stride >= 2 * width and stride % 2 == 0:
+        return _Mono16Converter(width, height, stride)
+    elif input_encoding == 'Mono12Packed' and stride >= 3 * ((width + 1) // 2):
+        return _Mono12PackedConverter(width, height, stride)
+    else:
+        return _SDKConverter(width, height, stride, input_encoding)
+
+def _rows(buffer, height, stride, row_bytes):
+    """Return a (height, row_bytes) uint8 view of the image rows in buffer,
+    skipping the stride padding."""
+    return buffer[:height*stride].reshape((height, stride))[:, :row_bytes]
+
+class _Mono16Converter:
+    def __init__(self, width, height, stride):
+        self.width = width
+        self.height = height
+        self.stride = stride
+
+    def view(self, buffer):
+        """Return a (height, width) uint16 view onto the image in buffer."""
+        # reinterpret the (contiguous) buffer as uint16 before slicing off the
+        # stride padding: older numpy cannot change the item size of a
+        # non-contiguous view
+        rows = buffer[:self.height*self.stride].view('<u2').reshape((self.height, self.stride // 2))
+        return rows[:, :self.width]
+
+    def __call__(self, buffer, output_array):
+        # output_array.T is a C-ordered (height, width) view, so this is a
+        # single de-striding copy straight into the output memory
+        numpy.copyto(output_array.T, self.view(buffer))
+
+class _Mono12PackedConverter:
+    def __init__(self, width, height, stride):
+        self.width = width
+        self.height = height
+        self.stride = stride
+        self.pairs = (width + 1) // 2 # an odd width leaves the last 'B' pixel unused
+
+    def __call__(self, buffer, output_array):
+        packed = _rows(buffer, self.height, self.stride, 3*self.pairs).reshape((self.height, self.pairs, 3))
+        out = output_array.T
+        a = out[:, 0::2]
+        b = out[:, 1::2]
+        b_pairs = b.shape[1]
+        middle = packed[:, :, 1]
+        numpy.copyto(a, packed[:, :, 0])
+        a <<= 4
+        a |= middle & 0x0F
+        numpy.copyto(b, packed[:, :b_pairs, 2])
+        b <<= 4
+        b |= middle[:, :b_pairs] >> 4
+
+class _SDKConverter:
+    def __init__(self, width, height, stride, input_encoding):
+        self.convert_buffer_args = (width, height, stride, input_encoding, 'Mono16')
+
+    def __call__(self, buffer, output_array):
+        lowlevel.ConvertBuffer(buffer.ctypes.data_as(UINT8_P), output_array.ctypes.data_as(UINT8_P),
+            *self.convert_buffer_args)
+
+def _pack_mono12(image, stride):
+    """Pack a (height, width) uint16 image into a Mono12Packed buffer with the
+    given row stride (for testing and benchmarking)."""
+    height, width = image.shape
+    pairs = (width + 1) // 2
+    padded = numpy.zeros((height, 2*pairs), dtype=numpy.uint16)
+    padded[:, :width] = image & 0x0FFF
+    a = padded[:, 0::2]
+    b = padded[:, 1::2]
+    buffer = numpy.zeros((height, stride), dtype=numpy.uint8)
+    packed = buffer[:, :3*pairs].reshape((height, pairs, 3))
+    packed[:, :, 0] = a >> 4
+    packed[:, :, 1] = (a & 0x0F) | ((b & 0x0F) << 4)
+    packed[:, :, 2] = b >> 4
+    return buffer.reshape(-1)
+
+def _pack_mono16(image, stride):
+    """Pack a (height, width) uint16 image into a Mono16 buffer with the given
+    row stride (for testing)."""
+    height, width = image.shape
+    buffer = numpy.zeros((height, stride), dtype=numpy.uint8)
+    buffer[:, :2*width] = image.astype('<u2').view(numpy.uint8)
+    return buffer.reshape(-1)
+
+def check_converters(width=15, height=7):
+    """Check the numpy converters against known images, for row strides with
+    and without padding (and an odd width, to exercise Mono12Packed's unused
+    final pixel). Raises AssertionError on any mismatch."""
+    image = numpy.random.randint(0, 4096, size=(height, width)).astype(numpy.uint16)
+    for padding in (0, 8):
+        cases = [
+            ('Mono16', _pack_mono16(image, 2*width + padding), 2*width + padding),
+            ('Mono12Packed', _pack_mono12(image, 3*((width + 1) // 2) + padding), 3*((width + 1) // 2) + padding)
+        ]
+        for input_encoding, buffer, stride in cases:
+            convert = get_converter(width, height, stride, input_encoding)
+            assert not isinstance(convert, _SDKConverter)
+            output = numpy.zeros((width, height), dtype=numpy.uint16, order='F')
+            convert(buffer, output)
+            assert (output.T == image).all(), (input_encoding, stride)
+
+def benchmark_mono12packed(width=2560, height=2160, iterations=20, compare_sdk=True):
+    """Time the numpy Mono12Packed unpacker for a frame of the given size, and
+    (if compare_sdk is True and the Andor utility library can be loaded) the
+    SDK's ConvertBuffer on the same data. Both outputs are checked against the
+    original image. Returns a dict of mean ms per frame."""
+    stride = 3 * ((width + 1) // 2) + 8 # typical Andor row padding
+    image = numpy.random.randint(0, 4096, size=(height, width)).astype(numpy.uint16)
+    buffer = _pack_mono12(image, stride)
+    output = numpy.empty((width, height), dtype=numpy.uint16, order='F')
+    converters = {'numpy': _Mono12PackedConverter(width, height, stride)}
+    if compare_sdk:
+        try:
+            lowlevel._init_util_lib('libatutility.so')
+        except OSError:
+            pass
+        else:
+            converters['sdk'] = _SDKConverter(width, height, stride, 'Mono12Packed')
+    results = {}
+    for name, convert in converters.items():
+        output[:] = 0
+        t = time.perf_counter()
+        for i in range(iterations):
+            convert(buffer, output)
+        results[name] = 1000 * (time.perf_counter() - t) / iterations
+        assert (output.T == image).all()
+    return results
@@ -84,13 +84,21 @@ import time
 import ctypes
 import numpy
 import contextlib
+import functools
 import collections
 import atexit
 import itertools
+import math
+import queue
+import struct
 
 from . import lowlevel
+from . import buffer_conversion
+from . import buffer_pool
+from . import frame_store
 from ...util import transfer_ism_buffer
 from ...util import enumerated_properties
+from ...util import frame_stats
 from ...util import property_device
 from ...config import scope_configuration
 
@@ -161,6 +169,14 @@ class Camera(property_device.PropertyDevice):
         #('VerticallyCenterAOI', lowlevel.SetBool, False)
     ]
 
+    # number of buffers kept queued with the Andor API in live mode, and the
+    # number of acquired frames that may wait for conversion before the oldest
+    # is dropped in favor of newer frames.
+    _LIVE_BUFFER_COUNT = 4
+    _LIVE_CONVERSION_QUEUE_LENGTH = 2
+    # number of buffers that cycle through the Andor queue when streaming to disk
+    _DISK_STREAM_BUFFER_COUNT = 16
+
     _PROPERTIES_THAT_CAN_CHANGE_FRAME_RATE_RANGE = set([
         'AOITop',
         'AOIHeight',
@@ -250,6 +266,9 @@ class Camera(property_device.PropertyDevice):
         self._maybe_update_frame_rate_and_range('ExposureTime') # pretend exposure time was updated, to force the frame rate range to get updated
         self._latest_data = None
         self._latest_timestamp = None
+        self._latest_metadata = None
+        # sequence-acquisition buffers are recycled across acquisitions (e.g. repeated acquire_image() calls)
+        self._buffer_pool = buffer_pool.BufferPool()
         self._latest_image_lock = threading.Lock()
 
     def _timer_update_temp(self):
@@ -551,14 +570,14 @@ class Camera(property_device.PropertyDevice):
             # frame comes in (in _update_image_data),  but we need to guarantee
             # that get_latest_timestamp() will always return the timestamp
             # associated with the most recent latest_image() call...
-            name, array, self._latest_timestamp = self._latest_data
+            name, array, self._latest_timestamp, self._latest_metadata = self._latest_data
             transfer_ism_buffer.server_register_array_for_transfer(name, array)
             return name, self._latest_timestamp, self._frame_number
 
-    def _update_image_data(self, name, array, timestamp):
+    def _update_image_data(self, name, array, timestamp, metadata=None):
         """Update information about the latest image, and broadcast to the world
         that another image has been retrieved."""
-        self._latest_data = name, array, timestamp
+        self._latest_data = name, array, timestamp, metadata
         self._frame_number += 1
         self._update_property('frame_number', self._frame_number)
 
@@ -567,25 +586,30 @@ class Camera(property_device.PropertyDevice):
         into software triggering mode with continuous cycling and then have a
         thread that simply executes a software trigger at the maximum possible
         rate given how fast the camera can operate (as determined by the logic
-        in _calculate_live_trigger_interval()). A single buffer is created and
-        repeatedly queued and waited on by a separate thread, which exists to
-        copy the result out to the output array via convert_buffer() as fast as
-        possible. Note that tight coupling between the trigger and the reader
-        threads is not required, as the camera has some RAM in which images
-        that have been acquired can be buffered before getting read out to the
-        computer via the Andor queue / wait commands."""
+        in _calculate_live_trigger_interval()). Several buffers are kept queued
+        with the Andor API by a separate reader thread, which waits on them and
+        hands each filled buffer to a conversion thread that copies the result
+        out to an output array via convert_buffer() and then returns the buffer
+        to the reader for re-queuing. Thus reading the next frame from the
+        camera overlaps with converting the previous one. If conversion falls
+        behind, the oldest unconverted frames are dropped (see
+        get_live_dropped_frames()). Note that tight coupling between the
+        trigger and the reader threads is not required, as the camera has some
+        RAM in which images that have been acquired can be buffered before
+        getting read out to the computer via the Andor queue / wait commands."""
         if self._live_mode:
             return
         lowlevel.Flush()
         self.push_state(cycle_mode='Continuous', trigger_mode='Software', readout_rate='280 MHz')
         trigger_interval = self._calculate_live_trigger_interval()
         namebase = 'live@-'+str(time.time())
-        buffer_maker = BufferFactory(namebase, frame_count=1, cycle=True)
+        buffer_maker = BufferFactory(namebase, frame_count=self._LIVE_BUFFER_COUNT, cycle=True)
         self._live_mode = True
         lowlevel.Command('AcquisitionStart')
-        def update():
-            self._update_image_data(*buffer_maker.convert_buffer())
-        self._live_reader = LiveReader(buffer_maker.queue_buffer, update, trigger_interval)
+        def update(buffer):
+            self._update_image_data(*buffer_maker.convert_buffer(buffer))
+        self._live_reader = LiveReader(buffer_maker, self._LIVE_BUFFER_COUNT, update, trigger_interval,
+            self._LIVE_CONVERSION_QUEUE_LENGTH)
         self._live_trigger = LiveTrigger(trigger_interval, self._live_reader)
 
     def _calculate_live_trigger_interval(self):
@@ -618,6 +642,23 @@ class Camera(property_device.PropertyDevice):
             return 0
         return 1/numpy.mean(self._live_reader.latest_intervals)
 
+    def get_live_dropped_frames(self):
+        """Return the number of frames read from the camera in the current
+        round of live imaging that were dropped because conversion could not
+        keep up."""
+        if not self._live_mode:
+            return
+        return self._live_reader.converter.dropped_count
+
+    def get_live_latency(self):
+        """Return the recent mean time in ms between a live frame being read from
+        the camera and that frame being available from latest_image()."""
+        if not self._live_mode:
+            return
+        if not self._live_reader.converter.latencies:
+            return 0
+        return 1000 * numpy.mean(self._live_reader.converter.latencies)
+
     def acquire_image(self, **camera_params):
         """Acquire a single image from the camera, with its current settings.
         NB: This is a SLOW way to acquire multiple images. In that case,
@@ -678,13 +719,19 @@ class Camera(property_device.PropertyDevice):
         self.push_state(live_mode=False) # turn off live mode first so that when we push the rest of the state, we don't get state parameters that are valid only for live mode
         self.push_state(cycle_mode=cycle_mode, trigger_mode=trigger_mode, **camera_params)
         lowlevel.Flush()
-        self._buffer_maker = BufferFactory(namebase, frame_count=frame_count, cycle=False)
-        if frame_count is not None:
-            # if we have a known number of images to acquire, create and queue buffers for them now.
-            # however, don't queue up more than a gig or so of images
-            max_queue = int(1024**3 / self.get_image_byte_count())
-            for i in range(min(max_queue, frame_count)):
-                self._buffer_maker.queue_buffer()
+        self._buffer_maker = BufferFactory(namebase, frame_count=frame_count, cycle=False, pool=self._buffer_pool)
+        # Rather than queuing buffers for every frame up front, queue enough for
+        # the expected frame rate, and let the scheduler adjust the queue depth
+        # as it measures how fast frames arrive and are retrieved. Never queue
+        # up more than a gig or so of images.
+        max_queue = int(1024**3 / self.get_image_byte_count())
+        if trigger_mode == 'Internal':
+            frame_rate = self.get_frame_rate()
+        else:
+            frame_rate = None
+        self._sequence_scheduler = SequenceScheduler(self._buffer_maker, frame_count, max_queue,
+            self.get_safe_image_count_to_queue(), self.get_timestamp_hz(), frame_rate)
+        self._sequence_scheduler.refill()
         lowlevel.Command('AcquisitionStart')
 
     def next_image(self, read_timeout_ms=lowlevel.ANDOR_INFINITE):
@@ -692,23 +739,148 @@ class Camera(property_device.PropertyDevice):
         if the image has not yet been triggered or retrieved from the camera.
         If a timeout is provided, either an image will be returned within that time
         or an AndorError of TIMEDOUT will be raised."""
-        self._buffer_maker.queue_if_needed()
-        lowlevel.WaitBuffer(int(round(read_timeout_ms)))
-        self._update_image_data(*self._buffer_maker.convert_buffer())
+        wait_time = self._wait_buffer(read_timeout_ms)
+        name, array, timestamp, metadata = self._buffer_maker.convert_buffer()
+        self._update_image_data(name, array, timestamp, metadata)
+        self._sequence_scheduler.frame_retrieved(wait_time, timestamp)
         return self.latest_image()[0] # return just the ism_buffer name
 
+    def _wait_buffer(self, read_timeout_ms):
+        """Make sure buffers are queued, wait for the next one to be filled, and
+        return the time spent waiting."""
+        self._sequence_scheduler.refill()
+        t = time.perf_counter()
+        lowlevel.WaitBuffer(int(round(read_timeout_ms)))
+        return time.perf_counter() - t
+
+    _REDUCTIONS = {'mean': numpy.float32, 'median': numpy.float32, 'sum': numpy.uint32, 'max': numpy.uint16, 'min': numpy.uint16}
+
+    def next_images(self, count, read_timeout_ms=lowlevel.ANDOR_INFINITE, reduce=None, trigger=False):
+        """Retrieve the next count images from the image acquisition sequence
+        in one call, as with calling next_image() count times.
+
+        Parameters:
+            count: number of images to retrieve.
+            read_timeout_ms: timeout for each image, as for next_image().
+            reduce: if None, all the images are returned. Otherwise, one of
+                'mean', 'median', 'sum', 'max', or 'min': the images are combined
+                pixel-wise on the server and only the result is returned, which
+                is much cheaper to transfer. 'mean' and 'median' produce float32
+                images, 'sum' a uint32 image, and 'max' and 'min' uint16 images.
+            trigger: if True, send a software trigger before each image.
+
+        Returns: images, timestamps
+            images is a list of images, or the single combined image if reduce
+            is not None; timestamps is a list of the timestamps of the
+            individual frames.
+        """
+        if count < 1:
+            raise ValueError('count must be at least 1')
+        if reduce is None:
+            names = []
+            timestamps = []
+            for i in range(count):
+                if trigger:
+                    self.send_software_trigger()
+                names.append(self.next_image(read_timeout_ms))
+                timestamps.append(self._latest_timestamp)
+            return names, timestamps
+        if reduce not in self._REDUCTIONS:
+            raise ValueError('reduce must be None or one of: {}'.format(', '.join(sorted(self._REDUCTIONS))))
+        width, height = self._buffer_maker.buffer_shape
+        if reduce == 'median':
+            frames = numpy.empty((count, height, width), dtype=numpy.uint16)
+        else:
+            frame = numpy.empty((width, height), dtype=numpy.uint16, order='F')
+            accumulator = numpy.zeros((width, height), dtype=numpy.uint32 if reduce in ('mean', 'sum') else numpy.uint16, order='F')
+        timestamps = []
+        for i in range(count):
+            if trigger:
+                self.send_software_trigger()
+            wait_time = self._wait_buffer(read_timeout_ms)
+            if reduce == 'median':
+                timestamp, metadata = self._buffer_maker.convert_into(frames[i].T)
+            else:
+                timestamp, metadata = self._buffer_maker.convert_into(frame)
+                if i == 0 or reduce in ('mean', 'sum'):
+                    accumulator += frame # with i == 0, accumulator was zero, so this initializes max/min too
+                elif reduce == 'max':
+                    numpy.maximum(accumulator, frame, out=accumulator)
+                else:
+                    numpy.minimum(accumulator, frame, out=accumulator)
+            self._sequence_scheduler.frame_retrieved(wait_time, timestamp)
+            timestamps.append(timestamp)
+        name = next(self._buffer_maker.reduced_names)
+        output_array = transfer_ism_buffer.server_create_array(name, shape=(width, height),
+            dtype=self._REDUCTIONS[reduce], order='Fortran')
+        if reduce == 'median':
+            numpy.median(frames, axis=0, out=output_array.T)
+        elif reduce == 'mean':
+            numpy.divide(accumulator, count, out=output_array, casting='unsafe')
+        else:
+            output_array[:] = accumulator
+        self._update_image_data(name, output_array, timestamp, metadata)
+        return self.latest_image()[0], timestamps
+
+    def next_image_statistics(self, read_timeout_ms=lowlevel.ANDOR_INFINITE, **statistics):
+        """Retrieve the next image from the image acquisition sequence, as with
+        next_image(), but rather than returning the image, return statistics
+        computed from it on the server (see image_statistics() for the keyword
+        arguments and return value). The 'timestamp' of the image is also
+        included. The image itself remains available via latest_image().
+
+        This avoids transferring full frames when only a few numbers are
+        needed, e.g. to meter exposures."""
+        wait_time = self._wait_buffer(read_timeout_ms)
+        name, array, timestamp, metadata = self._buffer_maker.convert_buffer()
+        self._update_image_data(name, array, timestamp, metadata)
+        self._sequence_scheduler.frame_retrieved(wait_time, timestamp)
+        result = image_statistics(array, **statistics)
+        result['timestamp'] = timestamp
+        return result
+
+    def latest_image_statistics(self, **statistics):
+        """Return statistics computed on the server from the latest image that
+        the camera retrieved (e.g. in live mode), along with its 'timestamp' and
+        'frame_number'. See image_statistics() for the keyword arguments and
+        return value."""
+        with self._latest_image_lock:
+            if self._latest_data is None:
+                raise RuntimeError('No image has been acquired.')
+            name, array, timestamp, metadata = self._latest_data
+            frame_number = self._frame_number
+        result = image_statistics(array, **statistics)
+        result['timestamp'] = timestamp
+        result['frame_number'] = frame_number
+        return result
+
+    def get_sequence_queue_stats(self):
+        """Return a dict describing the buffer queue of the current image
+        sequence acquisition (see SequenceScheduler.get_stats()), or None if no
+        acquisition is running."""
+        if not hasattr(self, '_sequence_scheduler'):
+            return
+        return self._sequence_scheduler.get_stats()
+
     def get_latest_timestamp(self):
         """Return the timestamp of the most recent image acquired."""
         if self._latest_timestamp is not None:
             return int(self._latest_timestamp)
 
+    def get_latest_metadata(self):
+        """Return a dict of all the Andor metadata decoded from the most recent
+        image acquired (see parse_metadata()), including the 'timestamp'."""
+        return self._latest_metadata
+
     def end_image_sequence_acquisition(self):
         """Stop an image-acquisition sequence and perform necessary cleanup."""
         lowlevel.Command('AcquisitionStop')
         lowlevel.Flush()
+        self._buffer_maker.release_queued()
         self.pop_state() # need to pop twice because we pushed twice in start_image_sequence_acquisition() (see above)
         self.pop_state()
         del self._buffer_maker
+        del self._sequence_scheduler
 
 
     def calculate_streaming_mode(self, frame_count, desired_frame_rate, **camera_params):
@@ -794,31 +966,140 @@ class Camera(property_device.PropertyDevice):
         self.end_image_sequence_acquisition()
         return image_names, timestamps, frame_rate
 
+    def start_disk_stream(self, path, frame_count=None, trigger_mode='Internal', frames_per_file=None,
+            frame_timeout=None, **camera_params):
+        """Start acquiring images straight to disk on the server, for sequences too
+        long or too fast to hold in memory.
+
+        A small ring of buffers is kept queued with the camera; as each one is
+        filled, its frame is converted by a pool of writer threads directly into
+        memory-mapped .npy files in the directory 'path', and the buffer is
+        queued again. Thus the length of the acquisition is limited by disk space
+        and the rate by disk bandwidth, rather than by RAM.
+
+        Parameters:
+            path: directory on the server to write into (created if needed).
+            frame_count: number of images to acquire, or None to acquire until
+                end_disk_stream() is called.
+            trigger_mode: as for start_image_sequence_acquisition().
+            frames_per_file: number of frames per .npy file; if None, about 1 GB
+                worth of frames.
+            frame_timeout: seconds to wait for each frame before the acquisition
+                fails. If None, for internal triggering this is three times the
+                frame interval (as for stream_acquire()); for other trigger
+                modes, the acquisition waits indefinitely for each trigger.
+            All other keyword arguments will be used to set the camera state (e.g.
+            exposure_time, readout_rate, etc.)
+
+        Call end_disk_stream() to stop (or, if frame_count was given, to wait for
+        the acquisition to complete) and obtain a handle to the stored frames.
+        """
+        if frame_count is None:
+            cycle_mode = 'Continuous'
+        else:
+            cycle_mode = 'Fixed'
+            camera_params['frame_count'] = frame_count
+        self.push_state(live_mode=False)
+        self.push_state(cycle_mode=cycle_mode, trigger_mode=trigger_mode, **camera_params)
+        lowlevel.Flush()
+        buffer_maker = BufferFactory('disk-stream', frame_count=self._DISK_STREAM_BUFFER_COUNT, cycle=True)
+        width, height = buffer_maker.buffer_shape
+        if frames_per_file is None:
+            frames_per_file = max(1, int(1024**3 / (2 * width * height)))
+        if frame_timeout is None and trigger_mode == 'Internal':
+            read_time = 1/min(self.get_max_interface_fps(), self.get_frame_rate())
+            frame_timeout = 3 * read_time + 0.25 # plus one WaitBuffer() poll interval
+        store = frame_store.FrameStore(path, width, height, frames_per_file)
+        lowlevel.Command('AcquisitionStart')
+        self._disk_stream = DiskStreamReader(buffer_maker, self._DISK_STREAM_BUFFER_COUNT, store,
+            frame_count, frame_timeout)
+
+    def end_disk_stream(self):
+        """Stop a disk-streaming acquisition started by start_disk_stream(),
+        wait for all frames to be written, and return a dataset handle: a dict
+        with the directory 'path', the list of .npy 'files', the 'frame_count',
+        the frame 'shape', and the name of the 'timestamps' file. Use
+        frame_store.open_frame_store(handle) to read the frames.
+
+        If a frame did not arrive within the frame timeout, or the acquisition
+        otherwise failed, the frames acquired so far are still saved, but an
+        error is raised rather than the handle returned."""
+        reader = self._disk_stream
+        del self._disk_stream
+        try:
+            if reader.frame_count is not None:
+                # the reader stops by itself after the requested frames, or fails
+                # if any frame is overdue; the join timeout is only a backstop
+                if reader.frame_timeout is None:
+                    join_timeout = None
+                else:
+                    join_timeout = reader.frame_timeout * (reader.frame_count - reader.image_count + 1)
+                reader.join(join_timeout)
+                if reader.is_alive():
+                    raise lowlevel.AndorError('Disk-stream acquisition did not complete in time: {} of {} frames acquired.'.format(
+                        reader.image_count, reader.frame_count))
+        finally:
+            reader.stop()
+            lowlevel.Command('AcquisitionStop')
+            lowlevel.Flush()
+            self.pop_state() # pushed twice in start_disk_stream()
+            self.pop_state()
+        try:
+            handle = reader.store.finish()
+        finally:
+            if reader.error is not None:
+                raise reader.error
+        return handle
+
+    def stream_acquire_to_disk(self, path, frame_count, frame_rate, **camera_params):
+        """Acquire a given number of images at the specified frame rate (or as
+        fast as possible, as for stream_acquire()), writing them to disk on the
+        server as they arrive (see start_disk_stream()).
+
+        Returns: handle, attempted_frame_rate
+            handle is the dataset handle described in end_disk_stream().
+        """
+        frame_rate, overlap = self.calculate_streaming_mode(frame_count, frame_rate,
+            trigger_mode='Internal', **camera_params)
+        self.start_disk_stream(path, frame_count, frame_rate=frame_rate,
+            trigger_mode='Internal', overlap_enabled=overlap, **camera_params)
+        return self.end_disk_stream(), frame_rate
+
 
 UINT8_P = ctypes.POINTER(ctypes.c_uint8)
 
 class BufferFactory:
-    def __init__(self, namebase, frame_count=1, cycle=False):
+    def __init__(self, namebase, frame_count=1, cycle=False, pool=None):
+        """Create buffers for the Andor API and convert filled buffers into
+        named output arrays. If cycle is True, a fixed set of frame_count
+        buffers is used over and over. Otherwise, up to frame_count buffers
+        (unlimited if None) are taken from the given buffer_pool.BufferPool
+        (or a private pool), and are returned to the pool once converted."""
         width, height, stride = map(lowlevel.GetInt, ('AOIWidth', 'AOIHeight', 'AOIStride'))
         self.buffer_shape = (width, height)
         input_encoding = lowlevel.GetEnumStringByIndex('PixelEncoding', lowlevel.GetEnumIndex('PixelEncoding'))
-        self.convert_buffer_args = (width, height, stride, input_encoding, 'Mono16')
+        self.converter = buffer_conversion.get_converter(width, height, stride, input_encoding)
+        self.metadata_parser = None
         image_bytes = lowlevel.GetInt('ImageSizeBytes')
         self.queued_buffers = collections.deque()
+        self.pool = pool if pool is not None else buffer_pool.BufferPool()
         if cycle:
-            self.buffers = itertools.cycle([numpy.empty(image_bytes, dtype=numpy.uint8) for i in range(frame_count)])
+            self.buffers = itertools.cycle([buffer_pool.allocate_buffer(image_bytes) for i in range(frame_count)])
         else:
             self.buffers = self._new_buffer_iter(image_bytes, frame_count)
         if frame_count == 1 and not cycle:
             self.names = iter([namebase])
         else:
             self.names = self._name_iter(namebase)
+        # names for arrays combined from several frames (see Camera.next_images),
+        # which must not use up the per-frame names
+        self.reduced_names = self._name_iter(namebase.rstrip('-') + '-reduced-')
 
     def _new_buffer_iter(self, image_bytes, frame_count):
         i = 0
         while True:
             i += 1
-            yield numpy.empty(image_bytes, dtype=numpy.uint8)
+            yield self.pool.acquire(image_bytes)
             if frame_count is not None and i == frame_count:
                 return
 
@@ -828,8 +1109,11 @@ class BufferFactory:
             yield namebase + str(i)
             i += 1
 
-    def queue_buffer(self):
-        buffer = next(self.buffers)
+    def queue_buffer(self, buffer=None):
+        """Queue the given buffer, or the next available buffer if None, with
+        the Andor API."""
+        if buffer is None:
+            buffer = next(self.buffers)
         lowlevel.QueueBuffer(buffer.ctypes.data_as(UINT8_P), len(buffer))
         self.queued_buffers.append(buffer)
 
@@ -837,33 +1121,288 @@ class BufferFactory:
         if not self.queued_buffers:
             self.queue_buffer()
 
-    def convert_buffer(self):
+    def convert_buffer(self, buffer=None):
+        """Convert the given filled buffer, or if None, the oldest queued
+        buffer (which the caller must have waited on with WaitBuffer), into a
+        new named output array. Return the name, array, timestamp, and a dict
+        of all the decoded metadata."""
         name = next(self.names)
         output_array = transfer_ism_buffer.server_create_array(name, shape=self.buffer_shape,
             dtype=numpy.uint16, order='Fortran')
+        if buffer is None:
+            timestamp, metadata = self.convert_into(output_array)
+        else:
+            timestamp, metadata = self.parse_metadata(buffer)
+            self.converter(buffer, output_array)
+        return name, output_array, timestamp, metadata
+
+    def convert_into(self, output_array):
+        """Convert the oldest queued buffer (which the caller must have waited
+        on with WaitBuffer) into the given Fortran-ordered (width, height) uint16
+        array, and return the buffer to the pool. Return the timestamp and a
+        dict of all the decoded metadata."""
         buffer = self.queued_buffers.popleft()
-        timestamp = parse_buffer_metadata(buffer, 1) # timestamp is metadata CID 1
+        timestamp, metadata = self.parse_metadata(buffer)
+        self.converter(buffer, output_array)
+        self.pool.release(buffer)
+        return timestamp, metadata
+
+    def release_queued(self):
+        """Return any still-queued buffers to the pool. Only call this after the
+        Andor queue has been flushed."""
+        while self.queued_buffers:
+            self.pool.release(self.queued_buffers.popleft())
+
+    def parse_metadata(self, buffer):
+        """Return the timestamp and a dict of all decoded metadata from a filled buffer."""
+        # all buffers from a given factory have the same metadata layout, so
+        # the chunk offsets are only worked out once
+        if self.metadata_parser is None or not self.metadata_parser.matches(buffer):
+            self.metadata_parser = MetadataParser(buffer)
+        metadata = self.metadata_parser.parse(buffer)
+        return metadata.get('timestamp'), metadata
+
+class SequenceScheduler:
+    """Size the queue of buffers handed to the Andor API during an image
+    sequence acquisition, so that the camera never has to wait for a host
+    buffer, without allocating buffers for every frame up front.
+
+    Frames that the camera has acquired but that have no host buffer to be
+    read into wait in the camera's on-board RAM, which holds only
+    Camera.get_safe_image_count_to_queue() frames. The scheduler estimates that
+    backlog from how far the latest frame's timestamp lags the camera's
+    timestamp clock, measures the frame interval from the timestamps and the
+    interval between next_image() calls, and from these keeps enough buffers
+    queued to cover the frames that will arrive before the next refill. A
+    warning is logged if the on-camera backlog nears overflow."""
+    MIN_DEPTH = 2
+    SAFETY_FACTOR = 1.5
+    CLOCK_CHECK_INTERVAL = 8 # read the camera clock every this many frames
+    BACKLOG_WARNING_FRACTION = 0.75
+
+    def __init__(self, buffer_maker, frame_count, max_depth, camera_capacity, timestamp_hz, frame_rate=None):
+        """Parameters:
+            buffer_maker: BufferFactory for the acquisition.
+            frame_count: total frames to acquire, or None if unbounded.
+            max_depth: maximum number of buffers to queue (limits host memory use).
+            camera_capacity: number of frames the camera RAM can safely hold.
+            timestamp_hz: camera timestamp clock frequency.
+            frame_rate: expected frame rate, if known (e.g. for internal triggering).
+        """
+        self.buffer_maker = buffer_maker
+        self.frames_remaining = frame_count
+        self.max_depth = max_depth
+        self.camera_capacity = camera_capacity
+        self.timestamp_hz = timestamp_hz
+        self.frame_interval = None if not frame_rate else 1 / frame_rate
+        self.retrieve_intervals = collections.deque(maxlen=10)
+        self.wait_times = collections.deque(maxlen=10)
+        self.camera_backlog = 0
+        self.target_depth = self.MIN_DEPTH
+        self._last_timestamp = None
+        self._last_retrieved = None
+        self._frames_retrieved = 0
+        self._warned = False
+        # before any measurements, queue about a quarter-second's worth of frames
+        if self.frame_interval is not None:
+            self.target_depth = self._clamp(self.MIN_DEPTH + math.ceil(0.25 / self.frame_interval))
+
+    def _clamp(self, depth):
+        depth = min(max(depth, self.MIN_DEPTH), self.max_depth)
+        if self.frames_remaining is not None:
+            depth = min(depth, self.frames_remaining)
+        return depth
+
+    def refill(self):
+        """Top up the queued buffers to the current target depth."""
+        # (_clamp() also keeps this to no more than the number of frames remaining)
+        queued = self.buffer_maker.queued_buffers
+        target = self._clamp(self.target_depth)
+        while len(queued) < target:
+            self.buffer_maker.queue_buffer()
+        if not queued:
+            self.buffer_maker.queue_buffer() # at least one, so that WaitBuffer can be called
+
+    def frame_retrieved(self, wait_time, timestamp):
+        """Record that a frame was retrieved after waiting wait_time seconds in
+        WaitBuffer, and update the target queue depth."""
+        now = time.perf_counter()
+        self._frames_retrieved += 1
+        if self.frames_remaining is not None:
+            self.frames_remaining -= 1
+        self.wait_times.append(wait_time)
+        if self._last_retrieved is not None:
+            self.retrieve_intervals.append(now - self._last_retrieved)
+        self._last_retrieved = now
         if timestamp is not None:
-            timestamp = timestamp.view('<u8')[0] # timestamp is 8 bytes of little-endian unsigned int
-        lowlevel.ConvertBuffer(buffer.ctypes.data_as(UINT8_P), output_array.ctypes.data_as(UINT8_P),
-            *self.convert_buffer_args)
-        return name, output_array, timestamp
+            if self._last_timestamp is not None and timestamp > self._last_timestamp:
+                interval = (timestamp - self._last_timestamp) / self.timestamp_hz
+                # exponentially-weighted, to follow changes without being jumpy
+                if self.frame_interval is None:
+                    self.frame_interval = interval
+                else:
+                    self.frame_interval = 0.8 * self.frame_interval + 0.2 * interval
+            self._last_timestamp = timestamp
+            if self._frames_retrieved % self.CLOCK_CHECK_INTERVAL == 1:
+                self._update_camera_backlog(timestamp)
+        self._update_target_depth()
+
+    def _update_camera_backlog(self, timestamp):
+        if not self.frame_interval:
+            return
+        try:
+            clock = lowlevel.GetInt('TimestampClock')
+        except lowlevel.AndorError:
+            return
+        lag = max(0, clock - timestamp) / self.timestamp_hz
+        # frames acquired since the one just retrieved are still on the camera
+        self.camera_backlog = lag / self.frame_interval
+        if self.camera_backlog > self.BACKLOG_WARNING_FRACTION * self.camera_capacity:
+            if not self._warned:
+                logger.warning('Camera RAM nearly full: about {:.0f} of {} frames waiting to be retrieved.',
+                    self.camera_backlog, self.camera_capacity)
+                self._warned = True
+        else:
+            self._warned = False
 
-def parse_buffer_metadata(buffer, desired_id):
+    def _update_target_depth(self):
+        if not self.frame_interval or not self.retrieve_intervals:
+            return
+        # enough buffers for the frames that arrive between retrievals, plus
+        # whatever is backed up on the camera, with some margin.
+        frames_per_retrieval = max(self.retrieve_intervals) / self.frame_interval
+        depth = self.MIN_DEPTH + math.ceil(self.SAFETY_FACTOR * frames_per_retrieval + self.camera_backlog)
+        self.target_depth = self._clamp(depth)
+
+    def get_stats(self):
+        """Return a dict with the current number of 'queued' buffers, the
+        'target_depth', the 'mean_wait_ms' spent in WaitBuffer, the measured
+        'frame_interval_ms', and the estimated on-camera 'camera_backlog'."""
+        return dict(
+            queued=len(self.buffer_maker.queued_buffers),
+            target_depth=self.target_depth,
+            mean_wait_ms=1000 * float(numpy.mean(self.wait_times)) if self.wait_times else None,
+            frame_interval_ms=1000 * self.frame_interval if self.frame_interval else None,
+            camera_backlog=self.camera_backlog
+        )
+
+# Andor metadata chunk IDs
+METADATA_CID_FRAME_DATA = 0
+METADATA_CID_TICKS = 1
+METADATA_CID_FRAME_INFO = 7
+
+# For each known metadata chunk ID, the fields of that chunk as (name, numpy format, offset within chunk).
+_METADATA_FIELDS = {
+    METADATA_CID_TICKS: [('timestamp', '<u8', 0)],
+    METADATA_CID_FRAME_INFO: [('aoi_stride', '<u2', 0), ('pixel_encoding', 'u1', 2), ('aoi_width', '<u2', 4), ('aoi_height', '<u2', 6)]
+}
+
+def find_metadata_chunks(buffer):
+    """Return a list of (chunk_id, start, end) for the metadata chunks in
+    the buffer, from the end of the buffer backwards, where buffer[start:end]
+    is the chunk data."""
+    # chunk layout: [chunk][CID][length], where CID and length are 4-byte little-endian uints,
+    # and where length is the size in bytes of chunk+CID.
+    chunks = []
     offset = len(buffer)
-    while offset > 0:
-        # chunk layout: [chunk][CID][length], where CID and length are 4-byte little-endian uints,
-        # and where length is the size in bytes of chunk+CID.
-        length_start = offset - 4
-        cid_start = length_start - 4
-        length = buffer[length_start:offset].view('<u4')[0]
-        chunk_id = buffer[cid_start:length_start].view('<u4')[0]
-        chunk_start = length_start - length # length includes CID and data
-        if chunk_id == desired_id:
-            return buffer[chunk_start:cid_start]
+    while offset >= 8:
+        cid_start = offset - 8
+        chunk_id, length = struct.unpack_from('<II', buffer, cid_start)
+        chunk_start = offset - 4 - length # length includes CID and data
+        if length < 4 or chunk_start < 0:
+            break # not valid metadata: don't go wandering off through image data
+        chunks.append((chunk_id, chunk_start, cid_start))
         offset = chunk_start
+    return chunks
+
+def parse_buffer_metadata(buffer, desired_id):
+    """Return the data of the metadata chunk with the given ID as a uint8
+    array, or None if there is no such chunk."""
+    for chunk_id, start, end in find_metadata_chunks(buffer):
+        if chunk_id == desired_id:
+            return buffer[start:end]
     return None
 
+class MetadataParser:
+    """Decode all the metadata chunks at the end of Andor buffers that share a
+    layout. The chunk offsets are found once, from the buffer passed to the
+    constructor, and compiled into a numpy structured dtype, so that parsing a
+    subsequent buffer is a single view onto its metadata region.
+
+    Chunks with a known layout (see _METADATA_FIELDS) are decoded into their
+    named fields; other chunks of up to 8 bytes are decoded as little-endian
+    unsigned ints named 'cid_N'."""
+    def __init__(self, buffer):
+        self.size = len(buffer)
+        self.chunks = find_metadata_chunks(buffer)
+        metadata_chunks = [chunk for chunk in self.chunks if chunk[0] != METADATA_CID_FRAME_DATA]
+        self.start = min((start for chunk_id, start, end in metadata_chunks), default=self.size)
+        names, formats, offsets = [], [], []
+        for chunk_id, start, end in metadata_chunks:
+            if chunk_id in _METADATA_FIELDS:
+                fields = _METADATA_FIELDS[chunk_id]
+            elif end - start in (1, 2, 4, 8):
+                fields = [('cid_{}'.format(chunk_id), '<u{}'.format(end - start), 0)]
+            else:
+                continue
+            for name, format, offset in fields:
+                if start + offset + numpy.dtype(format).itemsize <= end:
+                    names.append(name)
+                    formats.append(format)
+                    offsets.append(start + offset - self.start)
+        self.dtype = numpy.dtype(dict(names=names, formats=formats, offsets=offsets, itemsize=self.size - self.start))
+        self._trailer = bytes(buffer[-8:])
+
+    def matches(self, buffer):
+        """Return whether the buffer appears to have the same layout as the one
+        this parser was constructed from."""
+        return len(buffer) == self.size and bytes(buffer[-8:]) == self._trailer
+
+    def parse(self, buffer):
+        """Return a dict mapping metadata field names to values."""
+        if not self.dtype.names:
+            return {} # e.g. metadata is disabled
+        record = buffer[self.start:].view(self.dtype)[0]
+        return dict(zip(self.dtype.names, record.item()))
+
+def image_statistics(image, order_statistics=(), quantiles=(), histogram_bins=None, rois=(), saturation_level=None):
+    """Compute summary statistics of an image.
+
+    Parameters:
+        image: image array: usually uint16, but any numeric type (e.g. the
+            float32 mean of several frames) is accepted.
+        order_statistics: list of ranks k; the k-th smallest pixel value is
+            returned for each. Negative ranks count from the largest value, so
+            -1 is the maximum and -12 ignores the 11 brightest pixels.
+        quantiles: list of fractions q in [0, 1); the pixel value of rank
+            int(q * image.size) is returned for each.
+        histogram_bins: if not None, the number of equal-width bins spanning
+            [0, 65536) to count pixel values into. Must be a power of two.
+        rois: list of [x0, y0, x1, y1] regions of interest; the mean pixel
+            value of image[x0:x1, y0:y1] is returned for each.
+        saturation_level: if not None, the number of pixels at or above this
+            value is returned.
+
+    Returns a dict with 'min', 'max', and 'mean' of the whole image, plus
+    'order_statistics', 'quantiles', 'histogram', 'roi_means', and
+    'saturated_count' for whichever of the above were requested.
+    """
+    # for camera frames, a single histogram pass answers all of the rank-based
+    # statistics at once
+    histogram = frame_stats.frame_statistics(image)
+    result = dict(min=histogram.min, max=histogram.max, mean=histogram.mean)
+    if order_statistics:
+        result['order_statistics'] = histogram.order_statistic(order_statistics).tolist()
+    if quantiles:
+        result['quantiles'] = histogram.quantile(quantiles).tolist()
+    if histogram_bins is not None:
+        result['histogram'] = histogram.binned(histogram_bins).tolist()
+    if rois:
+        result['roi_means'] = [float(image[x0:x1, y0:y1].mean()) for x0, y0, x1, y1 in rois]
+    if saturation_level is not None:
+        result['saturated_count'] = histogram.saturated_count(saturation_level)
+    return result
+
 class LiveModeThread(threading.Thread):
     """Superclass for the threads that are used to run live camera acquisition,
     providing a basic API whereby the threads can be stopped manually, or if
@@ -926,30 +1465,54 @@ class LiveTrigger(LiveModeThread):
 
 
 class LiveReader(LiveModeThread):
-    def __init__(self, queue_buffer, update, trigger_interval):
-        """Repeatedly queue a buffer with the given queue_buffer() function,
-        wait for it to be filled via the Andor API, then call
-        update() which (presumably) will deal with the buffer
-        contents. The argument image_count is the index of the frame retrieved
+    def __init__(self, buffer_maker, buffer_count, update, trigger_interval, max_pending=2):
+        """Keep buffer_count buffers from buffer_maker queued with the Andor API,
+        and wait for them to be filled. Each filled buffer is handed off to a
+        LiveConverter thread, which calls update(buffer) to deal with the buffer
+        contents and then returns the buffer to be queued again. At most
+        max_pending filled buffers wait for conversion; beyond that, the oldest
+        is dropped. The attribute image_count is the number of frames retrieved
         since the start of this round of live imaging.
-        NB: update() is called in this background thread, so any operations
+        NB: update() is called in a background thread, so any operations
         therein must be thread-safe."""
-        self.queue_buffer = queue_buffer
-        self.update = update
+        self.buffer_maker = buffer_maker
+        # buffers that are ready to be (re-)queued with the Andor API
+        self.free_buffers = queue.Queue()
+        for i in range(buffer_count):
+            self.free_buffers.put(next(buffer_maker.buffers))
+        self.converter = LiveConverter(update, self.free_buffers.put, max_pending)
         self.latest_intervals = collections.deque(maxlen=10) # cyclic buffer containing intervals between recent image reads (for FPS calculations)
         self.image_count = 0 # number of frames retrieved
         self.ready = threading.Event()
         self.set_timeout(trigger_interval)
         self.timeout_count = 0
+        self._last_read = None
         super().__init__()
-        self.ready.wait() # don't return from init until a buffer is queued
+        self.ready.wait() # don't return from init until the buffers are queued
 
     def set_timeout(self, trigger_interval):
         self.timeout = 250 + int(1000 * trigger_interval) * 3 # convert to ms and triple plus add 250 ms for safety margin
 
+    def stop(self):
+        super().stop()
+        self.converter.stop()
+
+    def _queue_free_buffers(self):
+        # if no buffers are queued (i.e. they are all being converted), block
+        # briefly for one to come back, so that stop() requests are still noticed.
+        block = not self.buffer_maker.queued_buffers
+        while True:
+            try:
+                buffer = self.free_buffers.get(block, timeout=0.1)
+            except queue.Empty:
+                return
+            self.buffer_maker.queue_buffer(buffer)
+            block = False
+
     def loop(self):
-        t = time.time()
-        self.queue_buffer()
+        self._queue_free_buffers()
+        if not self.buffer_maker.queued_buffers:
+            return
         self.ready.set()
         try:
             # with no timeout, we would have to make sure to stop the reader thread before
@@ -967,11 +1530,116 @@ class LiveReader(LiveModeThread):
             if e.args[0].startswith('TIMEDOUT'):
                 self.timeout_count += 1
                 if self.timeout_count > 10:
-                    raise AndorError('Live image retrieval timing out.')
+                    raise lowlevel.AndorError('Live image retrieval timing out.')
                 return
             else:
                 raise
-        self.update()
+        t = time.time()
+        # the Andor API fills buffers in the order they were queued
+        self.converter.put(self.buffer_maker.queued_buffers.popleft(), t)
+        self.image_count += 1
+        if self._last_read is not None:
+            self.latest_intervals.append(t - self._last_read)
+        self._last_read = t
+
+class DiskStreamReader(LiveModeThread):
+    def __init__(self, buffer_maker, buffer_count, store, frame_count=None, frame_timeout=None):
+        """Keep buffer_count buffers from buffer_maker queued with the Andor API,
+        and pass each filled buffer to the FrameStore 'store', which converts it
+        in a writer thread and then hands it back for re-queuing. If frame_count
+        is not None, stop after that many frames. If frame_timeout is not None,
+        fail if no frame arrives for that many seconds. If the thread fails, the
+        exception is stored in the attribute 'error'."""
+        self.buffer_maker = buffer_maker
+        self.store = store
+        self.frame_count = frame_count
+        self.frame_timeout = frame_timeout
+        self.free_buffers = queue.Queue()
+        for i in range(buffer_count):
+            self.free_buffers.put(next(buffer_maker.buffers))
+        self.image_count = 0
+        self.error = None
+        self._last_frame = time.time()
+        super().__init__()
+
+    def loop(self):
+        try:
+            self._read_frame()
+        except Exception as e:
+            self.error = e
+            raise
+
+    def _read_frame(self):
+        if self.frame_count is not None and self.image_count == self.frame_count:
+            self.running = False
+            return
+        # re-queue buffers the writers are done with; if none are queued, wait briefly for one
+        block = not self.buffer_maker.queued_buffers
+        while True:
+            try:
+                buffer = self.free_buffers.get(block, timeout=0.1)
+            except queue.Empty:
+                break
+            self.buffer_maker.queue_buffer(buffer)
+            block = False
+        if not self.buffer_maker.queued_buffers:
+            return
+        try:
+            # use a timeout so that stop() requests are noticed even without triggers
+            lowlevel.WaitBuffer(250)
+        except lowlevel.AndorError as e:
+            if e.args[0].startswith('TIMEDOUT'):
+                if self.frame_timeout is not None and time.time() - self._last_frame > self.frame_timeout:
+                    raise lowlevel.AndorError('Disk-stream image retrieval timed out after {} frames.'.format(self.image_count))
+                return
+            raise
+        self._last_frame = time.time()
+        buffer = self.buffer_maker.queued_buffers.popleft()
+        timestamp, metadata = self.buffer_maker.parse_metadata(buffer)
+        self.store.write(functools.partial(self.buffer_maker.converter, buffer), timestamp,
+            functools.partial(self.free_buffers.put, buffer))
         self.image_count += 1
-        self.latest_intervals.append(time.time() - t)
 
+class LiveConverter(LiveModeThread):
+    def __init__(self, update, recycle, max_pending):
+        """Call update(buffer) for each filled buffer passed to put(), and then
+        recycle(buffer) to hand the buffer back for re-use. If max_pending
+        buffers are already waiting when another arrives, the oldest is dropped
+        (recycled without being converted): in live mode, the newest frame is
+        what matters."""
+        self.update = update
+        self.recycle = recycle
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+        self.pending_ready = threading.Condition()
+        self.dropped_count = 0
+        self.latencies = collections.deque(maxlen=10) # recent times from put() to conversion finishing
+        super().__init__()
+
+    def put(self, buffer, read_time):
+        with self.pending_ready:
+            if len(self.pending) >= self.max_pending:
+                dropped, dropped_time = self.pending.popleft()
+                self.dropped_count += 1
+                self.recycle(dropped)
+            self.pending.append((buffer, read_time))
+            self.pending_ready.notify()
+
+    def stop(self):
+        with self.pending_ready:
+            self.running = False
+            self.pending_ready.notify()
+        self.join()
+
+    def loop(self):
+        with self.pending_ready:
+            while self.running and not self.pending:
+                self.pending_ready.wait()
+            if not self.pending:
+                return
+            buffer, read_time = self.pending.popleft()
+        try:
+            self.update(buffer)
+        finally:
+            self.recycle(buffer)
+        self.latencies.append(time.time() - read_time)
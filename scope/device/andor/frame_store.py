@@ -0,0 +1,125 @@
+"""Disk-backed storage for streaming camera acquisitions.
+
+Frames are written into a directory of memory-mapped .npy files ("chunks"),
+each holding up to frames_per_chunk frames. Every chunk is a C-ordered uint16
+array of shape (frame_count, height, width), so chunk[i].T is a Fortran-ordered
+(width, height) frame just like the arrays returned by the camera. Frames are
+converted straight into the memory map by a pool of writer threads, and each
+chunk is flushed to disk once all of its frames have been written, so memory use
+does not grow with the length of the acquisition.
+
+When the acquisition is finished, FrameStore.finish() returns a "dataset
+handle": a JSON-serializable dict describing the files, which can be passed to
+open_frame_store() to read the frames back.
+"""
+
+import concurrent.futures as futures
+import json
+import pathlib
+import threading
+import numpy
+
+HANDLE_FILE = 'frames.json'
+TIMESTAMPS_FILE = 'timestamps.npy'
+
+class FrameStore:
+    def __init__(self, path, width, height, frames_per_chunk, num_threads=2):
+        """Parameters:
+            path: directory to write into (created if needed).
+            width, height: frame dimensions.
+            frames_per_chunk: number of frames per .npy file.
+            num_threads: number of writer threads.
+        """
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.width = width
+        self.height = height
+        self.frames_per_chunk = frames_per_chunk
+        # the writes for a chunk are always submitted before the task that waits
+        # for them, so the pool can't deadlock as long as there are two threads.
+        self.threadpool = futures.ThreadPoolExecutor(max(num_threads, 2))
+        self.files = []
+        self.timestamps = []
+        self.frame_count = 0
+        self._chunk = None
+        self._chunk_writes = []
+        self._chunk_flushes = []
+        self._errors = []
+        self._lock = threading.Lock()
+
+    def _new_chunk(self):
+        if self._chunk is not None:
+            self._chunk_flushes.append(self.threadpool.submit(self._flush_chunk, self._chunk, self._chunk_writes))
+        name = 'frames_{:05d}.npy'.format(len(self.files))
+        self._chunk = numpy.lib.format.open_memmap(str(self.path / name), mode='w+',
+            dtype=numpy.uint16, shape=(self.frames_per_chunk, self.height, self.width))
+        self._chunk_writes = []
+        self.files.append(name)
+
+    @staticmethod
+    def _flush_chunk(chunk, writes):
+        futures.wait(writes)
+        chunk.flush()
+
+    def write(self, write_frame, timestamp, done=None):
+        """Store the next frame. write_frame(output_array) will be called in a
+        writer thread to fill a Fortran-ordered (width, height) output array.
+        Then done(), if provided, is called (e.g. to recycle the source buffer).
+
+        Must always be called from the same thread."""
+        if self._errors:
+            raise self._errors[0]
+        index = self.frame_count % self.frames_per_chunk
+        if index == 0:
+            self._new_chunk()
+        self.frame_count += 1
+        self.timestamps.append(timestamp)
+        write = self.threadpool.submit(self._write, write_frame, self._chunk[index].T, done)
+        self._chunk_writes.append(write)
+
+    def _write(self, write_frame, output_array, done):
+        try:
+            write_frame(output_array)
+        except Exception as e:
+            with self._lock:
+                self._errors.append(e)
+            raise
+        finally:
+            if done is not None:
+                done()
+
+    def finish(self):
+        """Wait for all frames to be written to disk and return the dataset
+        handle. (The final chunk file keeps its full size, but the space for
+        frames that were never written is not allocated on disk.)"""
+        if self._chunk is not None:
+            self._flush_chunk(self._chunk, self._chunk_writes)
+        futures.wait(self._chunk_flushes)
+        self.threadpool.shutdown()
+        self._chunk = None
+        timestamps = numpy.array([-1 if t is None else t for t in self.timestamps], dtype=numpy.int64)
+        numpy.save(str(self.path / TIMESTAMPS_FILE), timestamps)
+        handle = dict(path=str(self.path), files=self.files, frame_count=self.frame_count,
+            shape=[self.width, self.height], timestamps=TIMESTAMPS_FILE)
+        with (self.path / HANDLE_FILE).open('w') as f:
+            json.dump(handle, f)
+        if self._errors:
+            raise self._errors[0]
+        return handle
+
+def open_frame_store(handle):
+    """Given a dataset handle returned by FrameStore.finish() (or the path to
+    the directory containing it), return (frames, timestamps), where frames is
+    a list of memory-mapped read-only arrays of shape (n, width, height), one
+    per chunk file, and timestamps is an array of frame timestamps (-1 where the
+    camera provided none)."""
+    if not isinstance(handle, dict):
+        with (pathlib.Path(handle) / HANDLE_FILE).open() as f:
+            handle = json.load(f)
+    path = pathlib.Path(handle['path'])
+    frames = [numpy.load(str(path / name), mmap_mode='r').transpose(0, 2, 1) for name in handle['files']]
+    if frames:
+        last_count = handle['frame_count'] - len(frames[0]) * (len(frames) - 1)
+        frames[-1] = frames[-1][:last_count]
+    timestamps = numpy.load(str(path / handle['timestamps']))
+    return frames, timestamps
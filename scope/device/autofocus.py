@@ -36,11 +36,21 @@ from ..config import scope_configuration
 logger = logging.get_logger(__name__)
 
 FFTW_WISDOM = scope_configuration.CONFIG_DIR / 'fftw_wisdom'
-if FFTW_WISDOM.exists():
-    fast_fft.load_plan_hints(str(FFTW_WISDOM))
-    logger.debug('FFTW wisdom loaded')
-else:
-    logger.warning('No FFTW wisdom found!')
+_fftw_wisdom_loaded = False
+
+def _load_fftw_wisdom():
+    """Load the cached FFTW plans, the first time an FFT filter is needed (rather
+    than at import, which would slow down starting the server even if filtered
+    autofocus metrics are never used)."""
+    global _fftw_wisdom_loaded
+    if _fftw_wisdom_loaded:
+        return
+    _fftw_wisdom_loaded = True
+    if FFTW_WISDOM.exists():
+        fast_fft.load_plan_hints(str(FFTW_WISDOM))
+        logger.debug('FFTW wisdom loaded')
+    else:
+        logger.warning('No FFTW wisdom found!')
 
 class AutofocusMetric:
     def __init__(self, shape):
@@ -72,6 +82,7 @@ class Brenner(AutofocusMetric):
 class FilteredBrenner(Brenner):
     def __init__(self, shape):
         super().__init__(shape)
+        _load_fftw_wisdom()
         timer = threading.Timer(1, logger.warning, ['Slow construction of FFTW filter for image shape {} (likely no cached plan could be found). May take >30 minutes!', shape])
         timer.start()
         self.filter = fast_fft.SpatialFilter(shape, self.PERIOD_RANGE, precision=32, threads=6, better_plan=True)
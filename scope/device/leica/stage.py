@@ -92,6 +92,15 @@ Z_SPEED_MM_PER_SECOND_PER_UNIT = 0.1488
 Z_RAMP_MM_PER_SECOND_PER_SECOND_PER_UNIT = 1449
 Z_MOVE_FUDGE_FACTOR = 0.056
 
+# Response deadline for a move is MOVE_TIMEOUT_FACTOR times the predicted movement
+# time plus MOVE_TIMEOUT_MARGIN seconds. The axis range is used when the distance is unknown.
+MOVE_TIMEOUT_FACTOR = 2
+MOVE_TIMEOUT_MARGIN = 5
+Z_RANGE_MM = 26
+XY_RANGE_MM = 150 # upper bound on the x and y travel
+# Axis initialization drives each axis to its end switches, which can take a while
+INIT_TIMEOUT = 120
+
 class Stage(stand.LeicaComponent):
     def _setup_device(self):
         self._x_mm_per_count = float(self.send_message(GET_CONVERSION_FACTOR_X, async=False).response) / 1000
@@ -107,6 +116,13 @@ class Stage(stand.LeicaComponent):
         self._z_speed_max = int(self.send_message(GET_MAX_SPEED_Z, async=False).response) * self._z_mm_per_count * Z_SPEED_MM_PER_SECOND_PER_UNIT
         self._z_ramp_min = int(self.send_message(GET_MIN_RAMP_Z, async=False).response) * self._z_mm_per_count * Z_RAMP_MM_PER_SECOND_PER_SECOND_PER_UNIT
         self._z_ramp_max = int(self.send_message(GET_MAX_RAMP_Z, async=False).response) * self._z_mm_per_count * Z_RAMP_MM_PER_SECOND_PER_SECOND_PER_UNIT
+        # cached speeds, z ramp, and most recent positions (or targets), used only
+        # to estimate how long moves should take
+        self._x_speed = self.get_x_speed()
+        self._y_speed = self.get_y_speed()
+        self._z_speed = self.get_z_speed()
+        self._z_ramp = self.get_z_ramp()
+        self._last_x = self._last_y = self._last_z = None
         self.send_message(
             SET_X_EVENT_SUBSCRIPTIONS,
             1, # X-axis started or stopped
@@ -192,28 +208,44 @@ class Stage(stand.LeicaComponent):
             self.set_z(z)
             # no need to do self.wait() at end of block: it gets called implicitly!
 
-    def _set_pos(self, value, conversion_factor, command, async):
+    def _set_pos(self, value, conversion_factor, command, async, timeout=None):
         if value is None: return
         counts = int(round(value / conversion_factor))
-        self.send_message(command, counts, async=async, intent="move stage to position")
+        self.send_message(command, counts, async=async, intent="move stage to position", timeout=timeout)
 
     def set_x(self, x, async=None):
         """Set x-axis position in mm.  If a value other than None is supplied for the async parameter,
         this value is used in place of the stage's current async state for issuing the stage x-axis
         move command."""
-        self._set_pos(x, self._x_mm_per_count, POS_ABS_X, async)
+        if x is None: return
+        distance = XY_RANGE_MM if self._last_x is None else abs(x - self._last_x)
+        timeout = self._move_timeout(_xy_movement_time(distance, 0, self._x_speed, self._y_speed))
+        self._set_pos(x, self._x_mm_per_count, POS_ABS_X, async, timeout=timeout)
+        self._last_x = x
 
     def set_y(self, y, async=None):
         """Set y-axis position in mm.  If a value other than None is supplied for the async parameter,
         this value is used in place of the stage's current async state for issuing the stage y-axis
         move command."""
-        self._set_pos(y, self._y_mm_per_count, POS_ABS_Y, async)
+        if y is None: return
+        distance = XY_RANGE_MM if self._last_y is None else abs(y - self._last_y)
+        timeout = self._move_timeout(_xy_movement_time(0, distance, self._x_speed, self._y_speed))
+        self._set_pos(y, self._y_mm_per_count, POS_ABS_Y, async, timeout=timeout)
+        self._last_y = y
 
     def set_z(self, z, async=None):
         """Set z-axis position in mm.  If a value other than None is supplied for the async parameter,
         this value is used in place of the stage's current async state for issuing the stage z-axis
         move command."""
-        self._set_pos(z, self._z_mm_per_count, POS_ABS_Z, async)
+        if z is None: return
+        distance = Z_RANGE_MM if self._last_z is None else abs(z - self._last_z)
+        timeout = self._move_timeout(_z_movement_time(distance, self._z_speed, self._z_ramp))
+        self._set_pos(z, self._z_mm_per_count, POS_ABS_Z, async, timeout=timeout)
+        self._last_z = z
+
+    def _move_timeout(self, movement_time):
+        """Return a response deadline for a move, based on the expected movement time."""
+        return max(MOVE_TIMEOUT_FACTOR * movement_time + MOVE_TIMEOUT_MARGIN, self.default_timeout)
 
     def get_position(self):
         """Return (x,y,z) positionz in mm."""
@@ -226,29 +258,38 @@ class Stage(stand.LeicaComponent):
 
     def get_x(self):
         """Get x-axis position in mm."""
-        return self._get_pos(self._x_mm_per_count, GET_POS_X)
+        x = self._get_pos(self._x_mm_per_count, GET_POS_X)
+        self._last_x = x
+        return x
 
     def get_y(self):
         """Get y-axis position in mm."""
-        return self._get_pos(self._y_mm_per_count, GET_POS_Y)
+        y = self._get_pos(self._y_mm_per_count, GET_POS_Y)
+        self._last_y = y
+        return y
 
     def get_z(self):
         """Get z-axis position in mm."""
-        return self._get_pos(self._z_mm_per_count, GET_POS_Z)
+        z = self._get_pos(self._z_mm_per_count, GET_POS_Z)
+        self._last_z = z
+        return z
 
     def _on_pos_x_event(self, event):
         counts = int(event.response)
         mm = counts * self._x_mm_per_count
+        self._last_x = mm
         self._update_property('x', mm)
 
     def _on_pos_y_event(self, event):
         counts = int(event.response)
         mm = counts * self._y_mm_per_count
+        self._last_y = mm
         self._update_property('y', mm)
 
     def _on_pos_z_event(self, event):
         counts = int(event.response)
         mm = counts * self._z_mm_per_count
+        self._last_z = mm
         self._update_property('z', mm)
 
     def _on_status_x_event(self, event):
@@ -379,6 +420,7 @@ class Stage(stand.LeicaComponent):
         assert self._x_speed_min <= speed <= self._x_speed_max
         counts = int(round(speed / self._x_mm_per_count_second))
         self.send_message(SET_SPEED_X, counts, intent="set x auto move speed")
+        self._x_speed = counts * self._x_mm_per_count_second
 
     def set_y_speed(self, speed):
         """Set the speed at which, when commanded to move to a specified position, the stage
@@ -386,6 +428,7 @@ class Stage(stand.LeicaComponent):
         assert self._y_speed_min <= speed <= self._y_speed_max
         counts = int(round(speed / self._x_mm_per_count_second))
         self.send_message(SET_SPEED_Y, counts, intent="set y auto move speed")
+        self._y_speed = counts * self._y_mm_per_count_second
 
     def set_z_speed(self, speed):
         """Set the speed at which, when commanded to move to a specified position, the stage
@@ -393,6 +436,7 @@ class Stage(stand.LeicaComponent):
         assert self._z_speed_min <= speed <= self._z_speed_max
         counts = int(round(speed / self._z_mm_per_count / Z_SPEED_MM_PER_SECOND_PER_UNIT))
         self.send_message(SET_SPEED_Z, counts, intent="set z auto move speed")
+        self._z_speed = counts * self._z_mm_per_count * Z_SPEED_MM_PER_SECOND_PER_UNIT
 
     def get_x_speed(self):
         """Get the speed at which, when commanded to move to a specified position, the stage
@@ -485,15 +529,15 @@ class Stage(stand.LeicaComponent):
 
     def reinit_x(self):
         """Reinitialize x axis to correct for drift or "stuck" stage. Executes synchronously."""
-        self.send_message(INIT_X, async=False, intent="init stage x axis")
+        self.send_message(INIT_X, async=False, intent="init stage x axis", timeout=INIT_TIMEOUT)
 
     def reinit_y(self):
         """Reinitialize y axis to correct for drift or "stuck" stage. Executes synchronously."""
-        self.send_message(INIT_Y, async=False, intent="init stage y axis")
+        self.send_message(INIT_Y, async=False, intent="init stage y axis", timeout=INIT_TIMEOUT)
 
     def reinit_z(self):
         """Reinitialize z axis to correct for drift or "stuck" stage. Executes synchronously."""
-        self.send_message(INIT_RANGE_Z, async=False, intent="init stage z axis")
+        self.send_message(INIT_RANGE_Z, async=False, intent="init stage z axis", timeout=INIT_TIMEOUT)
 
     def set_xy_fine_manual_control(self, fine):
         self.send_message(SET_XY_STEP_MODE, int(not fine), async=False)
@@ -527,48 +571,12 @@ class Stage(stand.LeicaComponent):
         assert self._z_ramp_min <= ramp <= self._z_ramp_max
         counts = int(round(ramp / self._z_mm_per_count / Z_RAMP_MM_PER_SECOND_PER_SECOND_PER_UNIT))
         self.send_message(SET_RAMP_Z, counts, intent="set z ramp")
+        self._z_ramp = counts * self._z_mm_per_count * Z_RAMP_MM_PER_SECOND_PER_SECOND_PER_UNIT
 
     def calculate_z_movement_time(self, distance):
         """Calculate how long it will take the stage to move a given z distance (in mm)
         with the current speed and ramp settings. Distance must be positive."""
-        final_speed = self.get_z_speed()
-        speed_ramp = self.get_z_ramp()
-        # Calculate time for a movement with a simple linear acceleration ramp to a
-        # final velocity, and a ramp back down so that speed=0 at the given distance.
-        # Also include a "fudge factor" which is a constant amount of time for ANY move.
-        #
-        # Case 1: there's enough time for the stage to reach it's final speed:
-        # ramp_time = final_speed / speed_ramp   # time for acceleration
-        # ramp_distance = 0.5 * speed_ramp * ramp_time**2   # distance traveled
-        # ramp_distance = 0.5 * final_speed**2 / speed_ramp   # simplified from above
-        # total_ramp_distance = final_speed**2 / speed_ramp   # distance for speed-up and speed-down ramps
-        # total_ramp_time = 2 * ramp_time   # time for speed-up and speed-down ramps
-        # non_ramp_distance = distance - total_ramp_distance   # remaining distance to cover after ramps accounted for
-        # NB: the rest only works if non_ramp_distance >= 0, obviously
-        # non_ramp_time = non_ramp_distance / final_speed   # time to cover distance at final_speed
-        # non_ramp_time = (distance - final_speed**2 / speed_ramp) / final_speed   # combined above formulae
-        # non_ramp_time = distance / final_speed - final_speed / speed_ramp   # simplified
-        # time = total_ramp_time + non_ramp_time   # total time is time accelerating + time cruising
-        # time = 2 * final_speed / speed_ramp + distance / final_speed - final_speed / speed_ramp   # combining above
-        # time = final_speed / speed_ramp + distance / final_speed   # simplified
-        # NB: criterion above for case 1 can be restated as:
-        # distance >= total_ramp_distance
-        # distance >= final_speed**2 / speed_ramp   # simplified
-        #
-        # Case 2: the stage never reaches the final speed, so it just ramps up half the time
-        # and down the other half.
-        # ramp_distance = 0.5 * distance   # half the distance is acceleration
-        # 0.5 * distance = 0.5 * speed_ramp * ramp_time**2   # ramp_distance is just acceleration formula
-        # ramp_time = sqrt(distance / speed_ramp)   # solve for ramp_time
-        # time = 2 * ramp_time   # got to acclerate and decelerate
-        # time = 2 * sqrt(distance / speed_ramp)
-        # Note that at the critical distance of final_speed**2 / speed_ramp
-        # the two time formulae give equivalent values, as expected.
-
-        if distance >= final_speed**2 / speed_ramp:
-            return final_speed / speed_ramp + distance / final_speed + Z_MOVE_FUDGE_FACTOR
-        else:
-            return 2*(distance / speed_ramp)**2 + Z_MOVE_FUDGE_FACTOR
+        return _z_movement_time(distance, self.get_z_speed(), self.get_z_ramp())
 
     def calculate_required_z_speed(self, distance, time):
         """Calculate how the speed needed for the stage to move the desired z distance
@@ -607,6 +615,29 @@ class Stage(stand.LeicaComponent):
             return max_speed
 
 
+    def calculate_xy_movement_time(self, x_distance, y_distance):
+        """Calculate approximately how long it will take the stage to move given x
+        and y distances (in mm) with the current speed settings. The x and y axes
+        move simultaneously. (Acceleration is not modeled.)"""
+        return _xy_movement_time(x_distance, y_distance, self.get_x_speed(), self.get_y_speed())
+
+    def calculate_movement_times(self, positions):
+        """Given a list of (x,y,z) positions in mm, return a matrix (as a list of
+        lists) of the estimated time in seconds to move from each position to
+        each other position, with the current speed and ramp settings. All axes
+        move simultaneously, so the time is that of the slowest axis."""
+        x_speed, y_speed = self.get_x_speed(), self.get_y_speed()
+        z_speed, z_ramp = self.get_z_speed(), self.get_z_ramp()
+        times = []
+        for x0, y0, z0 in positions:
+            row = []
+            for x1, y1, z1 in positions:
+                xy_time = _xy_movement_time(abs(x1-x0), abs(y1-y0), x_speed, y_speed)
+                z_time = _z_movement_time(abs(z1-z0), z_speed, z_ramp) if z1 != z0 else 0
+                row.append(max(xy_time, z_time))
+            times.append(row)
+        return times
+
     def calculate_z_movement_position(self, distance, t):
         """Calculate where the stage will be (relative to the starting position)
         for a z-move of a given distance (in mm) after t seconds have elapsed.
@@ -678,6 +709,51 @@ class Stage(stand.LeicaComponent):
         _calibrate_speed_coefficients(times, distances, speeds, ramps)
         return times, distances, speeds, ramps
 
+def _z_movement_time(distance, final_speed, speed_ramp):
+    """Calculate how long it will take the stage to move a given z distance (in mm)
+    with the given speed (mm/s) and ramp (mm/s^2). Distance must be positive."""
+    # Calculate time for a movement with a simple linear acceleration ramp to a
+    # final velocity, and a ramp back down so that speed=0 at the given distance.
+    # Also include a "fudge factor" which is a constant amount of time for ANY move.
+    #
+    # Case 1: there's enough time for the stage to reach it's final speed:
+    # ramp_time = final_speed / speed_ramp   # time for acceleration
+    # ramp_distance = 0.5 * speed_ramp * ramp_time**2   # distance traveled
+    # ramp_distance = 0.5 * final_speed**2 / speed_ramp   # simplified from above
+    # total_ramp_distance = final_speed**2 / speed_ramp   # distance for speed-up and speed-down ramps
+    # total_ramp_time = 2 * ramp_time   # time for speed-up and speed-down ramps
+    # non_ramp_distance = distance - total_ramp_distance   # remaining distance to cover after ramps accounted for
+    # NB: the rest only works if non_ramp_distance >= 0, obviously
+    # non_ramp_time = non_ramp_distance / final_speed   # time to cover distance at final_speed
+    # non_ramp_time = (distance - final_speed**2 / speed_ramp) / final_speed   # combined above formulae
+    # non_ramp_time = distance / final_speed - final_speed / speed_ramp   # simplified
+    # time = total_ramp_time + non_ramp_time   # total time is time accelerating + time cruising
+    # time = 2 * final_speed / speed_ramp + distance / final_speed - final_speed / speed_ramp   # combining above
+    # time = final_speed / speed_ramp + distance / final_speed   # simplified
+    # NB: criterion above for case 1 can be restated as:
+    # distance >= total_ramp_distance
+    # distance >= final_speed**2 / speed_ramp   # simplified
+    #
+    # Case 2: the stage never reaches the final speed, so it just ramps up half the time
+    # and down the other half.
+    # ramp_distance = 0.5 * distance   # half the distance is acceleration
+    # 0.5 * distance = 0.5 * speed_ramp * ramp_time**2   # ramp_distance is just acceleration formula
+    # ramp_time = sqrt(distance / speed_ramp)   # solve for ramp_time
+    # time = 2 * ramp_time   # got to acclerate and decelerate
+    # time = 2 * sqrt(distance / speed_ramp)
+    # Note that at the critical distance of final_speed**2 / speed_ramp
+    # the two time formulae give equivalent values, as expected.
+
+    if distance >= final_speed**2 / speed_ramp:
+        return final_speed / speed_ramp + distance / final_speed + Z_MOVE_FUDGE_FACTOR
+    else:
+        return 2*(distance / speed_ramp)**0.5 + Z_MOVE_FUDGE_FACTOR
+
+def _xy_movement_time(x_distance, y_distance, x_speed, y_speed):
+    """Calculate how long it will take the stage to move given x and y distances
+    (in mm) with the given speeds (mm/s), ignoring acceleration."""
+    return max(abs(x_distance) / x_speed, abs(y_distance) / y_speed)
+
 def _calibrate_z_speed_coefficients(times, distances, speeds, ramps):
     import numpy
 
@@ -74,8 +74,11 @@ class Stand(LeicaComponent):
         # If we're talking to a DMi8 that has not received a command since being attached, its first reply contains a leading null byte.  So, we provoke
         # this reply by issuing an empty command (a carriage return), knowing that we will receive one of two replies: a '99999' or a '\099999'.  Receiving
         # one removes the expectation of receiving the other.
-        self._message_manager.pending_standalone_responses['9999'].append(lambda response: self._message_manager.pending_standalone_responses.pop('\0999'))
-        self._message_manager.pending_standalone_responses['\0999'].append(lambda response: self._message_manager.pending_standalone_responses.pop('9999'))
+        def on_empty_command_reply(response):
+            for response_key in ('9999', '\0999'):
+                self._message_manager.unregister_callback(response_key, on_empty_command_reply)
+        for response_key in ('9999', '\0999'):
+            self._message_manager.register_callback(response_key, on_empty_command_reply, coalesce=False, timeout=10)
         self._message_manager._send_message('\r')
         self.send_message(SET_STAND_EVENT_SUBSCRIPTIONS, 1, 0, 0, 0, 0, 0, 0, 0, async=False, intent="subscribe to stand method change events")
         self.register_event_callback(GET_ACT_METHOD, self._on_method_event)
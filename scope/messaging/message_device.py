@@ -24,10 +24,22 @@
 
 import threading
 import collections
+import time
 
 from ..util import logging
 logger = logging.get_logger(__name__)
 
+class ResponseTimeoutError(TimeoutError):
+    """Raised when a Response is not provided before its deadline."""
+    pass
+
+def _time_remaining(deadline):
+    """Return the number of seconds until a time.monotonic() deadline (or
+    zero if it has passed), or None if the deadline is None."""
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
 class Response:
     """A container for a value to be provided by a background thread at some
     point in the future.
@@ -45,33 +57,77 @@ class Response:
     res = receive() # receive the response.
     res(value)
 
+    If constructed with a timeout, the response has a deadline that many
+    seconds in the future, after which wait() raises ResponseTimeoutError. The
+    background thread may also call expire() to indicate that no value will
+    ever be provided.
     """
-    def __init__(self):
+    def __init__(self, timeout=None):
         self.ready = threading.Event()
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.expired = False
 
     def __call__(self, response):
         self.response = response
         self.ready.set()
 
-    def wait(self):
-        self.ready.wait()
+    def expire(self):
+        """Indicate that the response will never be provided: wait() will
+        raise ResponseTimeoutError immediately."""
+        self.expired = True
+        self.ready.set()
+
+    def wait(self, timeout=None):
+        """Wait for the response and return it. If the response does not arrive
+        within 'timeout' seconds (or before the response's own deadline, if
+        that is sooner), raise ResponseTimeoutError."""
+        remaining = _time_remaining(self.deadline)
+        if timeout is not None and (remaining is None or timeout < remaining):
+            remaining = timeout
+        if not self.ready.wait(remaining) or self.expired:
+            raise ResponseTimeoutError(self._timeout_text())
         return self.response
 
+    def _timeout_text(self):
+        return 'No response received before timeout'
+
 class AsyncDevice:
     """A class that uses a message_manager.MessageManager to deal with sending
     and receiving messages to and from some outside hardware device, potentially
-    in async mode."""
+    in async mode.
+
+    Responses that are not received within a timeout (by default the
+    default_timeout class attribute, in seconds; None means wait forever)
+    raise ResponseTimeoutError rather than blocking forever. If waiting times
+    out or is interrupted, the outstanding responses are cancelled."""
+    default_timeout = None
 
     def __init__(self, message_manager):
-        self._pending_responses = set()
+        self._pending_responses = {} # maps Response objects to their response keys
         self._async = False
         self._message_manager = message_manager
 
-    def wait(self):
-        """Wait on all pending responses."""
+    def wait(self, timeout=None):
+        """Wait on all pending responses. If 'timeout' is not None, raise
+        ResponseTimeoutError if all of the responses have not been received
+        within that many seconds. Each response's own deadline also applies."""
+        deadline = None if timeout is None else time.monotonic() + timeout
         while self._pending_responses:
-            response = self._pending_responses.pop()
-            response.wait()
+            response, response_key = self._pending_responses.popitem()
+            try:
+                response.wait(_time_remaining(deadline))
+            except (ResponseTimeoutError, KeyboardInterrupt):
+                self._pending_responses[response] = response_key
+                self.cancel()
+                raise
+
+    def cancel(self):
+        """Stop waiting for all pending responses. They will be removed from
+        the message manager, and any replies that arrive later will be treated
+        as unexpected."""
+        while self._pending_responses:
+            response, response_key = self._pending_responses.popitem()
+            self._message_manager.unregister_callback(response_key, response)
 
     def has_pending(self):
         """Return true if there are any responses to async messages still pending."""
@@ -92,7 +148,7 @@ class AsyncDevice:
     def get_async(self):
         return self._async
 
-    def send_message(self, message, async=None, response=None, coalesce=True):
+    def send_message(self, message, async=None, response=None, coalesce=True, timeout=None):
         """Send the given message through the MessageManager.
 
         If the parameter 'async' is not None, it will override the async mode
@@ -108,17 +164,27 @@ class AsyncDevice:
         cancel the previous ones). If 'coalesce' is True, then messages with
         the same expected response will all be handled with the first response
         (good if subsequent messages cancel the previous ones and only one
-        response is generated)."""
+        response is generated).
+
+        'timeout' is the number of seconds after which the response should be
+        considered lost; if None, default_timeout is used. A provided
+        'response' object should have been constructed with the same timeout."""
         response_key = self._generate_response_key(message)
+        if timeout is None:
+            timeout = self.default_timeout
         if response is None:
-            response = Response()
-        self._message_manager.send_message(message, response_key, response, coalesce=coalesce)
+            response = Response(timeout)
+        self._message_manager.send_message(message, response_key, response, coalesce=coalesce, timeout=timeout)
         if async == 'fire_and_forget':
             return
         if async or (async is None and self._async):
-            self._pending_responses.add(response)
+            self._pending_responses[response] = response_key
         else:
-            return response.wait()
+            try:
+                return response.wait()
+            except (ResponseTimeoutError, KeyboardInterrupt):
+                self._message_manager.unregister_callback(response_key, response)
+                raise
 
     def _generate_response_key(self, message):
         """Subclasses must implement a method to generate the appropriate
@@ -135,16 +201,12 @@ LeicaResponseTuple = collections.namedtuple('LeicaResponse', ['full_response', '
 
 def parse_leica_response(full_response):
     """Parse a line from the Leica's serial output."""
-    header, *response = full_response.split(' ', 1)
-    if len(response) == 0:
+    header, space, response = full_response.partition(' ')
+    if not space:
         response = None
-    else:
-        response = response[0]
-    if header.startswith('$'):
-        auto_event = True
+    auto_event = header.startswith('$')
+    if auto_event:
         header = header[1:]
-    else:
-        auto_event = False
     error_code = header[2]
     return LeicaResponseTuple(full_response, auto_event, header, error_code, response)
 
@@ -164,20 +226,22 @@ class LeicaResponse(Response):
 
     If an error code was generated, raise a LeicaError on wait(). If constructed
     with an 'intent' help text, this will help create a better LeicaError.
+
+    The LeicaMessageManager parses each response once, so this callback
+    receives an already-parsed LeicaResponseTuple.
     """
-    def __init__(self, message, intent=None):
-        super().__init__()
+    def __init__(self, message, intent=None, timeout=None):
+        super().__init__(timeout)
         self.message = message
         self.intent = intent
 
-    def __call__(self, full_response):
-        response = parse_leica_response(full_response)
+    def __call__(self, response):
         if response.error_code != '0':
             logger.warning('Microscope error. (message to scope: "{}", error response: "{}")', self.message, response.full_response)
         super().__call__(response)
 
-    def wait(self):
-        response = super().wait()
+    def wait(self, timeout=None):
+        response = super().wait(timeout)
         if response.error_code != '0':
             if self.intent is not None:
                 error_text = 'Could not {} (message to scope: "{}", error response: "{}")'.format(self.intent, self.message, response.full_response)
@@ -186,22 +250,30 @@ class LeicaResponse(Response):
             raise LeicaError(error_text, response=response)
         return response
 
+    def _timeout_text(self):
+        if self.intent is not None:
+            return 'Timed out trying to {} (message to scope: "{}")'.format(self.intent, self.message)
+        else:
+            return 'Timed out waiting for microscope response (message to scope: "{}")'.format(self.message)
+
 
 class LeicaAsyncDevice(AsyncDevice):
     """Base class for Leica function units. Responses keys are the function unit and
     command IDs from the outgoing message; the error state (message[2]) is ignored
     for the purposes of matching responses to commands."""
+    # Most Leica commands complete within a few seconds. Commands that may take
+    # longer (e.g. long stage moves or axis initialization) pass explicit timeouts.
+    default_timeout = 30
 
     def __init__(self, message_manager):
         super().__init__(message_manager)
-        self._adapter_callbacks = {}
         self._setup_device()
 
     def _setup_device(self):
         """Override in subclasses to perform device-specific setup."""
         pass
 
-    def send_message(self, command, *params, async=None, intent=None, coalesce=True):
+    def send_message(self, command, *params, async=None, intent=None, coalesce=True, timeout=None):
         """Send a message to the Leica microscope
 
         Parameters:
@@ -210,13 +282,17 @@ class LeicaAsyncDevice(AsyncDevice):
             async: if not None, override the async instance variable.
             intent: should be helpful text describing the intent of the command.
             coalesce: see AsyncDevice.send_message documentation.
+            timeout: seconds to wait for a response; if None, use default_timeout.
 
         If a nonzero error code is returned, a LeicaError will be raised with
-        the intent text when the response's wait() method is called.
+        the intent text when the response's wait() method is called. If no
+        response arrives in time, a ResponseTimeoutError will be raised.
         """
         message = ' '.join([str(command)] + [str(param) for param in params]) + '\r'
-        response = LeicaResponse(message[:-1], intent) # don't include \r from message...
-        return super().send_message(message, async, response=response, coalesce=coalesce)
+        if timeout is None:
+            timeout = self.default_timeout
+        response = LeicaResponse(message[:-1], intent, timeout) # don't include \r from message...
+        return super().send_message(message, async, response=response, coalesce=coalesce, timeout=timeout)
 
     def _generate_response_key(self, message):
         # return the message's function unit ID and command ID
@@ -226,17 +302,13 @@ class LeicaAsyncDevice(AsyncDevice):
         """If specific event information is enabled (via a separate message), then
         events with the given ID will cause a LeicaResponseTuple to be passed
         to the callback."""
-        def adapter_callback(full_response):
-            callback(parse_leica_response(full_response))
-        self._adapter_callbacks[callback] = adapter_callback
         response_key = '$' + str(event_id)
-        self._message_manager.register_persistent_callback(response_key, adapter_callback)
+        self._message_manager.register_persistent_callback(response_key, callback)
 
     def unregister_event_callback(self, event_id, callback):
         """Stop calling the given callback when events with the given ID occur."""
-        adapter_callback = self._adapter_callbacks[callback]
         response_key = '$' + str(event_id)
-        self._message_manager.unregister_persistent_callback(response_key, adapter_callback)
+        self._message_manager.unregister_persistent_callback(response_key, callback)
 
 class AsyncDeviceNamespace:
     """Simple container class for building a hierarchy of AsyncDevice-like
@@ -258,7 +330,7 @@ class AsyncDeviceNamespace:
 
     @staticmethod
     def _is_async_capable(obj):
-        for async_func in ('wait', 'set_async', 'get_async'):
+        for async_func in ('wait', 'cancel', 'set_async', 'get_async'):
             if not hasattr(obj, async_func):
                 return False
         return True
@@ -273,9 +345,23 @@ class AsyncDeviceNamespace:
             self._children.remove(name)
         super().__delattr__(name)
 
-    def wait(self):
+    def wait(self, timeout=None):
+        """Wait for all child devices. If 'timeout' is not None, it is a single
+        deadline shared by all of the children, not a per-child timeout. If
+        the deadline passes or the wait is interrupted, all pending responses
+        of all children are cancelled."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            for child in self._children:
+                getattr(self, child).wait(_time_remaining(deadline))
+        except (ResponseTimeoutError, KeyboardInterrupt):
+            self.cancel()
+            raise
+
+    def cancel(self):
+        """Cancel all pending responses of all child devices."""
         for child in self._children:
-            getattr(self, child).wait()
+            getattr(self, child).cancel()
 
     def set_async(self, async):
         for child in self._children:
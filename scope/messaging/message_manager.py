@@ -24,19 +24,175 @@
 
 import threading
 import collections
+import heapq
+import itertools
+import time
 
 from ..util import logging
 logger = logging.get_logger(__name__)
 
 from ..util import smart_serial
+from . import message_device
+
+class _PendingCallback:
+    __slots__ = ('response_key', 'callback', 'deadline', 'done')
+    def __init__(self, response_key, callback, deadline):
+        self.response_key = response_key
+        self.callback = callback
+        self.deadline = deadline
+        self.done = False
+
+class PendingResponses:
+    """Thread-safe registry of callbacks waiting for responses, indexed by
+    response key.
+
+    Callbacks may be added and removed from foreground threads while the
+    MessageManager thread retires them as responses arrive. Each operation
+    holds an internal lock only long enough to update the tables; callbacks
+    themselves are always run by the caller, outside of the lock.
+
+    There are three kinds of callbacks:
+    grouped: all grouped callbacks for a key are retired by the next response
+        with that key.
+    standalone: standalone callbacks for a key are queued in FIFO order, and
+        each response with that key retires only the oldest one.
+    persistent: called for every response with that key until unregistered.
+
+    Grouped and standalone callbacks may have a timeout, after which expire()
+    will remove them and return them to the caller.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._grouped = {}
+        self._standalone = {}
+        # persistent callback lists are replaced, never modified in place, so
+        # that a list can be safely iterated outside of the lock.
+        self._persistent = {}
+        self._deadlines = [] # heap of (deadline, sequence_number, _PendingCallback)
+        self._live_deadlines = 0 # number of entries in the heap that are not yet done
+        self._sequence = itertools.count()
+
+    def add(self, response_key, callback, coalesce=True, timeout=None):
+        """Add a callback to be called once for the next response matching
+        response_key. See MessageManager.send_message for the meaning of
+        'coalesce'. If timeout is not None, the callback will be expired if
+        no response has retired it after that many seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pending = _PendingCallback(response_key, callback, deadline)
+        with self._lock:
+            if coalesce:
+                self._grouped.setdefault(response_key, []).append(pending)
+            else:
+                self._standalone.setdefault(response_key, collections.deque()).append(pending)
+            if deadline is not None:
+                if len(self._deadlines) > 2 * self._live_deadlines + 64:
+                    # most callbacks are retired long before their deadlines:
+                    # drop the retired entries rather than letting them pile up.
+                    self._deadlines = [entry for entry in self._deadlines if not entry[2].done]
+                    heapq.heapify(self._deadlines)
+                heapq.heappush(self._deadlines, (deadline, next(self._sequence), pending))
+                self._live_deadlines += 1
+
+    def remove(self, response_key, callback):
+        """Remove a pending grouped or standalone callback without calling it.
+        Return True if the callback was pending, or False if it had already
+        been retired (or was never added)."""
+        with self._lock:
+            for table in (self._grouped, self._standalone):
+                pendings = table.get(response_key)
+                if not pendings:
+                    continue
+                for pending in pendings:
+                    if pending.callback is callback:
+                        self._discard(table, pending)
+                        return True
+            return False
+
+    def _mark_done(self, pending):
+        # must be called with the lock held
+        pending.done = True
+        if pending.deadline is not None:
+            self._live_deadlines -= 1
+
+    def _discard(self, table, pending):
+        # must be called with the lock held
+        self._mark_done(pending)
+        pendings = table[pending.response_key]
+        pendings.remove(pending)
+        if not pendings:
+            del table[pending.response_key]
+
+    def add_persistent(self, response_key, callback):
+        """Add a callback to be called for every response matching response_key."""
+        with self._lock:
+            self._persistent[response_key] = self._persistent.get(response_key, []) + [callback]
+
+    def remove_persistent(self, response_key, callback):
+        """Remove a persistent callback."""
+        with self._lock:
+            callbacks = list(self._persistent[response_key])
+            callbacks.remove(callback)
+            if callbacks:
+                self._persistent[response_key] = callbacks
+            else:
+                del self._persistent[response_key]
+
+    def retire(self, response_key):
+        """Return the list of callbacks that should be called for a response
+        with the given key: all grouped callbacks, the oldest standalone
+        callback, and all persistent callbacks. The grouped and standalone
+        callbacks returned are removed from the registry. The returned list
+        must not be modified."""
+        with self._lock:
+            persistent = self._persistent.get(response_key, [])
+            retired = self._grouped.pop(response_key, None)
+            standalone = self._standalone.get(response_key)
+            if retired is None:
+                if not standalone:
+                    # common case for event notifications: nothing to retire
+                    return persistent
+                retired = []
+            if standalone:
+                retired.append(standalone.popleft())
+                if not standalone:
+                    del self._standalone[response_key]
+            for pending in retired:
+                self._mark_done(pending)
+        return [pending.callback for pending in retired] + persistent
+
+    def expire(self, now=None):
+        """Remove all grouped and standalone callbacks whose timeouts have
+        passed, and return them as a list of (response_key, callback) pairs."""
+        if now is None:
+            now = time.monotonic()
+        expired = []
+        # unlocked peek is just an optimization: heap[0] is always the earliest deadline
+        if not self._deadlines or self._deadlines[0][0] > now:
+            return expired
+        with self._lock:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                deadline, sequence, pending = heapq.heappop(self._deadlines)
+                if pending.done:
+                    continue
+                table = self._grouped if pending in self._grouped.get(pending.response_key, ()) else self._standalone
+                self._discard(table, pending)
+                expired.append((pending.response_key, pending.callback))
+        return expired
+
+    def __len__(self):
+        """Number of pending grouped and standalone callbacks."""
+        with self._lock:
+            return sum(map(len, self._grouped.values())) + sum(map(len, self._standalone.values()))
 
 class MessageManager(threading.Thread):
     """Base class for managing messages and responses sent to/from a
     device that can operate asynchronously and may respond out-of-order.
 
-    This class maintains a dictionary of callbacks for pending responses,
-    indexed by "response keys". When a response is received that matches the key,
-    the callback is called.
+    This class maintains a PendingResponses registry of callbacks for pending
+    responses, indexed by "response keys". When a response is received that
+    matches the key, the callback is called. Callbacks that are not answered
+    within their timeout (or the manager's default_timeout) are expired, so
+    that dropped responses cannot accumulate stale callbacks forever.
 
     Subclasses must implement a method for generating a response key from an
     incoming response, as well as methods for sending and receiving messages.
@@ -49,12 +205,13 @@ class MessageManager(threading.Thread):
     To cause the thread to stop running, set the 'running' attribute to False.
      """
     thread_name = 'MessageManager'
+    # seconds after which unanswered callbacks are expired if send_message()
+    # is not given an explicit timeout; None means never expire.
+    default_timeout = None
 
     def __init__(self, daemon=True):
-        # pending_xxx_responses holds lists of callbacks to call for each response key
-        self.pending_grouped_responses = collections.defaultdict(list)
-        self.pending_standalone_responses = collections.defaultdict(list)
-        self.pending_persistent_responses = collections.defaultdict(list)
+        self.pending_responses = PendingResponses()
+        # (response_key, callback) for the most recently sent message with a callback
         self.latest_callback = None
         super().__init__(name=self.thread_name, daemon=daemon)
         self.start()
@@ -69,28 +226,27 @@ class MessageManager(threading.Thread):
             response_key = self._generate_response_key(response)
             logger.debug('received response: {} with response key: {}', response, response_key)
 
-            handled = False
-            if response_key in self.pending_grouped_responses:
-                callbacks = self.pending_grouped_responses.pop(response_key)
-                for callback in callbacks:
-                    self._run_callback_safely(callback, response)
-                handled = True
-
-            if response_key in self.pending_standalone_responses:
-                callback, *remaining_callbacks = self.pending_standalone_responses.pop(response_key)
+            callbacks = self.pending_responses.retire(response_key)
+            for callback in callbacks:
                 self._run_callback_safely(callback, response)
-                if remaining_callbacks:
-                    self.pending_standalone_responses[response] = remaining_callbacks
-                handled = True
+            if not callbacks:
+                self._handle_unexpected_response(response, response_key)
+            self._expire_pending()
 
-            if response_key in self.pending_persistent_responses:
-                callbacks = self.pending_persistent_responses[response_key]
-                for callback in callbacks:
-                    self._run_callback_safely(callback, response)
-                handled = True
+    def _expire_pending(self):
+        """Expire any pending callbacks whose timeouts have passed. Called from
+        the manager thread after each response, and also periodically by
+        subclasses whose _receive_message() waits with a timeout."""
+        for response_key, callback in self.pending_responses.expire():
+            self._handle_expired_callback(response_key, callback)
 
-            if not handled:
-                self._handle_unexpected_response(response, response_key)
+    def _handle_expired_callback(self, response_key, callback):
+        """Handle a callback that was never answered within its timeout. If the
+        callback is a message_device.Response, it is expired so that anyone
+        waiting on it will get a ResponseTimeoutError."""
+        logger.warning('no response received for response key: {!r}; discarding callback', response_key)
+        if isinstance(callback, message_device.Response):
+            callback.expire()
 
     def _run_callback_safely(self, callback, response):
         """Catch errors from callbacks and log them. Not much else to do
@@ -102,13 +258,26 @@ class MessageManager(threading.Thread):
 
     def register_persistent_callback(self, response_key, response_callback):
         """Add a callback to always be called for a given response_key."""
-        self.pending_persistent_responses[response_key].append(response_callback)
+        self.pending_responses.add_persistent(response_key, response_callback)
 
     def unregister_persistent_callback(self, response_key, response_callback):
         """Remove a presistent callback."""
-        self.pending_persistent_responses[response_key].remove(response_callback)
+        self.pending_responses.remove_persistent(response_key, response_callback)
+
+    def register_callback(self, response_key, response_callback, coalesce=True, timeout=None):
+        """Add a callback to be called once for the next response matching
+        response_key, without sending any message. See send_message() for the
+        meaning of the other parameters."""
+        if timeout is None:
+            timeout = self.default_timeout
+        self.pending_responses.add(response_key, response_callback, coalesce, timeout)
 
-    def send_message(self, message, response_key=None, response_callback=None, coalesce=True):
+    def unregister_callback(self, response_key, response_callback):
+        """Remove a pending callback that has not yet been called. Return True
+        if the callback was pending, or False if it was already retired."""
+        return self.pending_responses.remove(response_key, response_callback)
+
+    def send_message(self, message, response_key=None, response_callback=None, coalesce=True, timeout=None):
         """Send a message from a foreground thread.
         (I.e. not the thread that the MessageManager is running.)
 
@@ -120,11 +289,12 @@ class MessageManager(threading.Thread):
             previously queued callback, in response to a previously sent
             message. (This makes sense if messages override each other and the
             first response should be considered to retire both.) If False, this
-            callback will not be grouped with any other callbacks also queued
-            with 'coalesce=False'. Note that 'onetime' cannot be False if
-            'coalesce' is False -- it doesn't make sense, as non-onetime
-            messages are for status-update type information, which should be
-            shared among all requesters.
+            callback will not be grouped with any other callbacks, and
+            callbacks queued with 'coalesce=False' for the same response key
+            will be retired one per response, in the order they were sent.
+        timeout: if no matching response has been received after this many
+            seconds, the callback is expired (see _handle_expired_callback).
+            If None, the manager's default_timeout is used.
         """
         # There is one thread-synchronization worry: if a pending response is
         # queued right before a response to a previous message with the same
@@ -132,19 +302,16 @@ class MessageManager(threading.Thread):
         # would otherwise override the previous message), then this callback will
         # be called for the previous response (if coalesce=True), leaving the
         # current message with no handler.
-        # Solution: do not queue and send messages while response-handling is
-        # in progress. The problem is that a previous-response could be in-flight
-        # over the wire, which cannot be detected, and so we can't 100% avoid
-        # these types of cases! This is a design flaw in the Leica system, for
-        # which this infrastructure is built. The best solution is to process
-        # things as quickly as possible on this side, so we will not use any
-        # locking primitives and just hope for the best.
+        # The registry itself is thread-safe, so callbacks are never lost or
+        # leaked by concurrent modification. But a previous response could be
+        # in-flight over the wire, which cannot be detected, and so we can't 100%
+        # avoid the above case! This is a design flaw in the Leica system, for
+        # which this infrastructure is built.
 
         logger.debug('sending message: {!r} with response key: {!r}', message, response_key)
         if response_key is not None and response_callback is not None:
-            response_dict = self.pending_grouped_responses if coalesce else self.pending_standalone_responses
-            response_dict[response_key].append(response_callback)
-            self.latest_callback = response_callback
+            self.register_callback(response_key, response_callback, coalesce, timeout)
+            self.latest_callback = response_key, response_callback
         self._send_message(message)
 
     def _send_message(self, message):
@@ -177,50 +344,204 @@ class SerialMessageManager(MessageManager):
         self.serial_port = smart_serial.Serial(serial_port, baudrate=serial_baud, timeout=1)
         self.thread_name = 'SerialMessageManager({})'.format(self.serial_port.port)
         self.response_terminator = response_terminator
+        # complete responses that have been read from the port but not yet handled
+        self._received_frames = collections.deque()
+        self._write_lock = threading.Lock()
         super().__init__(daemon)
 
     def _send_message(self, message):
         if type(message) != bytes:
             message = bytes(message, encoding='ascii')
-        self.serial_port.write(message)
+        with self._write_lock:
+            self.serial_port.write(message)
 
     def _receive_message(self):
         while self.running:
+            if self._received_frames:
+                return self._parse_response(self._received_frames.popleft())
             try:
-                response = self.serial_port.read_until(self.response_terminator)
+                # read every complete response available at once: during stage
+                # moves the scope sends bursts of events, which can then be
+                # framed with one buffer operation instead of one per event.
+                self._received_frames.extend(self.serial_port.read_frames(self.response_terminator))
             except smart_serial.SerialTimeout:
+                self._expire_pending()
                 continue
-            return str(response[:-len(self.response_terminator)], encoding='ascii')
+
+    def _parse_response(self, frame):
+        """Convert a response frame (bytes, without terminator) into the object
+        that will be used to generate the response key and will be passed to
+        all callbacks."""
+        return str(frame, encoding='ascii')
+
+class _OutboundCommand:
+    __slots__ = ('message', 'response_key', 'queue_key', 'callbacks', 'coalesce', 'timeout')
+    def __init__(self, response_key, queue_key, coalesce):
+        self.response_key = response_key
+        self.queue_key = queue_key
+        self.coalesce = coalesce
+        self.callbacks = []
 
 class LeicaMessageManager(SerialMessageManager):
-    """MessageManager subclass appropriate for routing messages from Leica API"""
+    """MessageManager subclass appropriate for routing messages from Leica API.
+
+    Each response is parsed exactly once, into a message_device.LeicaResponseTuple,
+    which is shared by all callbacks registered for that response.
+
+    Outgoing commands are placed on a queue that a sender thread writes to the
+    (slow) serial line one at a time. If a coalescable command is sent while
+    the last command in the queue is for the same function unit, command ID, and
+    addressing parameters (e.g. which lamp or objective: by Leica convention,
+    all parameters but the last), the newer command replaces the queued one, and
+    the callbacks of the superseded command are retired by the response to the
+    newer command. So rapid-fire setters (e.g. joypad-driven stage velocity
+    changes) put only the most recent intent on the wire. Commands are never
+    coalesced across other queued commands, which would change the order in
+    which the commands take effect.
+    """
+    # No Leica command takes anywhere near this long, so anything still pending
+    # after this time is waiting for a response that was dropped.
+    default_timeout = 600
     def __init__(self, serial_port, serial_baud, daemon=True):
+        # Commands not yet written to the serial port, in the order they will be sent.
+        self._outbound = collections.deque()
+        self._outbound_ready = threading.Condition()
         super().__init__(serial_port, serial_baud, response_terminator=b'\r', daemon=daemon)
+        self._sender = threading.Thread(target=self._send_outbound,
+            name='LeicaCommandSender({})'.format(self.serial_port.port), daemon=daemon)
+        self._sender.start()
+
+    def send_message(self, message, response_key=None, response_callback=None, coalesce=True, timeout=None):
+        """Queue a message to be sent from the sender thread. See
+        MessageManager.send_message for a description of the parameters; note
+        that if 'coalesce' is True, and the most recently queued message has not
+        yet been sent and is for the same command and addressing parameters, it
+        will be replaced by this message."""
+        if response_key is not None and coalesce:
+            queue_key = self._get_queue_key(message, response_key)
+        else:
+            queue_key = object() # never equal to any other
+        with self._outbound_ready:
+            if self._outbound and self._outbound[-1].queue_key == queue_key:
+                command = self._outbound[-1]
+                logger.debug('message: {!r} supersedes unsent message: {!r}', message, command.message)
+            else:
+                command = _OutboundCommand(response_key, queue_key, coalesce)
+                self._outbound.append(command)
+                logger.debug('queueing message: {!r} with response key: {!r}', message, response_key)
+            command.message = message
+            command.timeout = timeout
+            if response_key is not None and response_callback is not None:
+                command.callbacks.append(response_callback)
+            self._outbound_ready.notify()
+
+    @staticmethod
+    def _get_queue_key(message, response_key):
+        """Return the key that identifies commands that can replace one another:
+        the response key (function unit and command ID) and every parameter but
+        the last, which address the sub-device to which the value applies."""
+        if type(message) == bytes:
+            message = str(message, encoding='ascii')
+        params = message.split()[1:]
+        return (response_key,) + tuple(params[:-1])
+
+    def unregister_callback(self, response_key, response_callback):
+        with self._outbound_ready:
+            for command in self._outbound:
+                if command.response_key == response_key and response_callback in command.callbacks:
+                    command.callbacks.remove(response_callback)
+                    return True
+        return super().unregister_callback(response_key, response_callback)
+
+    def _send_outbound(self):
+        """Sender thread target: do not call directly."""
+        while self.is_alive():
+            with self._outbound_ready:
+                if not self._outbound:
+                    self._outbound_ready.wait(1)
+                    continue
+                command = self._outbound.popleft()
+                # register callbacks only now, so that a response to a previously-sent
+                # command with the same key cannot retire them.
+                for callback in command.callbacks:
+                    self.register_callback(command.response_key, callback, command.coalesce, command.timeout)
+                if command.callbacks:
+                    self.latest_callback = command.response_key, command.callbacks[-1]
+            logger.debug('sending message: {!r} with response key: {!r}', command.message, command.response_key)
+            try:
+                self._send_message(command.message)
+                # wait until the message is actually on the wire, so that newer
+                # commands queued in the meantime can supersede each other
+                self.serial_port.flush()
+            except:
+                logger.error('Could not send message: {!r}', command.message, exc_info=True)
+
+    def _parse_response(self, frame):
+        return message_device.parse_leica_response(str(frame, encoding='ascii'))
 
     def _generate_response_key(self, response):
-        if response[0] == '$':
+        full_response = response.full_response
+        if response.auto_event:
             # response is a status update: return entire function id
-            return response[:6]
+            return full_response[:6]
         else:
             # Return function unit ID and command ID, but strip out
             # the error code so can match both error and non-error responses
-            return response[:2] + response[3:5]
+            return full_response[:2] + full_response[3:5]
 
     def _handle_unexpected_response(self, response, response_key):
-        if response[0] == '$':
+        header = response.header
+        if response.auto_event:
             # Unexpected notifications are quite common, and if the dm6000b has communicated with MicroManager or the Leica
             # Windows software since last power cycled, they may be overwhelming in number. Therefore, these are appropriately
             # debug messages.
-            logger.debug('received UNEXPECTED notification from Leica device: {} with response key: {}', response, response_key)
-        elif response[2:4] == '99':
+            logger.debug('received UNEXPECTED notification from Leica device: {} with response key: {}', response.full_response, response_key)
+        elif header[2:4] == '99':
             # Error responses in the xx99x class  won't map back to a given response key properly, so we hackishly assume they 
             # pertain to the most recent command sent.
-            if response[2:5] == '998':
-                logger.error('Leica function unit {} not available.', response[:2])
+            if header[2:5] == '998':
+                logger.error('Leica function unit {} not available.', header[:2])
             else:
-                logger.error('Leica error: {}.', response)
+                logger.error('Leica error: {}.', response.full_response)
             if self.latest_callback is not None:
-                self._run_callback_safely(self.latest_callback, response)
+                latest_key, latest_callback = self.latest_callback
+                # only retire the callback if it hasn't been answered already
+                if self.pending_responses.remove(latest_key, latest_callback):
+                    self._run_callback_safely(latest_callback, response)
         else:
             # Unprompted command responses are an ominous sign and are of general interest
-            logger.warning('received UNPROMPTED COMMAND RESPONSE from Leica device: {} with response key: {}', response, response_key)
+            logger.warning('received UNPROMPTED COMMAND RESPONSE from Leica device: {} with response key: {}', response.full_response, response_key)
+
+def benchmark_leica_event_rate(event_count=100000):
+    """Measure how many Leica event notifications per second a LeicaMessageManager
+    can frame, parse, and dispatch, by feeding a burst of stage-position events
+    through a pseudo-terminal. Returns the measured events per second."""
+    import os
+    import time
+    master, slave = os.openpty()
+    manager = LeicaMessageManager(os.ttyname(slave), 19200)
+    received = []
+    done = threading.Event()
+    def callback(response):
+        received.append(response)
+        if len(received) == event_count:
+            done.set()
+    # several callbacks per event, as with the subscriptions made by Stage._setup_device()
+    device = message_device.LeicaAsyncDevice(manager)
+    device.register_event_callback(72023, callback)
+    device.register_event_callback(72023, lambda response: None)
+    data = b''.join(bytes('$72023 {}\r'.format(i), encoding='ascii') for i in range(event_count))
+    def writer():
+        view = memoryview(data)
+        while view:
+            view = view[os.write(master, view):]
+    t0 = time.time()
+    threading.Thread(target=writer, daemon=True).start()
+    done.wait()
+    elapsed = time.time() - t0
+    manager.running = False
+    manager.join()
+    manager.serial_port.close()
+    os.close(master)
+    os.close(slave)
+    return event_count / elapsed
@@ -24,16 +24,11 @@
 
 from serial import SerialException
 
-from .messaging import message_manager, message_device
-from .device.leica import stand, stage, objective_turret, illumination_axes
-from .device.andor import camera
-from .device.io_tool import io_tool
-from .device import spectra_x
-from .device import tl_lamp
-from .device import acquisition_sequencer
-from .device import autofocus
-from .device import peltier
-from .device import footpedal
+from .messaging import message_device
+
+# Device modules are imported below only when the corresponding device is
+# looked for, so that hardware which is not configured or not attached (and its
+# driver libraries) costs nothing at startup.
 
 from .config import scope_configuration
 
@@ -57,6 +52,8 @@ class Scope(message_device.AsyncDeviceNamespace):
         has_leica_LED = False
         try:
             logger.info('Looking for microscope.')
+            from .messaging import message_manager
+            from .device.leica import stand, stage, objective_turret, illumination_axes
             manager = message_manager.LeicaMessageManager(config.Stand.SERIAL_PORT, config.Stand.SERIAL_BAUD)
             self.stand = stand.Stand(manager, property_server, property_prefix='scope.stand.')
             function_units = self.stand.get_available_function_unit_IDs()
@@ -85,6 +82,7 @@ class Scope(message_device.AsyncDeviceNamespace):
 
         try:
             logger.info('Looking for IOTool.')
+            from .device.io_tool import io_tool
             self.iotool = io_tool.IOTool()
             has_iotool = True
         except SerialException:
@@ -98,19 +96,23 @@ class Scope(message_device.AsyncDeviceNamespace):
         if has_iotool:
             try:
                 logger.info('Looking for Spectra X.')
+                from .device import spectra_x
                 self.il.spectra_x = spectra_x.SpectraX(self.iotool, property_server, property_prefix='scope.il.spectra_x.')
                 has_spectra_x = True
             except SerialException:
                 has_spectra_x = False
                 logger.log_exception('Could not connect to Spectra X:')
+            from .device import tl_lamp
+            from .device import footpedal
             if has_leica_LED: # using DMi8, and scope is turned on
                 self.tl.lamp = tl_lamp.LeicaLED_Lamp(self.tl, self.iotool, property_server, property_prefix='scope.tl.lamp.')
             else:
                 self.tl.lamp = tl_lamp.SutterLED_Lamp(self.iotool, property_server, property_prefix='scope.tl.lamp.')
             self.footpedal = footpedal.Footpedal(self.iotool)
 
+        logger.info('Looking for camera.')
+        from .device.andor import camera
         try:
-            logger.info('Looking for camera.')
             self.camera = camera.Camera(property_server, property_prefix='scope.camera.')
             has_camera = True
         except camera.lowlevel.AndorError:
@@ -118,14 +120,17 @@ class Scope(message_device.AsyncDeviceNamespace):
             logger.log_exception('Could not connect to camera:')
 
         if has_camera and has_iotool and has_spectra_x:
+            from .device import acquisition_sequencer
             self.camera.acquisition_sequencer = acquisition_sequencer.AcquisitionSequencer(self)
 
         if has_scope and has_camera:
+            from .device import autofocus
             self.camera.autofocus = autofocus.Autofocus(self.camera, self.stage)
 
         if 'Peltier' in config:
             try:
                 logger.info('Looking for peltier controller.')
+                from .device import peltier
                 self.peltier = peltier.Peltier(property_server, property_prefix='scope.peltier.')
             except SerialException:
                 logger.log_exception('Could not connect to peltier controller:')
@@ -73,6 +73,11 @@ def _make_rpc_client(rpc_addr, interrupt_addr, image_transfer_addr, context=None
             return best_z, positions_and_scores, get_many_data(image_names)
         else:
             return best_z, positions_and_scores
+    def get_batch_data(return_values):
+        images, timestamps = return_values
+        if isinstance(images, str): # a single server-side reduced image
+            return get_data(images), timestamps
+        return get_many_data(images), timestamps
     def get_config(config_dict):
         return scope_configuration.ConfigDict(config_dict)
 
@@ -80,6 +85,7 @@ def _make_rpc_client(rpc_addr, interrupt_addr, image_transfer_addr, context=None
         'get_configuration': get_config,
         'camera.acquire_image': get_data,
         'camera.next_image': get_data,
+        'camera.next_images': get_batch_data,
         'camera.stream_acquire': get_stream_data,
         'camera.acquisition_sequencer.run': get_many_data,
         'camera.autofocus.autofocus': get_autofocus_data,
@@ -2,10 +2,19 @@ import sys
 import time
 import subprocess
 import pathlib
+import os
 import os.path
 import signal
 import json
 import collections
+import heapq
+import queue
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+import hashlib
 import smtplib
 import email.mime.text as mimetext
 
@@ -15,6 +24,7 @@ from .config import scope_configuration
 
 from .util import json_encode
 from .util import base_daemon
+from .util import job_worker
 from .util import logging
 logger = logging.get_logger(__name__)
 
@@ -22,6 +32,13 @@ STATUS_QUEUED = 'queued'
 STATUS_ERROR = 'error'
 STATUS_SUSPENDED = 'suspended'
 
+# Resources that a job may declare that it needs. Jobs that need the microscope
+# (e.g. acquisitions) are run one at a time; CPU-only jobs (e.g. analysis) can
+# run alongside them. See JobRunner.RESOURCE_SLOTS.
+RESOURCE_SCOPE = 'scope'
+RESOURCE_CPU = 'cpu'
+RESOURCES = (RESOURCE_SCOPE, RESOURCE_CPU)
+
 MAIL_RELAY = 'mailrelay.wustl.edu'
 MAIL_SENDER = 'scope-daemon@zplab.wustl.edu'
 
@@ -49,15 +66,25 @@ def main(timepoint_function):
         print(next_run_time)
 
 class JobRunner(base_daemon.Runner):
+    # maximum number of jobs needing each resource that may run at the same time
+    RESOURCE_SLOTS = {RESOURCE_SCOPE: 1, RESOURCE_CPU: 2}
+    # seconds to wait for a newly-started job worker to finish its setup and
+    # start listening, before stopping it and reporting the job as failed
+    WORKER_STARTUP_TIMEOUT = 300
+    # number of characters from the end of a failed worker's output to report
+    WORKER_LOG_TAIL = 10000
+
     def __init__(self):
         self.base_dir = pathlib.Path(scope_configuration.CONFIG_DIR)
         self.jobs = _JobList(self.base_dir / 'scope_jobs.json')
-        self.current_job = _JobFile(self.base_dir / 'scope_job_current')
+        self.current_jobs = _RunningJobsFile(self.base_dir / 'scope_job_current')
         self.log_dir = self.base_dir / 'scope_job_logs'
+        self.worker_dir = self.base_dir / 'scope_job_workers'
         super().__init__(name='Scope Job Manager', pidfile_path=self.base_dir / 'scope_job_runner.pid')
 
     # THE FOLLOWING FUNCTIONS ARE FOR COMMUNICATING WITH / STARTING A RUNNING DAEMON
-    def add_job(self, exec_file, alert_emails, next_run_time='now'):
+    # (A running daemon watches the job file, so it notices any changes made here.)
+    def add_job(self, exec_file, alert_emails, next_run_time='now', resource=RESOURCE_SCOPE, worker=False):
         """Add a job to the queue.
 
         Parameters:
@@ -70,10 +97,15 @@ class JobRunner(base_daemon.Runner):
             alert_emails: one email address as a string, list/tuple of multiple emails, or None.
                 If not None, then these email addresses will be alerted if the job fails.
             next_run_time: either a time.time() style timestamp, or 'now'.
+            resource: RESOURCE_SCOPE ('scope') if the job uses the microscope,
+                or RESOURCE_CPU ('cpu') if it does not, and so can run while
+                other jobs are using the microscope.
+            worker: if True, keep the job's process running between runs, and
+                send it each run as a request (see util.job_worker). Only for
+                job scripts that support this, such as those that call
+                timecourse.base_handler.TimepointHandler.main().
             """
-        self.jobs.add(exec_file, alert_emails, next_run_time, STATUS_QUEUED)
-        if self.is_running():
-            self._awaken_daemon()
+        self.jobs.add(exec_file, alert_emails, next_run_time, STATUS_QUEUED, resource, worker)
 
     def remove_job(self, exec_file):
         """Remove the job specified by the given exec_file.
@@ -82,10 +114,8 @@ class JobRunner(base_daemon.Runner):
         exec_file = canonical_path(exec_file)
         self.jobs.remove(exec_file)
         print('Job {} has been removed from the queue for future execution.'.format(exec_file))
-        if self.current_job.get() == exec_file:
+        if exec_file in self.current_jobs.get():
             print('This job is currently running. This run has NOT been terminated.')
-        if self.is_running():
-            self._awaken_daemon()
 
     def suspend_job(self, exec_file):
         """Suspend further execution of the job specified by the given exec_file.
@@ -95,10 +125,8 @@ class JobRunner(base_daemon.Runner):
         exec_file = canonical_path(exec_file)
         self.jobs.update(exec_file, status=STATUS_SUSPENDED)
         print('Job {} has been suspended and will not be executed in the future unless resumed.'.format(exec_file))
-        if self.current_job.get() == exec_file:
+        if exec_file in self.current_jobs.get():
             print('This job is currently running. This run has NOT been terminated.')
-        if self.is_running():
-            self._awaken_daemon()
 
     def resume_job(self, exec_file, next_run_time=None):
         """Resume a job that was suspended manually or for reasons of error.
@@ -112,9 +140,7 @@ class JobRunner(base_daemon.Runner):
         else:
             self.jobs.update(exec_file, status=STATUS_QUEUED, next_run_time=next_run_time)
         print('Job {} has been placed in the active job queue.'.format(exec_file))
-        if self.is_running():
-            self._awaken_daemon()
-        else:
+        if not self.is_running():
             print('NOTE: The job-runner is NOT CURRENTLY RUNNING. Until it is started again, queued jobs WILL NOT BE RUN.')
 
 
@@ -122,8 +148,7 @@ class JobRunner(base_daemon.Runner):
         """Suspend further execution of all queued jobs."""
         self._change_all_status(STATUS_QUEUED, STATUS_SUSPENDED)
         print('All jobs have been suspended and will not be executed in the future unless resumed.')
-        exec_file = self.current_job.get()
-        if exec_file:
+        for exec_file in self.current_jobs.get():
             print('Job {} is currently running. This run has NOT been terminated.'.format(exec_file))
 
 
@@ -144,34 +169,32 @@ class JobRunner(base_daemon.Runner):
         for job in jobs:
             if job.status == status_from:
                 self.jobs.update(job.exec_file, status=status_to)
-        if self.is_running():
-            self._awaken_daemon()
 
     def status(self):
         """Print a status message listing the running and queued jobs, if any."""
         is_running = self.is_running()
         if is_running:
             print('Job-runner daemon is running (PID {}).'.format(self.get_pid()))
-            current_job = self.current_job.get()
+            current_jobs = self.current_jobs.get()
         else:
             print('Job-runner daemon is NOT running.')
-            # In the unlikely event that the current_job file didn't get cleared before the daemon exited
-            # we should just ignore any stale entries in current_job.
-            current_job = None
-        if current_job:
+            # In the unlikely event that the current_jobs file didn't get cleared before the daemon exited
+            # we should just ignore any stale entries in current_jobs.
+            current_jobs = []
+        for current_job in current_jobs:
             print('Running job {}.'.format(current_job))
         jobs = self.jobs.get_jobs()
         upcoming_jobs = []
         non_queued_jobs = []
         for job in jobs:
-            if job.exec_file == current_job:
+            if job.exec_file in current_jobs:
                 continue
             if job.status == STATUS_QUEUED and job.next_run_time is not None:
                 upcoming_jobs.append(job)
             else:
                 non_queued_jobs.append(job)
         now = time.time()
-        if current_job and not upcoming_jobs:
+        if current_jobs and not upcoming_jobs:
             print('No other queued jobs.')
         elif not upcoming_jobs:
             print('No queued jobs.')
@@ -181,7 +204,7 @@ class JobRunner(base_daemon.Runner):
                 print('NOTE: As the job-runner is NOT CURRENTLY RUNNING, queued jobs WILL NOT BE RUN until the runner is started.')
             for job in upcoming_jobs:
                 blurb = self._format_job_blurb(now, job)
-                print('{}: {} (status: {})'.format(blurb, job.exec_file, job.status))
+                print('{}: {} (status: {}, resource: {}{})'.format(blurb, job.exec_file, job.status, job.resource, ', worker' if job.worker else ''))
         if non_queued_jobs:
             print('Jobs not queued:')
             for job in non_queued_jobs:
@@ -215,23 +238,22 @@ class JobRunner(base_daemon.Runner):
     def stop(self):
         """Gracefully terminate job daemon.
 
-        Note: If a job is currently running, it will complete."""
+        Note: If any jobs are currently running, they will complete."""
         self.assert_daemon()
         self.signal(signal.SIGINT)
-        current_job = self.current_job.get()
-        if current_job:
+        for current_job in self.current_jobs.get():
             print('Waiting for job {} to complete.'.format(current_job))
-        self.current_job.wait()
+        self.current_jobs.wait()
 
     def _awaken_daemon(self):
         """Wake the daemon up if it is sleeping, so that it will reread the
-        job file."""
+        job file. (Not normally necessary, as the daemon watches the file.)"""
         self.signal(signal.SIGHUP)
 
     # FOLLOWING FUNCTIONS ARE FOR USE WHEN DAEMONIZED
 
     def sigint_handler(self, signal_number, stack_frame):
-        """Stop running, but allow existing jobs to finish. If received twice,
+        """Stop starting jobs, but allow running jobs to finish. If received twice,
         forcibly terminate."""
         logger.info('Caught SIGINT')
         if self.running:
@@ -244,82 +266,240 @@ class JobRunner(base_daemon.Runner):
             raise SystemExit()
 
     def sighup_handler(self, signal_number, stack_frame):
-        """If sleeping, break out of sleep."""
+        """If sleeping, break out of sleep and reread the job file."""
         logger.debug('Caught SIGHUP')
         if self.asleep:
             raise InterruptedError()
 
     def initialize_daemon(self):
         self.jobs.update_job_lock()
-        self.current_job.clear()
+        self.current_jobs.clear()
 
     def run_daemon(self):
-        """Main loop: get a job to run and run it, or sleep until the next run
-        time (or forever) otherwise."""
+        """Main loop: start each queued job once it is due and the resource it
+        needs is free, and otherwise sleep until the next job is due, a running
+        job finishes, or the job file changes."""
         self.asleep = False
         self.running = True
-        while self.running:
-            job = self._get_next_job() # may be None
-            if job and job.next_run_time > time.time():
-                # not ready to run job yet
-                sleep_time = job.next_run_time - time.time()
-                job = None
-            else:
-                sleep_time = 60*60*24 # sleep for a day
-            if job:
-                # Run a job if there was one
-                self.current_job.set(job)
-                try:
-                    self._run_job(job)
-                finally:
-                    self.current_job.clear()
-            else:
-                # if we're out of jobs, sleep for a while
-                self.asleep = True
-                logger.debug('Sleeping for {}s', sleep_time)
+        self._running_jobs = {} # maps exec_file to Job
+        self._workers = {} # maps exec_file to the Popen object of the job's worker process
+        self._finished_jobs = queue.Queue() # results posted by the threads that run jobs
+        self._wake_read, self._wake_write = os.pipe() # written to by those threads to wake the main loop
+        watcher = _FileWatcher(self.jobs.backing_file)
+        try:
+            self._load_schedule()
+            while self.running or self._running_jobs:
+                while not self._finished_jobs.empty():
+                    self._finish_job(*self._finished_jobs.get())
+                if self.running:
+                    self._start_due_jobs()
+                timeout = self._time_until_next_job()
+                if watcher.poll_interval is not None:
+                    timeout = min(timeout, watcher.poll_interval)
+                readable = []
+                reload = False
                 try:
-                    time.sleep(sleep_time)
+                    self.asleep = True
+                    logger.debug('Sleeping for up to {:.0f}s', timeout)
+                    readable, _, _ = select.select([self._wake_read] + watcher.fds, [], [], timeout)
                 except InterruptedError:
-                    logger.debug('Awoken by HUP')
+                    logger.debug('Awoken by signal')
+                    reload = True
                 self.asleep = False
+                if self._wake_read in readable:
+                    os.read(self._wake_read, 4096)
+                if watcher.changed(readable) or reload:
+                    self._load_schedule()
+        finally:
+            for exec_file in list(self._workers):
+                self._stop_worker(exec_file)
+            watcher.close()
+            os.close(self._wake_read)
+            os.close(self._wake_write)
+
+    def _load_schedule(self):
+        """Rebuild the heap of queued jobs, ordered by next run time, from the job file."""
+        self._queued_jobs = {job.exec_file: job for job in self.jobs.get_jobs() if job.status == STATUS_QUEUED
+            and job.next_run_time is not None and job.exec_file not in self._running_jobs}
+        self._schedule = [(job.next_run_time, str(job.exec_file)) for job in self._queued_jobs.values()]
+        heapq.heapify(self._schedule)
+        # stop the workers of jobs that have been removed, suspended, or changed to not use a worker
+        for exec_file in list(self._workers):
+            job = self._queued_jobs.get(exec_file)
+            if exec_file not in self._running_jobs and (job is None or not job.worker):
+                self._stop_worker(exec_file)
+
+    def _resource_available(self, resource):
+        in_use = sum(job.resource == resource for job in self._running_jobs.values())
+        return in_use < self.RESOURCE_SLOTS.get(resource, 1)
+
+    def _start_due_jobs(self):
+        """Start all due jobs whose resources are available, most overdue first.
+        Due jobs that must wait for a resource stay at the top of the schedule,
+        so they get the resource as soon as it is free."""
+        now = time.time()
+        waiting = []
+        while self._schedule and self._schedule[0][0] <= now:
+            entry = heapq.heappop(self._schedule)
+            job = self._queued_jobs[pathlib.Path(entry[1])]
+            if self._resource_available(job.resource):
+                del self._queued_jobs[job.exec_file]
+                self._start_job(job)
+            else:
+                waiting.append(entry)
+        for entry in waiting:
+            heapq.heappush(self._schedule, entry)
+
+    def _time_until_next_job(self):
+        """Return the time until the next job that is not yet due. (Jobs that are
+        due but waiting for a resource will be started when a job finishes.)"""
+        now = time.time()
+        future_times = [run_time for run_time, exec_file in self._schedule if run_time > now]
+        if future_times:
+            return min(future_times) - now
+        return 60*60*24 # sleep for a day
 
-    def _run_job(self, job):
-        """Actually run a given job and interpret the output"""
+    def _start_job(self, job):
         logger.info('Running job {}', job.exec_file)
         args = [sys.executable, str(job.exec_file), str(job.next_run_time)]
         logger.debug('Parameters: {}', args)
+        self._running_jobs[job.exec_file] = job
+        self.current_jobs.add(job.exec_file)
+        threading.Thread(target=self._run_job, args=(job, args), daemon=True).start()
+
+    def _run_job(self, job, args):
+        """Actually run a given job (in a background thread), and pass the results
+        to the main loop."""
         start_time = time.time()
-        sub = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        stdout_data, stderr_data = sub.communicate()
-        elapsed_time = time.time() - start_time
-        logger.info('Job done (elapsed time: {:.0f} min)', elapsed_time/60)
+        result = None
+        if job.worker:
+            result = self._run_in_worker(job)
+        if result is None:
+            result = self._run_process(args)
+        self._finished_jobs.put((job, args, time.time() - start_time) + result)
+        os.write(self._wake_write, b'!')
+
+    def _run_process(self, args):
+        """Run a job as a new process. Return returncode, stdout_data, stderr_data."""
+        try:
+            sub = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            stdout_data, stderr_data = sub.communicate()
+            return sub.returncode, stdout_data, stderr_data
+        except Exception as e:
+            return None, '', 'Could not start job: {}'.format(e)
+
+    def _worker_socket(self, exec_file):
+        # unix socket paths are limited to ~100 characters, so use a short unique name
+        name = hashlib.sha1(str(exec_file).encode('utf8')).hexdigest()[:16]
+        return self.worker_dir / (name + '.sock')
+
+    def _worker_log(self, exec_file):
+        return self._worker_socket(exec_file).with_suffix('.log')
+
+    def _read_worker_log(self, exec_file):
+        try:
+            with self._worker_log(exec_file).open('r') as f:
+                return f.read()[-self.WORKER_LOG_TAIL:]
+        except OSError:
+            return ''
+
+    def _run_in_worker(self, job):
+        """Run a job by sending a request to its worker process, starting the
+        worker if it is not already running. Return returncode, stdout_data,
+        stderr_data in the same form as _run_process(), or None if the worker
+        could not be used (in which case nothing was run)."""
+        socket_path = self._worker_socket(job.exec_file)
+        worker = self._workers.get(job.exec_file)
+        if worker is None or worker.poll() is not None:
+            worker = self._start_worker(job.exec_file, socket_path)
+            if worker is None:
+                # the worker may have done anything before it exited (or was
+                # stopped), so do not risk running the job a second time
+                return 1, '', 'Worker for job {} failed to start. Worker output:\n{}'.format(
+                    job.exec_file, self._read_worker_log(job.exec_file))
+        try:
+            next_run_time = job_worker.request_run(socket_path, job.next_run_time)
+        except job_worker.WorkerUnavailable as e:
+            logger.info('Running job {} without worker: {}', job.exec_file, e)
+            self._stop_worker(job.exec_file)
+            return None
+        except job_worker.WorkerError as e:
+            # start from a clean process next time
+            self._stop_worker(job.exec_file)
+            return 1, '', 'Error in worker process for {}:\n{}'.format(job.exec_file, e)
+        return 0, '' if next_run_time is None else repr(float(next_run_time)), ''
+
+    def _start_worker(self, exec_file, socket_path):
+        """Start a worker process for the given job, and wait for it to finish
+        its setup and start listening at socket_path. Return the Popen object,
+        or None if the worker exited or timed out first (in which case its
+        output can be read with _read_worker_log())."""
+        self._stop_worker(exec_file)
+        if not self.worker_dir.exists():
+            self.worker_dir.mkdir(parents=True)
+        logger.info('Starting worker for job {}', exec_file)
+        env = dict(os.environ)
+        env[job_worker.WORKER_SOCKET_ENV] = str(socket_path)
+        # a job script without worker support rejects the WORKER_ARG argument,
+        # rather than taking it as a scheduled start time and running the job
+        with self._worker_log(exec_file).open('w') as log:
+            worker = subprocess.Popen([sys.executable, str(exec_file), job_worker.WORKER_ARG], env=env,
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        self._workers[exec_file] = worker
+        give_up_time = time.time() + self.WORKER_STARTUP_TIMEOUT
+        while not socket_path.exists():
+            if worker.poll() is not None or time.time() > give_up_time:
+                logger.warning('Worker for job {} failed to start', exec_file)
+                self._stop_worker(exec_file)
+                return None
+            time.sleep(0.1)
+        return worker
+
+    def _stop_worker(self, exec_file):
+        """Terminate the worker process for a job, if any."""
+        worker = self._workers.pop(exec_file, None)
+        if worker is not None:
+            if worker.poll() is None:
+                logger.info('Stopping worker for job {}', exec_file)
+                worker.terminate()
+                try:
+                    worker.wait(10)
+                except subprocess.TimeoutExpired:
+                    worker.kill()
+                    worker.wait()
+            socket_path = self._worker_socket(exec_file)
+            if socket_path.exists():
+                socket_path.unlink()
+
+    def _finish_job(self, job, args, elapsed_time, returncode, stdout_data, stderr_data):
+        """Interpret the output of a job that has finished running."""
+        del self._running_jobs[job.exec_file]
+        self.current_jobs.discard(job.exec_file)
+        logger.info('Job {} done (elapsed time: {:.0f} min)', job.exec_file, elapsed_time/60)
         logger.debug('Stdout {}', stdout_data)
         logger.debug('Stderr {}', stderr_data)
-        logger.debug('Retcode {}', sub.returncode)
-        if sub.returncode != 0:
-            self._job_broke(job, 'Calling: {}\nReturn code: {}\nStandard Error output:\n{}'.format(' '.join(args), sub.returncode, stderr_data))
-            return
-        if stdout_data:
-            try:
-                next_run_time = float(stdout_data)
-            except Exception as e:
-                self._job_broke(job, 'Could not parse next run time from job response "{}": {}'.format(next_run_time, e))
-                return
-        else:
-            next_run_time = None
+        logger.debug('Retcode {}', returncode)
         try:
-            self.jobs.update(job.exec_file, next_run_time=next_run_time)
-        except ValueError:
-            logger.info('Could not update job {}: perhaps it was removed while running?', job.exec_file)
-
-        log_run_time = 'in {:.0f} seconds'.format(next_run_time - time.time()) if next_run_time else 'never'
-        logger.info('Next run time: {}', log_run_time)
+            if returncode != 0:
+                self._job_broke(job, 'Calling: {}\nReturn code: {}\nStandard Error output:\n{}'.format(' '.join(args), returncode, stderr_data))
+                return
+            if stdout_data:
+                try:
+                    next_run_time = float(stdout_data)
+                except Exception as e:
+                    self._job_broke(job, 'Could not parse next run time from job response "{}": {}'.format(stdout_data, e))
+                    return
+            else:
+                next_run_time = None
+            try:
+                self.jobs.update(job.exec_file, next_run_time=next_run_time)
+            except ValueError:
+                logger.info('Could not update job {}: perhaps it was removed while running?', job.exec_file)
 
-    def _get_next_job(self):
-        """Get the job that should be run next."""
-        for job in self.jobs.get_jobs():
-            if job.status == STATUS_QUEUED and job.next_run_time is not None:
-                return job
+            log_run_time = 'in {:.0f} seconds'.format(next_run_time - time.time()) if next_run_time else 'never'
+            logger.info('Next run time: {}', log_run_time)
+        finally:
+            self._load_schedule()
 
     def _job_broke(self, job, error_text, new_status=STATUS_ERROR):
         """Alert the world that the job errored out."""
@@ -337,7 +517,8 @@ class JobRunner(base_daemon.Runner):
                 logger.error('Could not send alert email.', exc_info=True)
 
 
-_Job = collections.namedtuple('Job', ('exec_file', 'alert_emails', 'next_run_time', 'status'))
+_Job = collections.namedtuple('Job', ('exec_file', 'alert_emails', 'next_run_time', 'status', 'resource', 'worker'))
+_Job.__new__.__defaults__ = (RESOURCE_SCOPE, False) # job files from before these fields were added lack them
 
 def _validate_alert_emails(alert_emails):
     if alert_emails is None:
@@ -410,7 +591,7 @@ class _JobList:
             else:
                 raise ValueError('No job queued for {}'.format(exec_file))
 
-    def add(self, exec_file, alert_emails, next_run_time, status):
+    def add(self, exec_file, alert_emails, next_run_time, status, resource=RESOURCE_SCOPE, worker=False):
         """Add a new job to the list.
 
         Parameters:
@@ -418,11 +599,15 @@ class _JobList:
             alert_emails: None, tuple-of-strings, or single string
             next_run_time: timestamp float, 'now' or None
             status: current job status
+            resource: one of RESOURCES
+            worker: whether to run the job in a long-lived worker process
 
         """
         exec_file = canonical_path(exec_file)
         if not exec_file.exists():
             raise ValueError('Executable file {} does not exist.'.format(exec_file))
+        if resource not in RESOURCES:
+            raise ValueError('Job resource must be one of: {}'.format(', '.join(RESOURCES)))
         alert_emails = _validate_alert_emails(alert_emails)
         if next_run_time is 'now':
             next_run_time = time.time()
@@ -431,7 +616,7 @@ class _JobList:
 
         with self.jobs_lock:
             jobs = self._read()
-            jobs[exec_file] = _Job(exec_file, alert_emails, next_run_time, status)
+            jobs[exec_file] = _Job(exec_file, alert_emails, next_run_time, status, resource, bool(worker))
             self._write(jobs)
 
     def update(self, exec_file, **kws):
@@ -460,20 +645,33 @@ class _JobList:
         else:
             raise ValueError('No job queued for {}'.format(exec_file))
 
-class _JobFile:
+class _RunningJobsFile:
+    """Record of the currently-running jobs, as a file listing their exec_files,
+    one per line. The file exists only while jobs are running."""
     def __init__(self, jobfile_path):
         self.job_file = canonical_path(jobfile_path)
 
     def get(self):
-        """Return the contents of the job_file if it exists, else None."""
+        """Return a list of the running jobs' exec_files."""
         if self.job_file.exists():
             with self.job_file.open('r') as f:
-                return canonical_path(f.read())
+                return [canonical_path(line) for line in f.read().splitlines() if line]
+        return []
+
+    def _write(self, exec_files):
+        if exec_files:
+            with self.job_file.open('w') as f:
+                f.write(''.join(str(exec_file) + '\n' for exec_file in exec_files))
+        else:
+            self.clear()
+
+    def add(self, exec_file):
+        """Record that the given job is running."""
+        self._write(self.get() + [exec_file])
 
-    def set(self, job):
-        """Write the given string to the jobfile."""
-        with self.job_file.open('w') as f:
-            f.write(str(job.exec_file))
+    def discard(self, exec_file):
+        """Record that the given job is no longer running."""
+        self._write([f for f in self.get() if f != exec_file])
 
     def clear(self):
         """Remove the jobfile if it exists."""
@@ -481,6 +679,73 @@ class _JobFile:
             self.job_file.unlink()
 
     def wait(self):
-        """Wait until the jobfile has been cleared."""
+        """Wait until no jobs are running."""
         while self.job_file.exists():
             time.sleep(1)
+
+class _FileWatcher:
+    """Detect changes to a file: with inotify where available (Linux), or else
+    by checking its modification time every POLL_INTERVAL seconds.
+
+    Include the 'fds' list in the read list of a select() call (and, if
+    poll_interval is not None, time out after at most that many seconds), then
+    call changed() with the readable file descriptors."""
+    POLL_INTERVAL = 5
+    _IN_CLOSE_WRITE = 0x00000008
+    _IN_MOVED_TO = 0x00000080
+    _EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, name length
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.fds = []
+        self.poll_interval = None
+        self._mtime = self._get_mtime()
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK) # IN_NONBLOCK has the same value
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            # watch the directory: the file may be replaced rather than rewritten
+            if libc.inotify_add_watch(fd, str(self.path.parent).encode(), self._IN_CLOSE_WRITE | self._IN_MOVED_TO) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+            self.fds = [fd]
+        except (OSError, AttributeError):
+            logger.debug('inotify not available: polling {} for changes', self.path)
+            self.poll_interval = self.POLL_INTERVAL
+
+    def _get_mtime(self):
+        try:
+            return self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def changed(self, readable):
+        """Return whether the file has changed since the last call."""
+        if not self.fds:
+            mtime = self._get_mtime()
+            changed = mtime != self._mtime
+            self._mtime = mtime
+            return changed
+        if self.fds[0] not in readable:
+            return False
+        changed = False
+        name = os.fsencode(self.path.name)
+        while True:
+            try:
+                data = os.read(self.fds[0], 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self._EVENT_HEADER.unpack_from(data, offset)
+                offset += self._EVENT_HEADER.size
+                if data[offset:offset+length].rstrip(b'\0') == name:
+                    changed = True
+                offset += length
+        return changed
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
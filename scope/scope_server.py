@@ -22,7 +22,6 @@
 #
 # Authors: Zach Pincus
 
-import zmq
 import time
 import threading
 import json
@@ -78,6 +77,8 @@ class ScopeServer(base_daemon.Runner):
     # overrides from base_daemon.Runner to implement server behavior
     def initialize_daemon(self):
         # do scope imports here so any at-import debug logging gets properly recorded
+        # (and so that the status / stop commands need not import them at all)
+        import zmq
         from . import scope
         from .simple_rpc import rpc_server
         from .simple_rpc import property_server
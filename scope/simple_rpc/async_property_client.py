@@ -0,0 +1,139 @@
+import asyncio
+import collections
+import json
+import zmq
+import zmq.asyncio
+
+from . import trie
+
+class SubscriptionClosed(Exception):
+    pass
+
+# placed on a Subscription's queue when it is closed, to wake any waiting consumers
+_CLOSED = object()
+
+class Subscription:
+    """Asynchronous iterator over (property_name, value) updates, as returned by
+    AsyncZMQClient.subscribe() and subscribe_prefix(). Use as:
+        async for property_name, value in subscription:
+            ...
+
+    Updates are buffered in a queue until they are consumed. If maxsize is
+    nonzero and the consumer falls behind, the oldest buffered updates are
+    dropped in favor of new ones, so a slow consumer always sees recent values.
+    Call close() to stop receiving updates: iteration then ends once the
+    buffered updates have been consumed.
+    """
+    def __init__(self, client, key, is_prefix, maxsize):
+        self._client = client
+        self._key = key
+        self._is_prefix = is_prefix
+        self._queue = asyncio.Queue(maxsize)
+        self.closed = False
+
+    def _put(self, update):
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(update)
+
+    async def get(self):
+        """Return the next (property_name, value) update, waiting if necessary.
+        Raises SubscriptionClosed if the subscription has been closed and all
+        buffered updates have been consumed."""
+        update = await self._queue.get()
+        if update is _CLOSED:
+            self._queue.put_nowait(_CLOSED) # so that every later get() also raises
+            raise SubscriptionClosed()
+        return update
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._client._unsubscribe(self._key, self._is_prefix, self)
+            self._put(_CLOSED)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.get()
+        except SubscriptionClosed:
+            raise StopAsyncIteration
+
+class AsyncZMQClient:
+    """asyncio-based client for receiving property updates over ZeroMQ PUB/SUB.
+
+    Instead of registering callbacks that run in a background thread, as with
+    property_client.ZMQClient, subscribe to a property name or prefix and
+    iterate over the returned Subscription object from a coroutine:
+        client = AsyncZMQClient(addr)
+        frames = client.subscribe('scope.camera.frame_number')
+        async for property_name, frame_number in frames:
+            ...
+    Updates are received by a task that runs as long as there are
+    subscriptions; a local copy of the most recent value of every received
+    property is kept in the 'properties' attribute.
+    """
+    def __init__(self, port, context=None):
+        """Parameters:
+            port: a string ZeroMQ port identifier, like ''tcp://127.0.0.1:5555''.
+            context: a zmq.asyncio.Context to share, if one already exists.
+        """
+        self.context = context if context is not None else zmq.asyncio.Context()
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.connect(port)
+        self.properties = {}
+        # subscriptions is a dict mapping property names to sets of Subscriptions
+        self.subscriptions = collections.defaultdict(set)
+        # prefix_subscriptions is a trie used to match property names to prefixes
+        self.prefix_subscriptions = trie.trie()
+        self._receiver = None
+
+    def subscribe(self, property_name, maxsize=0):
+        """Return a Subscription that yields (property_name, value) each time
+        the named property is updated. If maxsize is nonzero, at most that many
+        updates are buffered (older updates are dropped)."""
+        subscription = Subscription(self, property_name, False, maxsize)
+        self.socket.setsockopt_string(zmq.SUBSCRIBE, property_name)
+        self.subscriptions[property_name].add(subscription)
+        self._ensure_receiver()
+        return subscription
+
+    def subscribe_prefix(self, property_prefix, maxsize=0):
+        """Return a Subscription that yields (property_name, value) each time a
+        property whose name starts with property_prefix is updated. An empty
+        prefix ('') will match everything. If maxsize is nonzero, at most that
+        many updates are buffered (older updates are dropped)."""
+        subscription = Subscription(self, property_prefix, True, maxsize)
+        self.socket.setsockopt_string(zmq.SUBSCRIBE, property_prefix)
+        if property_prefix not in self.prefix_subscriptions:
+            self.prefix_subscriptions[property_prefix] = set()
+        self.prefix_subscriptions[property_prefix].add(subscription)
+        self._ensure_receiver()
+        return subscription
+
+    def _unsubscribe(self, key, is_prefix, subscription):
+        subscriptions = self.prefix_subscriptions if is_prefix else self.subscriptions
+        subscribed = subscriptions[key]
+        subscribed.discard(subscription)
+        if not subscribed:
+            del subscriptions[key]
+        self.socket.setsockopt_string(zmq.UNSUBSCRIBE, key)
+
+    def _ensure_receiver(self):
+        if self._receiver is None or self._receiver.done():
+            self._receiver = asyncio.ensure_future(self._receive_updates())
+
+    async def _receive_updates(self):
+        while self.subscriptions or len(self.prefix_subscriptions):
+            property_name, value = await self.socket.recv_multipart()
+            property_name = str(property_name, encoding='utf8')
+            value = json.loads(str(value, encoding='utf8'))
+            self.properties[property_name] = value
+            update = property_name, value
+            for subscription in self.subscriptions.get(property_name, ()):
+                subscription._put(update)
+            for subscriptions in self.prefix_subscriptions.values(property_name):
+                for subscription in subscriptions:
+                    subscription._put(update)
@@ -0,0 +1,112 @@
+import asyncio
+import collections
+import json
+import zmq
+import zmq.asyncio
+
+from ..util import json_encode
+from . import rpc_client
+
+class AsyncZMQClient:
+    """asyncio-based client for the simple RPC protocol. Calls are coroutines:
+        result = await client('foo.bar.baz', x, y, z=5)
+    or, via a proxy namespace:
+        namespace = await client.proxy_namespace()
+        result = await namespace.foo.bar.baz(x, y, z=5)
+
+    Unlike rpc_client.ZMQClient, several calls may be outstanding at once (e.g.
+    via asyncio.gather()): requests are pipelined over a single DEALER socket,
+    and the server answers them in the order they were sent. (The server still
+    executes the calls one at a time.)
+
+    If a call is cancelled while the server is running it, an interrupt is sent
+    to the server, just as a KeyboardInterrupt does for the blocking client.
+    """
+    def __init__(self, rpc_addr, interrupt_addr=None, context=None):
+        """Parameters:
+            rpc_addr, interrupt_addr: a string ZeroMQ port identifier, like ''tcp://127.0.0.1:5555''.
+                If interrupt_addr is None, cancelled calls will not interrupt the server.
+            context: a zmq.asyncio.Context to share, if one already exists.
+        """
+        self.context = context if context is not None else zmq.asyncio.Context()
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.connect(rpc_addr)
+        if interrupt_addr is None:
+            self.interrupt_socket = None
+        else:
+            self.interrupt_socket = self.context.socket(zmq.PUSH)
+            self.interrupt_socket.connect(interrupt_addr)
+        # futures for the sent requests, in the order the replies will arrive
+        self._pending_replies = collections.deque()
+        self._reply_reader = None
+
+    async def __call__(self, command, *args, **kwargs):
+        request = json_encode.encode_compact_to_bytes((command, args, kwargs))
+        reply = asyncio.get_event_loop().create_future()
+        self._pending_replies.append(reply)
+        # the empty frame is the delimiter that a REQ socket would add for us
+        await self.socket.send_multipart([b'', request])
+        if self._reply_reader is None or self._reply_reader.done():
+            self._reply_reader = asyncio.ensure_future(self._read_replies())
+        try:
+            retval, is_error = await reply
+        except asyncio.CancelledError:
+            if self.interrupt_socket is not None and self._pending_replies and self._pending_replies[0] is reply:
+                # this call is the one the server is working on now
+                await self.interrupt_socket.send(b'interrupt')
+            raise
+        if is_error:
+            raise rpc_client.RPCError(retval)
+        return retval
+
+    async def _read_replies(self):
+        try:
+            while self._pending_replies:
+                empty, reply_type, reply = await self.socket.recv_multipart(copy=False)
+                reply_type = str(reply_type.bytes, encoding='ascii')
+                if reply_type == 'bindata':
+                    reply = reply.buffer
+                else:
+                    reply = json.loads(str(reply.bytes, encoding='utf8'))
+                future = self._pending_replies.popleft()
+                if not future.done(): # skip the replies to cancelled calls
+                    future.set_result((reply, reply_type == 'error'))
+        except asyncio.CancelledError:
+            self._fail_pending_replies(None)
+            raise
+        except Exception as e:
+            # replies can no longer be matched to requests: fail all waiting calls
+            self._fail_pending_replies(e)
+
+    def _fail_pending_replies(self, exception):
+        """Cancel the futures of all outstanding calls (if exception is None), or
+        else raise the exception from them."""
+        while self._pending_replies:
+            future = self._pending_replies.popleft()
+            if not future.done():
+                if exception is None:
+                    future.cancel()
+                else:
+                    future.set_exception(exception)
+
+    def proxy_function(self, command):
+        """Return a proxy coroutine function for server-side command 'command'."""
+        async def func(*args, **kwargs):
+            return await self(command, *args, **kwargs)
+        func.__name__ = func.__qualname__ = command
+        return func
+
+    async def proxy_namespace(self, client_wrappers=None):
+        """Use the RPC server's __DESCRIBE__ functionality to reconstitute a
+        faxscimile namespace on the client side, as for RPCClient.proxy_namespace.
+
+        Every proxy function returns an awaitable. Because properties cannot be
+        awaited on assignment, get_/set_ function pairs are left as functions,
+        so use 'await ns.stage.get_x()' rather than 'ns.stage.x'.
+
+        If client_wrappers is provided, it must be a dict mapping qualified
+        function names to functions that will be called with the awaitable
+        result of that RPC call, and which must themselves return an awaitable.
+        """
+        descriptions = await self('__DESCRIBE__')
+        return rpc_client._make_proxy_namespace(self, descriptions, client_wrappers, make_properties=False)
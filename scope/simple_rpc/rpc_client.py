@@ -84,63 +84,7 @@ class RPCClient:
         processing before returning to the client, this can be used for that
         purpose.
         """
-        if client_wrappers is None:
-            client_wrappers = {}
-        # group functions by their namespace
-        server_namespaces = collections.defaultdict(list)
-        functions_proxied = set()
-        for qualname, doc, argspec in self('__DESCRIBE__'):
-            functions_proxied.add(qualname)
-            *parents, name = qualname.split('.')
-            parents = tuple(parents)
-            server_namespaces[parents].append((name, qualname, doc, argspec))
-            # make sure that intermediate (and possibly-empty) namespaces are also in the dict
-            for i in range(len(parents)):
-                server_namespaces[parents[:i]] # for a defaultdict, just looking up the entry adds it
-
-        # for each namespace that contains functions:
-        # 1: see if there are any get/set pairs to turn into properties, and
-        # 2: make a class for that namespace with the given properties and functions
-        client_namespaces = {}
-        for parents, function_descriptions in server_namespaces.items():
-            # make a custom class to have the right names and more importantly to receive the namespace-specific properties
-            class NewNamespace(ClientNamespace):
-                pass
-            NewNamespace.__name__ = parents[-1] if parents else 'root'
-            NewNamespace.__qualname__ = '.'.join(parents) if parents else 'root'
-            # create functions and gather property accessors
-            accessors = collections.defaultdict(RPCClient._accessor_pair)
-            for name, qualname, doc, argspec in function_descriptions:
-                client_wrap_function = client_wrappers.pop(qualname, None)
-                client_func = _rich_proxy_function(doc, argspec, name, self, qualname, client_wrap_function)
-                if name.startswith('get_'):
-                    accessors[name[4:]].getter = client_func
-                    name = '_'+name
-                elif name.startswith('set_'):
-                    accessors[name[4:]].setter = client_func
-                    name = '_'+name
-                setattr(NewNamespace, name, client_func)
-            for name, accessor_pair in accessors.items():
-                setattr(NewNamespace, name, accessor_pair.get_property())
-            client_namespaces[parents] = NewNamespace()
-
-        # now assemble these namespaces into the correct hierarchy, fetching intermediate
-        # namespaces from the proxy_namespaces dict as required.
-        root = client_namespaces[()]
-        for parents in list(client_namespaces.keys()):
-            if parents not in client_namespaces:
-                # we might have already popped it below
-                continue
-            namespace = root
-            for i, element in enumerate(parents):
-                try:
-                    namespace = getattr(namespace, element)
-                except AttributeError:
-                    new_namespace = client_namespaces.pop(parents[:i+1])
-                    setattr(namespace, element, new_namespace)
-                    namespace = new_namespace
-        root._functions_proxied = functions_proxied
-        return root
+        return _make_proxy_namespace(self, self('__DESCRIBE__'), client_wrappers)
 
     class _accessor_pair:
         def __init__(self):
@@ -215,6 +159,69 @@ class ZMQClient(BaseZMQClient):
     def _send_interrupt(self, message):
         self.interrupt_socket.send(bytes(message, encoding='ascii'))
 
+def _make_proxy_namespace(rpc_client, descriptions, client_wrappers=None, make_properties=True):
+    """Build a proxy namespace (see RPCClient.proxy_namespace) from the results
+    of the RPC server's __DESCRIBE__ command, with proxy functions that call
+    rpc_client. If make_properties is False, get_/set_ function pairs are
+    left as plain functions instead of being turned into properties."""
+    if client_wrappers is None:
+        client_wrappers = {}
+    # group functions by their namespace
+    server_namespaces = collections.defaultdict(list)
+    functions_proxied = set()
+    for qualname, doc, argspec in descriptions:
+        functions_proxied.add(qualname)
+        *parents, name = qualname.split('.')
+        parents = tuple(parents)
+        server_namespaces[parents].append((name, qualname, doc, argspec))
+        # make sure that intermediate (and possibly-empty) namespaces are also in the dict
+        for i in range(len(parents)):
+            server_namespaces[parents[:i]] # for a defaultdict, just looking up the entry adds it
+
+    # for each namespace that contains functions:
+    # 1: see if there are any get/set pairs to turn into properties, and
+    # 2: make a class for that namespace with the given properties and functions
+    client_namespaces = {}
+    for parents, function_descriptions in server_namespaces.items():
+        # make a custom class to have the right names and more importantly to receive the namespace-specific properties
+        class NewNamespace(ClientNamespace):
+            pass
+        NewNamespace.__name__ = parents[-1] if parents else 'root'
+        NewNamespace.__qualname__ = '.'.join(parents) if parents else 'root'
+        # create functions and gather property accessors
+        accessors = collections.defaultdict(RPCClient._accessor_pair)
+        for name, qualname, doc, argspec in function_descriptions:
+            client_wrap_function = client_wrappers.pop(qualname, None)
+            client_func = _rich_proxy_function(doc, argspec, name, rpc_client, qualname, client_wrap_function)
+            if make_properties and name.startswith('get_'):
+                accessors[name[4:]].getter = client_func
+                name = '_'+name
+            elif make_properties and name.startswith('set_'):
+                accessors[name[4:]].setter = client_func
+                name = '_'+name
+            setattr(NewNamespace, name, client_func)
+        for name, accessor_pair in accessors.items():
+            setattr(NewNamespace, name, accessor_pair.get_property())
+        client_namespaces[parents] = NewNamespace()
+
+    # now assemble these namespaces into the correct hierarchy, fetching intermediate
+    # namespaces from the proxy_namespaces dict as required.
+    root = client_namespaces[()]
+    for parents in list(client_namespaces.keys()):
+        if parents not in client_namespaces:
+            # we might have already popped it below
+            continue
+        namespace = root
+        for i, element in enumerate(parents):
+            try:
+                namespace = getattr(namespace, element)
+            except AttributeError:
+                new_namespace = client_namespaces.pop(parents[:i+1])
+                setattr(namespace, element, new_namespace)
+                namespace = new_namespace
+    root._functions_proxied = functions_proxied
+    return root
+
 def _rich_proxy_function(doc, argspec, name, rpc_client, rpc_function, client_wrap_function=None):
     """Using the docstring and argspec from the RPC __DESCRIBE__ command,
     generate a proxy function that looks just like the remote function, except
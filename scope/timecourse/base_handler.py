@@ -33,19 +33,40 @@ import concurrent.futures as futures
 import os
 
 from ..util import json_encode
+from ..util import job_worker
 from ..util import threaded_image_io
 from ..util import log_util
+from ..client_util import position_order
+from . import position_metadata as position_metadata_log
 
 class DummyIO:
     def __init__(self, logger):
         self.logger = logger
-    def write(*args, **kws):
+    def write(self, *args, **kws):
         self.logger.warning('Trying to write files, but file writing was disabled!')
+    write_async = write
+    def flush(self):
+        pass
 
 class TimepointHandler:
     IMAGE_COMPRESSION = threaded_image_io.COMPRESSION.DEFAULT
     LOG_LEVEL = logging.INFO
     IO_THREADS = 4
+    # images are saved in the background while the next position is acquired;
+    # if this many bytes of images are waiting to be written, wait for the backlog to clear
+    IO_MAX_QUEUED_BYTES = 1024**3
+    # positions are processed and saved in the background while the next position
+    # is acquired; if this many positions are waiting, wait for the oldest to finish
+    MAX_PENDING_POSITIONS = 2
+    # order in which to visit positions: 'name' (sorted by name), 'shortest' (a short
+    # path according to the stage movement times), or 'serpentine' (row by row in
+    # y, alternating direction in x; positions within SERPENTINE_ROW_TOLERANCE mm
+    # in y are considered to be in the same row).
+    POSITION_ORDER = 'shortest'
+    SERPENTINE_ROW_TOLERANCE = 1
+    # seconds a worker process waits for the scope server to answer before
+    # reconnecting at the start of a timepoint (see reset_scope())
+    SCOPE_CHECK_TIMEOUT = 10
 
     def __init__(self, data_dir, log_level=None, scope_host='127.0.0.1', dry_run=False):
         """Setup the basic code to take a single timepoint from a timecourse experiment.
@@ -65,13 +86,10 @@ class TimepointHandler:
         """
         self.data_dir = pathlib.Path(data_dir)
         self.experiment_metadata_path = self.data_dir / 'experiment_metadata.json'
-        with self.experiment_metadata_path.open('r') as f:
-            self.experiment_metadata = json.load(f)
-        self.positions = self.experiment_metadata['positions'] # dict mapping names to (x,y,z) stage positions
-        self.skip_positions = set(self.experiment_metadata.setdefault('skip_positions', []))
+        self.load_experiment_metadata()
+        self.scope_host = scope_host
         if scope_host is not None:
-            from .. import scope_client
-            self.scope, self.scope_properties = scope_client.client_main(scope_host)
+            self._connect_scope()
             if hasattr(self.scope, 'camera'):
                 self.scope.camera.return_to_default_state()
         else:
@@ -84,7 +102,7 @@ class TimepointHandler:
             log_level = getattr(logging, log_level)
         self.logger.setLevel(log_level)
         if self.write_files:
-            self.image_io = threaded_image_io.ThreadedIO(self.IO_THREADS)
+            self.image_io = threaded_image_io.ThreadedIO(self.IO_THREADS, self.IO_MAX_QUEUED_BYTES)
             handler = logging.FileHandler(str(self.data_dir/'acquisitions.log'))
         else:
             self.image_io = DummyIO(self.logger)
@@ -92,6 +110,49 @@ class TimepointHandler:
         handler.setFormatter(log_util.get_formatter())
         self.logger.addHandler(handler)
         self._job_thread = futures.ThreadPoolExecutor(max_workers=1)
+        # a single worker finishes positions strictly in the order they were acquired
+        self._position_thread = futures.ThreadPoolExecutor(max_workers=1)
+        # and another records each position's metadata once its images are written
+        self._metadata_thread = futures.ThreadPoolExecutor(max_workers=1)
+
+    def load_experiment_metadata(self):
+        """Read the experiment metadata (including the positions to acquire) from
+        disk. This is done at the start of each timepoint run by a worker
+        process (see main()), so that edits made between timepoints take effect."""
+        with self.experiment_metadata_path.open('r') as f:
+            self.experiment_metadata = json.load(f)
+        self.positions = self.experiment_metadata['positions'] # dict mapping names to (x,y,z) stage positions
+        self.skip_positions = set(self.experiment_metadata.setdefault('skip_positions', []))
+
+    def _connect_scope(self):
+        from .. import scope_client
+        self.scope, self.scope_properties = scope_client.client_main(self.scope_host)
+
+    def reset_scope(self):
+        """Prepare the scope for a timepoint run by a worker process (see main())
+        as a newly started process would find it: reconnect if the scope server
+        has stopped answering on the existing connection (e.g. because it was
+        restarted since the last timepoint), and return the camera to its default
+        state."""
+        if self.scope is None:
+            return
+        import zmq
+        rpc_client = self.scope._rpc_client
+        rpc_client.socket.RCVTIMEO = int(self.SCOPE_CHECK_TIMEOUT * 1000)
+        try:
+            rpc_client('__DESCRIBE__')
+            stale = False
+        except zmq.Again:
+            stale = True
+        finally:
+            rpc_client.socket.RCVTIMEO = -1
+        if stale:
+            self.logger.warning('Scope server not responding: reconnecting.')
+            # closes all the sockets of the old connection, which share its context
+            rpc_client.context.destroy(linger=0)
+            self._connect_scope()
+        if hasattr(self.scope, 'camera'):
+            self.scope.camera.return_to_default_state()
 
     def run_timepoint(self, scheduled_start):
         try:
@@ -99,6 +160,8 @@ class TimepointHandler:
             self.scheduled_start = scheduled_start
             self.start_time = time.time()
             self._job_futures = []
+            self._position_futures = []
+            self._metadata_futures = []
             self.logger.info('Starting timepoint {} ({:.0f} minutes after scheduled)', self.timepoint_prefix,
                 (self.start_time-self.scheduled_start)/60)
             # record the timepoint prefix and timestamp for this timepoint into the
@@ -106,11 +169,16 @@ class TimepointHandler:
             self.experiment_metadata.setdefault('timepoints', []).append(self.timepoint_prefix)
             self.experiment_metadata.setdefault('timestamps', []).append(self.start_time)
             self.configure_timepoint()
-            for position_name, position_coords in sorted(self.positions.items()):
-                if position_name not in self.skip_positions:
-                    self.run_position(position_name, position_coords)
+            for position_name in self.get_position_order():
+                self.run_position(position_name, self.positions[position_name])
+            self._wait_for_positions(0)
             self.experiment_metadata['skip_positions'] = list(self.skip_positions)
             self.finalize_timepoint()
+            t0 = time.time()
+            self.image_io.flush() # make sure all images are on disk before the metadata says they are
+            futures.wait(self._metadata_futures)
+            [f.result() for f in self._metadata_futures]
+            self.logger.debug('Finished saving images ({:.1f} seconds)', time.time()-t0)
             self.end_time = time.time()
             self.experiment_metadata.setdefault('durations', []).append(self.end_time - self.start_time)
             if self.write_files:
@@ -166,22 +234,63 @@ class TimepointHandler:
         scheduled. Returning None means no future runs will be scheduled."""
         return None
 
+    def get_position_order(self):
+        """Return the names of the positions to acquire (i.e. those not skipped),
+        in the order given by the POSITION_ORDER attribute. The order is stored
+        in the experiment metadata and reused until the set of positions changes."""
+        names = sorted(self.positions.keys() - self.skip_positions)
+        method = self.POSITION_ORDER
+        if method == 'name' or len(names) < 3:
+            return names
+        cached = self.experiment_metadata.get('position_order')
+        if cached is not None and cached['method'] == method and sorted(cached['order']) == names:
+            return cached['order']
+        t0 = time.time()
+        coords = [self.positions[name] for name in names]
+        if method == 'serpentine':
+            order = position_order.serpentine_order(coords, self.SERPENTINE_ROW_TOLERANCE)
+        elif method == 'shortest':
+            if self.scope is not None:
+                costs = self.scope.stage.calculate_movement_times(coords)
+            else:
+                costs = position_order.chebyshev_distances(coords)
+            order = position_order.tsp_order(costs)
+        else:
+            raise ValueError('Unknown POSITION_ORDER: {}'.format(method))
+        ordered_names = [names[i] for i in order]
+        self.experiment_metadata['position_order'] = dict(method=method, order=ordered_names)
+        self.logger.debug('Computed {} position order ({:.1f} seconds)', method, time.time()-t0)
+        return ordered_names
+
+    def process_images(self, position_name, position_dir, position_metadata, images, new_metadata):
+        """Override this method to post-process the images returned by
+        acquire_images() (e.g. dark-current correction, or deciding whether to
+        skip the position in the future) before they are saved. Return the list
+        of images to save. The new_metadata dict may also be updated in-place.
+
+        This runs in a background thread while the next position is being
+        acquired, so it must NOT use self.scope. Positions are processed one at
+        a time, in the order in which they were acquired.
+
+        Parameters are as for acquire_images(), plus the images and the
+        new_metadata dict it returned."""
+        return images
+
     def run_position(self, position_name, position_coords):
         """Do everything required for taking a timepoint at a single position
         EXCEPT focusing / image acquisition. This includes moving the stage to
         the right x,y position, loading and saving metadata, and saving image
-        data, as generated by acquire_images()"""
+        data, as generated by acquire_images().
+
+        Once the images are acquired, processing and saving them is handed off
+        to a background thread (see process_images()) so that the stage can move
+        on to the next position immediately."""
         self.logger.info('Acquiring Position: {}', position_name)
         t0 = time.time()
         position_dir = self.data_dir / position_name
         if not position_dir.exists():
             position_dir.mkdir()
-        metadata_path = position_dir / 'position_metadata.json'
-        if metadata_path.exists():
-            with metadata_path.open('r') as f:
-                position_metadata = json.load(f)
-        else:
-            position_metadata = []
+        position_metadata = position_metadata_log.PositionMetadata(position_dir)
         timestamp = time.time()
 
         if self.scope is not None:
@@ -192,19 +301,39 @@ class TimepointHandler:
             position_metadata)
         t2 = time.time()
         self.logger.debug('{} Images Acquired ({:.1f} seconds)', len(images), t2-t1)
-        image_paths = [position_dir / (self.timepoint_prefix + ' ' + name) for name in image_names]
         if new_metadata is None:
             new_metadata = {}
         new_metadata['timestamp'] = timestamp
         new_metadata['timepoint'] = self.timepoint_prefix
-        position_metadata.append(new_metadata)
-        if self.write_files:
-            self.image_io.write(images, image_paths, self.IMAGE_COMPRESSION)
-            self._write_atomic_json(metadata_path, position_metadata)
+        self._wait_for_positions(self.MAX_PENDING_POSITIONS - 1)
+        self._position_futures.append(self._position_thread.submit(self._finish_position, position_name,
+            position_dir, position_metadata, images, image_names, new_metadata))
         t3 = time.time()
-        self.logger.debug('Images saved ({:.1f} seconds)', t3-t2)
         self.logger.debug('Position done (total: {:.1f} seconds)', t3-t0)
 
+    def _finish_position(self, position_name, position_dir, position_metadata, images, image_names, new_metadata):
+        t0 = time.time()
+        images = self.process_images(position_name, position_dir, position_metadata, images, new_metadata)
+        image_paths = [position_dir / (self.timepoint_prefix + ' ' + name) for name in image_names]
+        if self.write_files:
+            writes = self.image_io.write_async(images, image_paths, self.IMAGE_COMPRESSION)
+            self._metadata_futures.append(self._metadata_thread.submit(self._append_position_metadata,
+                position_metadata, new_metadata, writes))
+        self.logger.debug('{} images processed and queued for saving ({:.1f} seconds)', position_name, time.time()-t0)
+
+    def _append_position_metadata(self, position_metadata, new_metadata, writes):
+        """Record a position's metadata for this timepoint once all its images
+        have been written, so that the metadata never lists missing images."""
+        futures.wait(writes)
+        [f.result() for f in writes] # if any write failed, raise instead of recording the timepoint
+        position_metadata.append(new_metadata)
+
+    def _wait_for_positions(self, max_pending):
+        """Wait until no more than max_pending positions are still being processed,
+        raising any error encountered while processing the finished positions."""
+        while len(self._position_futures) > max_pending:
+            self._position_futures.pop(0).result()
+
     def _write_atomic_json(self, out_path, data):  
         out_path = pathlib.Path(out_path)
         tmp_path = out_path.parent / (out_path.name + '-' +self.timepoint_prefix)
@@ -260,6 +389,14 @@ class TimepointHandler:
 
         e.g. this allows the following usage: ./acquire.py --dry-run=True --log-level=logging.DEBUG
 
+        If started by the job runner as a worker process, with the argument
+        --job-worker (see util.job_worker), the handler is instead created once
+        and then runs a timepoint for each request from the job runner, reusing
+        its imports, scope connection, and so forth. Before each timepoint, the
+        experiment metadata are re-read and the scope is reset (see
+        reset_scope()). The worker exits if a timepoint fails or if the file
+        defining the class is modified, and the job runner then starts afresh.
+
         Parameters:
             timepoint_dir: location of timepoint directory. If not specified, default
                 to the parent dir of the file that defines the class that this
@@ -269,8 +406,11 @@ class TimepointHandler:
         if timepoint_dir is None:
             timepoint_dir = pathlib.Path(inspect.getfile(cls)).parent
         scheduled_start = None
+        worker = False
         for arg in sys.argv[1:]:
-            if arg.count('='):
+            if arg == job_worker.WORKER_ARG:
+                worker = True
+            elif arg.count('='):
                 while arg.startswith('-'):
                     arg = arg[1:]
                 arg = arg.replace('-', '_')
@@ -282,6 +422,17 @@ class TimepointHandler:
             else:
                 raise ValueError('More than one schedule start time provided')
 
+        if worker:
+            worker_socket = job_worker.get_worker_socket()
+            if worker_socket is None:
+                raise ValueError('{} given, but no worker socket specified'.format(job_worker.WORKER_ARG))
+            handler = cls(timepoint_dir, **cls_init_args)
+            def run_timepoint(scheduled_start):
+                handler.load_experiment_metadata()
+                handler.reset_scope()
+                return handler.run_timepoint(scheduled_start)
+            job_worker.serve(run_timepoint, worker_socket, watch_paths=[inspect.getfile(cls)])
+            return
         if scheduled_start is None:
             scheduled_start = time.time()
         handler = cls(timepoint_dir, **cls_init_args)
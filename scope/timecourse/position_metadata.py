@@ -0,0 +1,160 @@
+"""Append-only storage of the per-timepoint metadata for each position.
+
+Each position directory may contain:
+    position_metadata.json: a (legible) JSON list of metadata dicts, one per
+        timepoint, as written by compact_position_metadata() (or by older
+        versions of the timecourse handler, which rewrote the whole list for
+        every timepoint).
+    position_metadata.jsonl: metadata dicts for subsequent timepoints, one
+        compact JSON object per line, appended as each timepoint is acquired.
+Together these give the full chronological list. Appending costs the same no
+matter how long the experiment has run, and the most recent entries (e.g. the
+last focus position) are read from the end of the log without reading the
+whole file.
+
+To fold the logs back into a single position_metadata.json for each position
+(e.g. before analysis), run:
+    python -m scope.timecourse.position_metadata /path/to/data_dir
+"""
+
+import collections.abc
+import json
+import os
+import pathlib
+
+from ..util import json_encode
+
+COMPACT_FILE = 'position_metadata.json'
+LOG_FILE = 'position_metadata.jsonl'
+
+class PositionMetadata(collections.abc.Sequence):
+    """Read-only list-like view of the metadata for one position, plus an
+    append() method to add the entry for a new timepoint.
+
+    Negative indices and slices at the end of the list (e.g. metadata[-1] or
+    metadata[-5:]) are read lazily from the tail of the log file. Any other
+    access reads (and caches) the full list."""
+
+    # read the log tail in blocks of this many bytes
+    TAIL_BLOCK_SIZE = 16384
+
+    def __init__(self, position_dir):
+        position_dir = pathlib.Path(position_dir)
+        self.compact_path = position_dir / COMPACT_FILE
+        self.log_path = position_dir / LOG_FILE
+        self._entries = None
+
+    def _read_compact(self):
+        if not self.compact_path.exists():
+            return []
+        with self.compact_path.open('r') as f:
+            return json.load(f)
+
+    def _read_log_tail(self, count):
+        """Return up to the last count complete entries in the log file."""
+        if not self.log_path.exists():
+            return []
+        with self.log_path.open('rb') as f:
+            position = f.seek(0, os.SEEK_END)
+            data = b''
+            # count+1 newlines guarantees count complete lines (a partial final
+            # line from an interrupted append has no trailing newline)
+            while position > 0 and data.count(b'\n') <= count:
+                block_size = min(self.TAIL_BLOCK_SIZE, position)
+                position -= block_size
+                f.seek(position)
+                data = f.read(block_size) + data
+        lines = data.split(b'\n')[:-1] # drop any partial final line
+        if position > 0:
+            lines = lines[1:] # the first line is probably incomplete
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line.decode('utf8')))
+            except ValueError:
+                pass # the remains of an interrupted append (see append())
+        return entries[-count:]
+
+    def _all_entries(self):
+        if self._entries is None:
+            entries = self._read_compact()
+            if self.log_path.exists():
+                # entries are unique by timepoint: if a compaction was interrupted
+                # after the compact file was written, the log may repeat some
+                compacted = {entry.get('timepoint') for entry in entries}
+                for entry in self._read_log_tail(self.log_path.stat().st_size):
+                    if entry.get('timepoint') not in compacted:
+                        entries.append(entry)
+            self._entries = entries
+        return self._entries
+
+    def __len__(self):
+        return len(self._all_entries())
+
+    def __bool__(self):
+        if self._entries is not None:
+            return bool(self._entries)
+        if self.log_path.exists() and self.log_path.stat().st_size > 0:
+            return True
+        return bool(self._read_compact())
+
+    def __getitem__(self, index):
+        if self._entries is None:
+            # metadata[-n] and metadata[-n:] can be read from the tail of the log
+            if isinstance(index, int) and index < 0:
+                tail = self._read_log_tail(-index)
+                if len(tail) == -index:
+                    return tail[index]
+            elif isinstance(index, slice) and index.start is not None and index.start < 0 and index.stop is None and index.step is None:
+                tail = self._read_log_tail(-index.start)
+                if len(tail) == -index.start:
+                    return tail
+        return self._all_entries()[index]
+
+    def append(self, entry):
+        """Append the metadata dict for a new timepoint to the log. The entry is
+        written with a single write() to the end of the file, so a reader never
+        sees a partially-written entry as valid."""
+        line = json_encode.encode_compact_to_bytes(entry) + b'\n'
+        fd = os.open(str(self.log_path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size > 0:
+                with self.log_path.open('rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        # a previous append was interrupted: terminate the partial line
+                        line = b'\n' + line
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        if self._entries is not None:
+            self._entries.append(entry)
+
+    def compact(self):
+        """Rewrite the full list of entries as the compact (legible JSON) file,
+        and remove the log. Must not be run while the position is being acquired."""
+        entries = self._all_entries()
+        tmp_path = self.compact_path.with_suffix('.json-compacting')
+        with tmp_path.open('w') as f:
+            json_encode.encode_legible_to_file(entries, f)
+        os.replace(str(tmp_path), str(self.compact_path))
+        if self.log_path.exists():
+            self.log_path.unlink()
+
+def compact_position_metadata(data_dir):
+    """Compact the position metadata logs for every position directory in an
+    experiment's data_dir. Returns the names of the positions compacted."""
+    data_dir = pathlib.Path(data_dir)
+    compacted = []
+    for log_path in sorted(data_dir.glob('*/' + LOG_FILE)):
+        PositionMetadata(log_path.parent).compact()
+        compacted.append(log_path.parent.name)
+    return compacted
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='compact timecourse position metadata logs into position_metadata.json files')
+    parser.add_argument('data_dir', help='timecourse experiment directory')
+    args = parser.parse_args()
+    compacted = compact_position_metadata(args.data_dir)
+    print('Compacted metadata for {} positions'.format(len(compacted)))
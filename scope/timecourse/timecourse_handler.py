@@ -29,6 +29,7 @@ import time
 from . import base_handler
 from ..client_util import autofocus
 from ..client_util import calibrate
+from ..client_util import focus_prediction
 
 from ..util.threaded_image_io import COMPRESSION
 
@@ -87,6 +88,13 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
     FINE_FOCUS_STEPS = 75
     PIXEL_READOUT_RATE = '100 MHz'
     USE_LAST_FOCUS_POSITION = True
+    # If USE_FOCUS_PREDICTION is True, once a position has enough focus history,
+    # its focus is predicted from the history (and the focus changes seen at
+    # the positions already visited this timepoint). If the focus is predicted
+    # to within FOCUS_PREDICTION_SIGMAS standard deviations inside the fine
+    # focus range, only a narrower fine autofocus is run.
+    USE_FOCUS_PREDICTION = True
+    FOCUS_PREDICTION_SIGMAS = 4
     INTERVAL_MODE = 'scheduled start'
     IMAGE_COMPRESSION = COMPRESSION.DEFAULT # useful options include PNG_FAST, PNG_NONE, TIFF_NONE
     LOG_LEVEL = logging.INFO
@@ -95,6 +103,13 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
     TL_APERTURE_DIAPHRAGM = None
     IL_FIELD_WHEEL = None
     VIGNETTE_PERCENT = 5 # 5 is a good number when using a 1x optocoupler. If 0.7x, use 35.
+    # Dark-current calibrations are cached and reused between timepoints until
+    # they are older than the given number of hours or the sensor temperature
+    # has drifted by more than the given number of degrees C. By default, the
+    # cache is in the 'calibrations/dark_current' subdirectory of the data directory.
+    DARK_CALIBRATION_MAX_AGE_HOURS = 24
+    DARK_CALIBRATION_MAX_TEMPERATURE_DRIFT = 1
+    DARK_CALIBRATION_DIR = None
 
     def configure_additional_acquisition_steps(self):
         """Add more steps to the acquisition_sequencer's sequence as desired,
@@ -165,16 +180,27 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
         self.scope.camera.readout_rate = self.PIXEL_READOUT_RATE
         self.scope.camera.shutter_mode = 'Rolling'
         self.configure_calibrations() # sets self.bf_exposure and self.tl_intensity
+        self.focus_predictor = focus_prediction.FocusPredictor()
         self.scope.camera.acquisition_sequencer.new_sequence() # internally sets all spectra x intensities to 255, unless specified here
         self.scope.camera.acquisition_sequencer.add_step(exposure_ms=self.bf_exposure,
             lamp='TL', tl_intensity=self.tl_intensity)
         self.image_names = ['bf.png']
         self.configure_additional_acquisition_steps()
+        self.exposures = self.scope.camera.acquisition_sequencer.exposure_times
         t1 = time.time()
         self.logger.debug('Configuration done ({:.1f} seconds)', t1-t0)
 
     def configure_calibrations(self):
-        self.dark_corrector = calibrate.DarkCurrentCorrector(self.scope)
+        if self.write_files:
+            dark_calibration_dir = self.DARK_CALIBRATION_DIR
+            if dark_calibration_dir is None:
+                dark_calibration_dir = self.data_dir / 'calibrations' / 'dark_current'
+            dark_calibration_cache = calibrate.DarkCalibrationCache(dark_calibration_dir,
+                self.DARK_CALIBRATION_MAX_AGE_HOURS, self.DARK_CALIBRATION_MAX_TEMPERATURE_DRIFT)
+            self.dark_corrector, is_new = dark_calibration_cache.get_corrector(self.scope)
+            self.logger.debug('{} dark-current calibration', 'Acquired new' if is_new else 'Reused cached')
+        else:
+            self.dark_corrector = calibrate.DarkCurrentCorrector(self.scope)
         ref_positions = self.experiment_metadata['reference_positions']
 
         # go to a data-acquisition position and figure out the right brightfield exposure
@@ -256,23 +282,32 @@ class BasicAcquisitionHandler(base_handler.TimepointHandler):
         else:
             z_start = self.positions[position_name][2]
         z_max = self.experiment_metadata['z_max']
+        position_coords = self.positions[position_name]
+        if self.USE_FOCUS_PREDICTION:
+            predicted_z, uncertainty = self.focus_predictor.predict(position_coords, position_metadata, t0)
+        else:
+            predicted_z, uncertainty = None, None
         self.scope.camera.exposure_time = self.bf_exposure
         self.scope.tl.lamp.intensity = self.tl_intensity
-        with scope.tl.lamp.in_state(enabled=True), scope.stage.in_state(z_speed=1):
-            coarse_z, fine_z = autofocus.coarse_fine_autofocus(self.scope, z_start, z_max,
+        with self.scope.tl.lamp.in_state(enabled=True), self.scope.stage.in_state(z_speed=1):
+            coarse_z, fine_z = autofocus.predicted_autofocus(self.scope, z_start, predicted_z, uncertainty, z_max,
                 self.COARSE_FOCUS_RANGE, self.COARSE_FOCUS_STEPS,
-                self.FINE_FOCUS_RANGE, self.FINE_FOCUS_STEPS)
+                self.FINE_FOCUS_RANGE, self.FINE_FOCUS_STEPS, sigmas=self.FOCUS_PREDICTION_SIGMAS)
+        self.focus_predictor.record(position_coords, predicted_z, fine_z)
         t1 = time.time()
-        self.logger.debug('Autofocused ({:.1f} seconds)', t1-t0)
-        self.logger.info('Autofocus z: {}', fine_z)
+        self.logger.debug('Autofocused ({:.1f} seconds{})', t1-t0, '' if coarse_z is None else ', with coarse pass')
+        self.logger.info('Autofocus z: {} (predicted: {})', fine_z, predicted_z)
         images = self.scope.camera.acquisition_sequencer.run()
         t2 = time.time()
         self.logger.debug('Acquisition sequence run ({:.1f} seconds)', t2-t1)
-        exposures = self.scope.camera.acquisition_sequencer.exposure_times
-        images = [self.dark_corrector.correct(image, exposure) for image, exposure in zip(images, exposures)]
         timestamps = numpy.array(self.scope.camera.acquisition_sequencer.latest_timestamps)
         timestamps = (timestamps - timestamps[0]) / self.scope.camera.timestamp_hz
-        metadata = dict(coarse_z=coarse_z, fine_z=fine_z, image_timestamps=dict(zip(self.image_names, timestamps)))
-        if self.should_skip(position_dir, position_metadata, images):
-            self.skip_positions.append(position_name)
+        metadata = dict(coarse_z=coarse_z, fine_z=fine_z, predicted_z=predicted_z, image_timestamps=dict(zip(self.image_names, timestamps)))
         return images, self.image_names, metadata
+
+    def process_images(self, position_name, position_dir, position_metadata, images, new_metadata):
+        # runs in a background thread while the stage moves to the next position
+        images = [self.dark_corrector.correct(image, exposure) for image, exposure in zip(images, self.exposures)]
+        if self.should_skip(position_dir, position_metadata, images):
+            self.skip_positions.add(position_name)
+        return images
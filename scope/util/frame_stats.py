@@ -0,0 +1,159 @@
+"""Histogram-based statistics of integer-valued camera frames.
+
+Finding an order statistic with numpy.partition copies and partially sorts the
+whole frame, and each additional rank costs another pass. Camera frames are
+uint16 with a known bit depth, so a single bincount pass gives the full
+histogram of the frame, and a cumulative sum of that histogram answers any
+number of order statistics, quantiles, and saturation counts by a binary search
+over at most 65536 entries.
+
+Other images (e.g. float32 averages of several frames) cannot be histogrammed
+this way: frame_statistics() returns a PartitionStatistics object, with the
+same interface, for those.
+"""
+
+import time
+import numpy
+
+class FrameHistogram:
+    def __init__(self, image, bit_depth=16):
+        """Compute the histogram of an unsigned integer image.
+
+        Parameters:
+            image: unsigned integer image array (of any memory order).
+            bit_depth: the number of significant bits per pixel. The histogram
+                will have at least 2**bit_depth bins (more if any pixel has a
+                larger value).
+        """
+        self.bit_depth = bit_depth
+        self.size = image.size
+        # reshape with order='A' so that Fortran-ordered frames are not copied
+        self.counts = numpy.bincount(image.reshape(-1, order='A'), minlength=2**bit_depth)
+        self.cumulative_counts = numpy.cumsum(self.counts)
+
+    def order_statistic(self, k):
+        """Return the k-th smallest pixel value (k=0 is the minimum). Negative k
+        counts from the largest value, so -1 is the maximum. If k is a list or
+        array of ranks, an array of values is returned."""
+        k = numpy.asarray(k)
+        k = numpy.where(k < 0, k + self.size, k)
+        if numpy.any((k < 0) | (k >= self.size)):
+            raise IndexError('rank out of range for image of {} pixels'.format(self.size))
+        # the k-th smallest value is the first whose cumulative count exceeds k
+        values = numpy.searchsorted(self.cumulative_counts, k, side='right')
+        return values if values.ndim else int(values)
+
+    def quantile(self, q):
+        """Return the pixel value of rank int(q * image.size) for q in [0, 1]
+        (or for each q in a list). This is the same non-interpolated definition
+        used by calibrate.meter_exposure()."""
+        k = numpy.minimum((numpy.asarray(q) * self.size).astype(numpy.intp), self.size - 1)
+        return self.order_statistic(k)
+
+    def percentile(self, p):
+        """Return the pixel value at percentile p in [0, 100] (or for each p in a
+        list), as in quantile()."""
+        return self.quantile(numpy.asarray(p) / 100)
+
+    def saturated_count(self, level=None):
+        """Return the number of pixels at or above the given level (by default,
+        the largest value representable at the histogram's bit depth)."""
+        if level is None:
+            level = 2**self.bit_depth - 1
+        if level <= 0:
+            return self.size
+        return int(self.size - self.cumulative_counts[min(level, len(self.counts)) - 1])
+
+    def binned(self, bins):
+        """Return the histogram of the first 2**bit_depth values, summed into the
+        given number of equal-width bins (which must divide 2**bit_depth)."""
+        total = 2**self.bit_depth
+        if bins < 1 or total % bins:
+            raise ValueError('bins must be a power of two no greater than {}'.format(total))
+        return self.counts[:total].reshape((bins, -1)).sum(axis=1)
+
+    @property
+    def min(self):
+        return self.order_statistic(0)
+
+    @property
+    def max(self):
+        return self.order_statistic(-1)
+
+    @property
+    def mean(self):
+        return float(numpy.dot(self.counts, numpy.arange(len(self.counts))) / self.size)
+
+class PartitionStatistics:
+    def __init__(self, image):
+        """Provide the FrameHistogram interface for an image of any numeric
+        type, computing order statistics with numpy.partition."""
+        self.image = image
+        self.size = image.size
+
+    def order_statistic(self, k):
+        """Return the k-th smallest pixel value, as FrameHistogram.order_statistic()."""
+        k = numpy.asarray(k)
+        k = numpy.where(k < 0, k + self.size, k)
+        if numpy.any((k < 0) | (k >= self.size)):
+            raise IndexError('rank out of range for image of {} pixels'.format(self.size))
+        # a single partial sort finds all the requested ranks at once
+        values = numpy.partition(self.image, numpy.unique(k), axis=None)[k]
+        return values if values.ndim else values.item()
+
+    def quantile(self, q):
+        """Return the pixel value of rank int(q * image.size), as FrameHistogram.quantile()."""
+        k = numpy.minimum((numpy.asarray(q) * self.size).astype(numpy.intp), self.size - 1)
+        return self.order_statistic(k)
+
+    def percentile(self, p):
+        return self.quantile(numpy.asarray(p) / 100)
+
+    def saturated_count(self, level=2**16-1):
+        """Return the number of pixels at or above the given level."""
+        return int(numpy.count_nonzero(self.image >= level))
+
+    def binned(self, bins):
+        """Return the histogram of pixel values in [0, 65536), counted into the
+        given number of equal-width bins (which must divide 65536)."""
+        if bins < 1 or 2**16 % bins:
+            raise ValueError('bins must be a power of two no greater than {}'.format(2**16))
+        return numpy.histogram(self.image, bins, range=(0, 2**16))[0]
+
+    @property
+    def min(self):
+        return self.image.min().item()
+
+    @property
+    def max(self):
+        return self.image.max().item()
+
+    @property
+    def mean(self):
+        return float(self.image.mean())
+
+def frame_statistics(image, bit_depth=16):
+    """Return a FrameHistogram for an unsigned integer image of at most
+    bit_depth bits per pixel, or else a PartitionStatistics object."""
+    if image.dtype.kind == 'u' and image.dtype.itemsize * 8 <= bit_depth:
+        return FrameHistogram(image, bit_depth)
+    return PartitionStatistics(image)
+
+def benchmark_order_statistics(width=2560, height=2160, bit_depth=16, iterations=10):
+    """Compare finding the maximum (ignoring 11 hot pixels) and the 95th
+    percentile of a frame, as calibrate.meter_exposure() does, with two calls to
+    numpy.partition versus a single FrameHistogram. The results are checked
+    against each other. Returns a dict of mean ms per frame."""
+    image = numpy.random.randint(0, 2**bit_depth, size=(width, height)).astype(numpy.uint16)
+    image = numpy.asfortranarray(image)
+    ranks = [-12, int(image.size * 0.95)]
+    t = time.perf_counter()
+    for i in range(iterations):
+        partitioned = [numpy.partition(image, k, axis=None)[k] for k in ranks]
+    partition_ms = 1000 * (time.perf_counter() - t) / iterations
+    t = time.perf_counter()
+    for i in range(iterations):
+        histogram = FrameHistogram(image, bit_depth).order_statistic(ranks)
+    histogram_ms = 1000 * (time.perf_counter() - t) / iterations
+    assert list(histogram) == partitioned
+    return dict(partition=partition_ms, histogram=histogram_ms)
@@ -0,0 +1,94 @@
+"""Measure the import time of the client and server entry points, and check it
+against a budget. With Python 3.7 and later, the interpreter's own import
+profiler (python -X importtime) gives the time and a per-module breakdown.
+Older versions silently ignore -X importtime, so there the time is instead the
+wall-clock time to run `python -c "import module"`, less the time to start a
+bare interpreter (the best of several runs of each).
+
+Each module is imported in a fresh interpreter, so nothing is already cached.
+To check all the budgets, and list the slowest imports of any module over
+budget, run:
+    python -m scope.util.import_timing
+which exits with a nonzero status if any budget is exceeded.
+"""
+
+import subprocess
+import sys
+import time
+
+# maximum cumulative import time, in seconds, for entry points whose users
+# should not have to wait for the device and analysis modules to load
+IMPORT_TIME_BUDGETS = {
+    'scope.scope_client': 0.5,
+    'scope.scope_server': 0.3, # as used by `scope_server status` and `stop`
+    'scope.cli.scope_daemon': 0.3,
+    'scope.cli.scope_job_daemon': 0.3,
+}
+
+def measure_import_time(module_name):
+    """Import a module in a new interpreter, and return the total import time
+    in seconds, and a list of (cumulative seconds, module name) for every
+    module imported, slowest first. (Without -X importtime support, the list is
+    empty.)"""
+    if sys.version_info < (3, 7):
+        return _wall_clock_import_time(module_name), []
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module_name],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('Could not import {}:\n{}'.format(module_name, result.stderr))
+    total = 0
+    times = []
+    for line in result.stderr.splitlines():
+        # lines look like: "import time:  self [us] | cumulative | imported package"
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue # the header line
+        name = fields[2].rstrip()
+        # nested imports are indented by two spaces per level
+        if len(name) - len(name.lstrip()) == 1:
+            total += cumulative / 1e6
+        times.append((cumulative / 1e6, name.strip()))
+    if not times:
+        raise RuntimeError('No import timing information from python -X importtime')
+    times.sort(reverse=True)
+    return total, times
+
+def _run_time(code, repeats):
+    """Return the shortest wall-clock time to run the given code in a new interpreter."""
+    best = float('inf')
+    for i in range(repeats):
+        t = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, universal_newlines=True)
+        elapsed = time.perf_counter() - t
+        if result.returncode != 0:
+            raise RuntimeError('Could not run {!r}:\n{}'.format(code, result.stderr))
+        best = min(best, elapsed)
+    return best
+
+def _wall_clock_import_time(module_name, repeats=5):
+    """Return the time to import a module in a new interpreter, as the difference
+    between the wall-clock times to run an interpreter that imports it and one
+    that does nothing."""
+    return max(_run_time('import ' + module_name, repeats) - _run_time('pass', repeats), 0)
+
+def check_import_budgets(budgets=IMPORT_TIME_BUDGETS, show_slowest=10):
+    """Measure the import time of each module in the budgets dict, and print
+    the results. Return a list of the modules that were over budget."""
+    over_budget = []
+    for module_name, budget in sorted(budgets.items()):
+        total, times = measure_import_time(module_name)
+        ok = total <= budget
+        print('{}: {:.3f} s (budget {:.3f} s){}'.format(module_name, total, budget, '' if ok else ' OVER BUDGET'))
+        if not ok:
+            over_budget.append(module_name)
+            for seconds, name in times[:show_slowest]:
+                print('    {:.3f} s  {}'.format(seconds, name))
+    return over_budget
+
+if __name__ == '__main__':
+    sys.exit(1 if check_import_budgets() else 0)
@@ -0,0 +1,133 @@
+"""Long-lived worker processes for jobs run repeatedly by the job runner.
+
+Normally each run of a job is a fresh `python exec_file scheduled_start`
+process, which must re-import everything, reconnect to the scope server, and
+re-read its configuration before doing any work. A job script that supports
+worker mode can instead be started once as `python exec_file --job-worker`
+(WORKER_ARG), with the WORKER_SOCKET_ENV environment variable set to the path
+of a unix socket: it does its setup, calls serve(), and then runs each
+subsequent request from request_run() in the same process. (A script that does
+not support worker mode will reject the --job-worker argument, rather than
+mistaking it for a request to run.)
+
+Protocol: one request per connection. The client sends a JSON line
+{"scheduled_start": t}, and the worker replies with a JSON line that is one of:
+    {"next_run_time": t or null}: the run completed.
+    {"error": text}: the run raised an exception (the worker then exits, so
+        that the next run starts from a clean process).
+    {"stale": true}: the job script has changed since the worker started, so
+        the worker exits without running anything.
+"""
+
+import json
+import os
+import pathlib
+import socket
+import traceback
+
+WORKER_SOCKET_ENV = 'SCOPE_JOB_WORKER_SOCKET'
+WORKER_ARG = '--job-worker'
+
+class WorkerUnavailable(Exception):
+    """The worker could not be reached, or declined the request. Nothing was run."""
+    pass
+
+class WorkerError(Exception):
+    """The run failed, or the worker died while running it."""
+    pass
+
+def get_worker_socket():
+    """Return the socket path this process should serve on, or None if it was
+    not started as a worker."""
+    return os.environ.get(WORKER_SOCKET_ENV)
+
+def _send(connection, message):
+    connection.sendall(json.dumps(message).encode('utf8') + b'\n')
+
+def _receive(connection):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(4096)
+        if not chunk:
+            return None
+        data += chunk
+    return json.loads(data.decode('utf8'))
+
+def serve(run, socket_path, watch_paths=(), check_interval=60):
+    """Serve run requests until a run fails, a watched file changes, or the
+    parent process (the job runner) exits.
+
+    Parameters:
+        run: function to call with the scheduled_start time of each request,
+            which returns the next run time (or None).
+        socket_path: path of the unix socket to listen on.
+        watch_paths: files (e.g. the job script) that, if modified, make the
+            worker exit rather than run stale code.
+        check_interval: how often, in seconds, to check whether the parent
+            process is still alive while waiting for requests.
+    """
+    socket_path = pathlib.Path(socket_path)
+    parent_pid = os.getppid()
+    watch_mtimes = {pathlib.Path(path): pathlib.Path(path).stat().st_mtime_ns for path in watch_paths}
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # bind to a temporary name and then rename, so that clients never see a
+    # socket that is not yet listening
+    tmp_path = socket_path.with_name(socket_path.name + '-starting')
+    if tmp_path.exists():
+        tmp_path.unlink()
+    listener.bind(str(tmp_path))
+    listener.listen(1)
+    listener.settimeout(check_interval)
+    os.replace(str(tmp_path), str(socket_path))
+    try:
+        while True:
+            try:
+                connection, address = listener.accept()
+            except socket.timeout:
+                if os.getppid() != parent_pid:
+                    return
+                continue
+            with connection:
+                connection.settimeout(None)
+                request = _receive(connection)
+                if request is None:
+                    continue
+                if any(path.stat().st_mtime_ns != mtime for path, mtime in watch_mtimes.items()):
+                    _send(connection, dict(stale=True))
+                    return
+                try:
+                    next_run_time = run(request['scheduled_start'])
+                except Exception:
+                    _send(connection, dict(error=traceback.format_exc()))
+                    return
+                _send(connection, dict(next_run_time=next_run_time))
+    finally:
+        listener.close()
+        if socket_path.exists():
+            socket_path.unlink()
+
+def request_run(socket_path, scheduled_start):
+    """Ask the worker listening at socket_path to run, and wait for the run to
+    complete. Return the next run time (or None).
+
+    Raises WorkerUnavailable if the worker could not be reached or would not run
+    (in which case the job may safely be run some other way), or WorkerError if
+    the run failed."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with connection:
+        try:
+            connection.connect(str(socket_path))
+            _send(connection, dict(scheduled_start=scheduled_start))
+        except OSError as e:
+            raise WorkerUnavailable('Could not contact worker at {}: {}'.format(socket_path, e))
+        try:
+            reply = _receive(connection)
+        except OSError as e:
+            raise WorkerError('Lost contact with worker during run: {}'.format(e))
+    if reply is None:
+        raise WorkerError('Worker exited during run.')
+    if reply.get('stale'):
+        raise WorkerUnavailable('Worker is out of date.')
+    if 'error' in reply:
+        raise WorkerError(reply['error'])
+    return reply['next_run_time']
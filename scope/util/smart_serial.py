@@ -46,10 +46,15 @@ class Serial(serialposix.Serial):
     Instead, the next time the read function is called, the data already
     read in will still be there.
     (3) A read_until() command is provided that reads from the serial port
-    until some string is matched.
+    until some string is matched, and a read_frames() command is provided
+    that returns all complete terminator-delimited frames available at once.
+
+    Incoming data are accumulated in a bytearray, so that appending new data
+    and consuming data from the front of the buffer do not copy the entire
+    pending buffer each time.
     """
     def __init__(self, port, baudrate=9600, timeout=None, **kwargs):
-        self.read_buffer = b''
+        self.read_buffer = bytearray()
         super().__init__(port, baudrate=baudrate, timeout=timeout, **kwargs)
 
     def inWaiting(self):
@@ -66,13 +71,7 @@ class Serial(serialposix.Serial):
            calls."""
         if not self.isOpen(): raise serialposix.portNotOpenError
         if len(self.read_buffer) > size:
-            read_buffer = self.read_buffer
-            try:
-                self.read_buffer = read_buffer[size:]
-                return read_buffer[:size]
-            except KeyboardInterrupt as k:
-                self.read_buffer = read_buffer
-                raise k
+            return self._consume(size)
         while len(self.read_buffer) < size:
             try:
                 ready,_,_ = select.select([self.fd],[],[], self.timeout)
@@ -102,13 +101,50 @@ class Serial(serialposix.Serial):
                 if e.errno != errno.EAGAIN:
                     raise SerialException('read failed: %s' % (e,))
 
-        read_buffer = self.read_buffer
+        return self._consume(len(self.read_buffer))
+
+    def _consume(self, size):
+        """Remove and return the first 'size' bytes of the read buffer."""
+        data = bytes(self.read_buffer[:size])
+        # If interrupted before the deletion, the data remain in the buffer for
+        # the next read. Deletion from the front of a bytearray does not copy
+        # the remainder of the buffer.
+        del self.read_buffer[:size]
+        return data
+
+    def _read_into_buffer(self, min_size):
+        """Block until data are available (or raise SerialTimeout), then
+        append everything waiting in the OS buffer (and at least min_size
+        bytes, if possible) to the read buffer."""
         try:
-            self.read_buffer = b''
-            return read_buffer
-        except KeyboardInterrupt as k:
-            self.read_buffer = read_buffer
-            raise k
+            ready,_,_ = select.select([self.fd],[],[], self.timeout)
+            # If select was used with a timeout, and the timeout occurs, it
+            # returns with empty lists -> thus abort read operation.
+            # For timeout == 0 (non-blocking operation) also abort when there
+            # is nothing to read.
+            if not ready:
+                raise SerialTimeout()   # timeout
+            s = fcntl.ioctl(self.fd, serialposix.TIOCINQ, serialposix.TIOCM_zero_str)
+            in_waiting = struct.unpack('I',s)[0]
+            buf = os.read(self.fd, max(in_waiting, min_size))
+            # read should always return some data as select reported it was
+            # ready to read when we get to this point.
+            if not buf:
+                # Disconnected devices, at least on Linux, show the
+                # behavior that they are always ready to read immediately
+                # but reading returns nothing.
+                raise SerialException('device reports readiness to read but returned no data (device disconnected or multiple access on port?)')
+            self.read_buffer += buf
+        except OSError as e:
+            # because SerialException is a IOError subclass, which is a OSError subclass,
+            # we could accidentally catch and re-raise SerialExceptions we ourselves raise earlier
+            # which is a tad silly.
+            if isinstance(e, SerialException):
+                raise
+
+            # ignore EAGAIN errors. all other errors are shown
+            if e.errno != errno.EAGAIN:
+                raise SerialException('read failed: %s' % (e,))
 
     def read_all_buffered(self):
         return self.read(self.inWaiting())
@@ -127,42 +163,30 @@ class Serial(serialposix.Serial):
             match_pos = self.read_buffer.find(match, search_start)
             if match_pos != -1:
                 break
-            search_start = len(self.read_buffer) - ml + 1
-            try:
-                ready,_,_ = select.select([self.fd],[],[], self.timeout)
-                # If select was used with a timeout, and the timeout occurs, it
-                # returns with empty lists -> thus abort read operation.
-                # For timeout == 0 (non-blocking operation) also abort when there
-                # is nothing to read.
-                if not ready:
-                    raise SerialTimeout()   # timeout
-                s = fcntl.ioctl(self.fd, serialposix.TIOCINQ, serialposix.TIOCM_zero_str)
-                in_waiting = struct.unpack('I',s)[0]
-                buf = os.read(self.fd, max(in_waiting, ml))
-                # read should always return some data as select reported it was
-                # ready to read when we get to this point.
-                if not buf:
-                    # Disconnected devices, at least on Linux, show the
-                    # behavior that they are always ready to read immediately
-                    # but reading returns nothing.
-                    raise SerialException('device reports readiness to read but returned no data (device disconnected or multiple access on port?)')
-                self.read_buffer += buf
-            except OSError as e:
-                # because SerialException is a IOError subclass, which is a OSError subclass,
-                # we could accidentally catch and re-raise SerialExceptions we ourselves raise earlier
-                # which is a tad silly.
-                if isinstance(e, SerialException):
-                    raise
+            search_start = max(len(self.read_buffer) - ml + 1, 0)
+            self._read_into_buffer(ml)
+        return self._consume(match_pos + ml)
 
-                # ignore EAGAIN errors. all other errors are shown
-                if e.errno != errno.EAGAIN:
-                    raise SerialException('read failed: %s' % (e,))
+    def read_frames(self, terminator):
+        """Read all complete frames delimited by the bytes 'terminator' that
+           are available, blocking until at least one frame is complete. Return
+           a list of bytes objects, with the terminators removed. Timeouts and
+           KeyboardInterrupts behave as for read_until(), and any trailing
+           partial frame is kept for subsequent reads.
 
-        read_buffer = self.read_buffer
-        match_last = match_pos + ml
-        try:
-            self.read_buffer = read_buffer[match_last:]
-            return read_buffer[:match_last]
-        except KeyboardInterrupt as k:
-            self.read_buffer = read_buffer
-            raise k
\ No newline at end of file
+           When a device emits many short messages in a burst, this returns
+           the whole burst from a single system call and buffer operation,
+           rather than requiring one read_until() call per message."""
+        if not self.isOpen(): raise serialposix.portNotOpenError
+        search_start = 0
+        tl = len(terminator)
+        while True:
+            last_pos = self.read_buffer.rfind(terminator, search_start)
+            if last_pos != -1:
+                break
+            search_start = max(len(self.read_buffer) - tl + 1, 0)
+            self._read_into_buffer(tl)
+        with memoryview(self.read_buffer) as view:
+            frames = bytes(view[:last_pos]).split(terminator)
+        del self.read_buffer[:last_pos + tl]
+        return frames
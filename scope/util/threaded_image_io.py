@@ -1,4 +1,5 @@
 import concurrent.futures as futures
+import threading
 import freeimage
 
 class COMPRESSION:
@@ -12,8 +13,19 @@ class COMPRESSION:
 
 
 class ThreadedIO:
-    def __init__(self, num_threads):
+    def __init__(self, num_threads, max_queued_bytes=None):
+        """Parameters:
+            num_threads: number of threads to read and write images with.
+            max_queued_bytes: maximum total size of the images queued by
+                write_async() but not yet written. Once this is reached,
+                write_async() blocks until enough earlier writes complete.
+                If None, there is no limit.
+        """
         self.threadpool = futures.ThreadPoolExecutor(num_threads)
+        self.max_queued_bytes = max_queued_bytes
+        self._queued_bytes = 0
+        self._queue_changed = threading.Condition()
+        self._async_writes = []
 
     def write(self, images, paths, flags=0):
         """Write out a list of images to the given paths."""
@@ -26,6 +38,40 @@ class ThreadedIO:
         # error out has a chance to finish before we barf an exception.
         [f.result() for f in futures_out]
 
+    def write_async(self, images, paths, flags=0):
+        """Queue a list of images to be written to the given paths, and return
+        without waiting for them to be written (unless the max_queued_bytes limit
+        has been reached). The images must not be modified after this call.
+        Call flush() to wait for all queued writes and raise any errors.
+
+        Returns a list of futures for the writes, one per image."""
+        writes = []
+        for image, path in zip(images, paths):
+            nbytes = image.nbytes
+            with self._queue_changed:
+                # an image larger than the whole budget is allowed once the queue is empty
+                self._queue_changed.wait_for(lambda: self.max_queued_bytes is None or self._queued_bytes == 0 or
+                    self._queued_bytes + nbytes <= self.max_queued_bytes)
+                self._queued_bytes += nbytes
+            writes.append(self.threadpool.submit(self._write_queued, image, path, flags, nbytes))
+        self._async_writes.extend(writes)
+        return writes
+
+    def _write_queued(self, image, path, flags, nbytes):
+        try:
+            freeimage.write(image, str(path), flags)
+        finally:
+            with self._queue_changed:
+                self._queued_bytes -= nbytes
+                self._queue_changed.notify_all()
+
+    def flush(self):
+        """Wait for all writes queued by write_async() to complete, and raise
+        the first error encountered (if any), as with write()."""
+        async_writes, self._async_writes = self._async_writes, []
+        futures.wait(async_writes)
+        [f.result() for f in async_writes]
+
     def read(self, paths):
         """Return an iterator over image arrays read from the given paths."""
         paths = map(str, paths)